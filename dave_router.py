@@ -1,30 +1,305 @@
 import json
+import os
 import threading
 import asyncio
-import websocket
-from nicegui import ui, app
-from queue import Queue
+from queue import Queue, Empty
+from collections import deque, OrderedDict
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
 import time
-import sqlalchemy
 import logging
 import datetime
 import decimal
 import urllib.parse
-import msgpack
+import re
 import base64
+import sys
+import signal
+import argparse
+import random
+import bisect
+import struct
+import hashlib
+import contextlib
+import importlib
+import weakref
+from array import array
 from multiprocessing import freeze_support
 freeze_support()
 
+class _LazyModule:
+    """Stand-in for a module that is imported on first attribute access.
+
+    Heavy dependencies stay out of startup this way. The first access also
+    rebinds the module-level name to the real module, so later lookups skip
+    the proxy entirely.
+    """
+
+    def __init__(self, name: str):
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_module", None)
+
+    def _load(self):
+        module = self._module
+        if module is None:
+            module = importlib.import_module(self._name)
+            object.__setattr__(self, "_module", module)
+            globals()[self._name] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __delattr__(self, attr):
+        delattr(self._load(), attr)
+
+    def __repr__(self):
+        return f"<lazy module {self._name!r}>"
+
+sqlalchemy = _LazyModule("sqlalchemy")
+websocket = _LazyModule("websocket")
+msgpack = _LazyModule("msgpack")
+
 # Global variables to track connection state
 ws_connection = None
 connected_username = None
-message_queue = Queue()  # Queue for thread-safe message passing
 # ws_url = "wss://api.data-dave.ai/dave-router-wss" 
 ws_url = "ws://localhost:8000/dave-router-wss" 
 
-# Engine/session cache to avoid repeated authentications (esp. Snowflake external browser)
-_engine_cache_lock = threading.Lock()
-_engine_cache = {}
+def _env_int(name: str, default: int) -> int:
+    """Read an integer setting from the environment, falling back to the default."""
+    try:
+        return int(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+# Tunnel dispatcher limits
+# - MAX_CONCURRENT_QUERIES: worker threads executing queries at once
+# - MAX_QUERIES_PER_CONNECTION: running queries allowed per connection key
+# - MAX_PENDING_QUERIES: queued queries before new requests are rejected as busy
+MAX_CONCURRENT_QUERIES = _env_int("DAVE_ROUTER_MAX_CONCURRENT_QUERIES", 8)
+MAX_QUERIES_PER_CONNECTION = _env_int("DAVE_ROUTER_MAX_QUERIES_PER_CONNECTION", 4)
+MAX_PENDING_QUERIES = _env_int("DAVE_ROUTER_MAX_PENDING_QUERIES", 256)
+# Running queries allowed per backend session (0 = no quota), so one
+# workspace cannot hold every warehouse connection
+MAX_QUERIES_PER_SESSION = _env_int("DAVE_ROUTER_MAX_QUERIES_PER_SESSION", 6)
+
+# Rows per sql-query-result-chunk frame when the request does not set chunk_rows
+STREAM_CHUNK_ROWS = _env_int("DAVE_ROUTER_STREAM_CHUNK_ROWS", 5000)
+
+# Serializes writes to ws_connection; worker threads finish in any order
+_send_lock = threading.Lock()
+# Raw MessagePack in binary frames, negotiated at login; base64 text otherwise
+binary_frames_enabled = False
+# Backend decodes typed values (MessagePack ext types, see _ext_default) instead of strings
+typed_values_enabled = False
+# WebSocket transport for sessions: "asyncio" (websockets client on the
+# NiceGUI event loop, falls back to "thread" when websockets is missing) or
+# "thread" (one blocking websocket-client thread per session)
+TRANSPORT = os.environ.get("DAVE_ROUTER_TRANSPORT", "asyncio")
+# Reconnect/keepalive settings
+# - PING_INTERVAL: seconds between keepalive pings
+# - PING_TIMEOUT: seconds without any frame (including pongs) before the socket is considered dead
+# - RECONNECT_BASE_DELAY/RECONNECT_MAX_DELAY: exponential backoff bounds in seconds
+# - RECONNECT_MAX_ATTEMPTS: consecutive failed reconnects before giving up (0 = keep trying)
+# - RESUME_BUFFER_BYTES: unacknowledged results kept for re-sending after a reconnect
+PING_INTERVAL = _env_int("DAVE_ROUTER_PING_INTERVAL", 20)
+PING_TIMEOUT = _env_int("DAVE_ROUTER_PING_TIMEOUT", 60)
+RECONNECT_BASE_DELAY = _env_int("DAVE_ROUTER_RECONNECT_BASE_DELAY", 1)
+RECONNECT_MAX_DELAY = _env_int("DAVE_ROUTER_RECONNECT_MAX_DELAY", 60)
+RECONNECT_MAX_ATTEMPTS = _env_int("DAVE_ROUTER_RECONNECT_MAX_ATTEMPTS", 0)
+RESUME_BUFFER_BYTES = _env_int("DAVE_ROUTER_RESUME_BUFFER_BYTES", 32 * 1024 * 1024)
+# Payload compression codec chosen by the backend at login (None = uncompressed)
+compression_codec = None
+# Packed payloads smaller than this are sent uncompressed
+COMPRESSION_MIN_BYTES = _env_int("DAVE_ROUTER_COMPRESSION_MIN_BYTES", 4096)
+ZSTD_LEVEL = _env_int("DAVE_ROUTER_ZSTD_LEVEL", 3)
+
+# Opt-in query result cache (requests set "cache": true); 0 bytes disables it
+RESULT_CACHE_MAX_BYTES = _env_int("DAVE_ROUTER_RESULT_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+RESULT_CACHE_TTL = _env_int("DAVE_ROUTER_RESULT_CACHE_TTL", 300)
+
+# Statement timeout applied when a sql-query has no timeout_ms (0 = no timeout)
+DEFAULT_QUERY_TIMEOUT_MS = _env_int("DAVE_ROUTER_DEFAULT_TIMEOUT_MS", 0)
+
+# Result size limits for queries that do not set max_rows/max_bytes (0 = unlimited)
+DEFAULT_MAX_ROWS = _env_int("DAVE_ROUTER_DEFAULT_MAX_ROWS", 0)
+DEFAULT_MAX_BYTES = _env_int("DAVE_ROUTER_DEFAULT_MAX_BYTES", 0)
+
+# Dialects whose drivers are imported in the background at startup, e.g. "postgresql,snowflake"
+PREWARM_DRIVERS = [d.strip() for d in os.environ.get("DAVE_ROUTER_PREWARM_DRIVERS", "").split(",") if d.strip()]
+
+# Lines kept in the UI terminal; the oldest are dropped once it is full
+TERMINAL_HISTORY = _env_int("DAVE_ROUTER_TERMINAL_HISTORY", 1000)
+# UI event bus
+# - UI_EVENT_QUEUE_SIZE: events waiting for delivery before new query (sql_*) events are dropped (and counted)
+# - UI_EVENT_BATCH_MS: delay after the first event of a burst so the rest land in the same batch
+# - UI_EVENT_COALESCE_MIN: same-type query events in one batch folded into a single summary line
+UI_EVENT_QUEUE_SIZE = _env_int("DAVE_ROUTER_UI_EVENT_QUEUE_SIZE", 1000)
+UI_EVENT_BATCH_MS = _env_int("DAVE_ROUTER_UI_EVENT_BATCH_MS", 50)
+UI_EVENT_COALESCE_MIN = _env_int("DAVE_ROUTER_UI_EVENT_COALESCE_MIN", 10)
+
+# Connection-state events: never dropped, and only the latest of each type is kept waiting
+_STATE_EVENTS = {"connected", "disconnected", "reconnecting", "login_failed"}
+
+class _EventBus:
+    """Pushes UI events from worker threads to the NiceGUI event loop in batches.
+
+    put() is thread-safe and never blocks. The first event after a delivery schedules
+    one callback on the subscriber's loop (call_soon_threadsafe, then UI_EVENT_BATCH_MS
+    later); everything put in between is delivered with it. Per-query (sql_*) events
+    that arrive while `capacity` are already waiting are dropped and counted. Other
+    events are always accepted; a connection-state event replaces a waiting one of
+    the same type, so the UI always ends on the latest state.
+    """
+
+    def __init__(self, capacity: int, batch_delay: float):
+        self._capacity = max(1, capacity)
+        self._batch_delay = batch_delay
+        self._lock = threading.Lock()
+        self._pending = deque()
+        self._handler = None
+        self._loop = None
+        self._scheduled = False
+        self._dropped_since_delivery = 0
+        self.dropped = 0
+
+    def subscribe(self, handler, loop=None):
+        """Deliver batches as handler(events, dropped) on loop (the running loop by default)."""
+        with self._lock:
+            self._handler = handler
+            self._loop = loop or asyncio.get_running_loop()
+        self._schedule()
+
+    def put(self, event: dict):
+        kind = event.get("type")
+        with self._lock:
+            if kind in _STATE_EVENTS:
+                for waiting in self._pending:
+                    if waiting.get("type") == kind:
+                        self._pending.remove(waiting)
+                        break
+            elif str(kind).startswith("sql_") and len(self._pending) >= self._capacity:
+                self.dropped += 1
+                self._dropped_since_delivery += 1
+                return
+            self._pending.append(event)
+            if self._scheduled or self._loop is None:
+                return
+        self._schedule()
+
+    def _schedule(self):
+        with self._lock:
+            if self._scheduled or self._loop is None or not self._pending:
+                return
+            self._scheduled = True
+            loop = self._loop
+        try:
+            loop.call_soon_threadsafe(loop.call_later, self._batch_delay, self._deliver)
+        except RuntimeError:
+            # Loop closed (shutdown); keep buffering up to capacity
+            with self._lock:
+                self._scheduled = False
+
+    def _deliver(self):
+        with self._lock:
+            events = list(self._pending)
+            self._pending.clear()
+            dropped, self._dropped_since_delivery = self._dropped_since_delivery, 0
+            self._scheduled = False
+            handler = self._handler
+        if handler and (events or dropped):
+            try:
+                handler(events, dropped)
+            except Exception:
+                logging.getLogger("dave_router.events").exception(f"Failed to deliver {len(events)} UI event(s)")
+
+    def drain(self) -> list:
+        """Take every waiting event without delivering it."""
+        with self._lock:
+            events = list(self._pending)
+            self._pending.clear()
+            self._dropped_since_delivery = 0
+        return events
+
+    def __len__(self):
+        return len(self._pending)
+
+# Query events folded when a batch holds at least UI_EVENT_COALESCE_MIN of them
+_COALESCED_EVENTS = {
+    "sql_success": "SQL Success: {count} queries completed.",
+    "sql_execution_info": "Executed {count} queries.",
+}
+
+def _coalesce_events(events: list) -> list:
+    """Fold bursts of per-query events into one summary event, keeping everything else in order."""
+    counts = {}
+    for event in events:
+        kind = event.get("type")
+        if kind in _COALESCED_EVENTS:
+            counts[kind] = counts.get(kind, 0) + 1
+    folded = {kind for kind, count in counts.items() if count >= max(2, UI_EVENT_COALESCE_MIN)}
+    if not folded:
+        return events
+    result = []
+    seen = dict.fromkeys(folded, 0)
+    for event in events:
+        kind = event.get("type")
+        if kind not in folded:
+            result.append(event)
+            continue
+        seen[kind] += 1
+        # The summary takes the place of the last folded event
+        if seen[kind] == counts[kind]:
+            result.append({"type": "sql_success" if kind == "sql_success" else "info",
+                           "message": _COALESCED_EVENTS[kind].format(count=counts[kind])})
+    return result
+
+# UI events from worker and session threads (see _EventBus)
+message_queue = _EventBus(UI_EVENT_QUEUE_SIZE, UI_EVENT_BATCH_MS / 1000)
+
+# Engine cache bounds
+# - MAX_ENGINES: engines (and their connection pools) kept at once; least recently used go first
+# - ENGINE_IDLE_TTL: seconds an engine may sit unused before its pool is disposed
+MAX_ENGINES = _env_int("DAVE_ROUTER_MAX_ENGINES", 16)
+ENGINE_IDLE_TTL = _env_int("DAVE_ROUTER_ENGINE_IDLE_TTL", 1800)
+# Pool pre-warming for known targets (DAVE_ROUTER_TARGETS or router-targets messages)
+# - PREWARM_MIN_CONNECTIONS: pooled connections opened per target before its first query
+# - POOL_KEEPALIVE_INTERVAL: seconds between passes that ping and top up warmed pools (0 = off)
+PREWARM_MIN_CONNECTIONS = _env_int("DAVE_ROUTER_PREWARM_MIN_CONNECTIONS", 1)
+POOL_KEEPALIVE_INTERVAL = _env_int("DAVE_ROUTER_POOL_KEEPALIVE_INTERVAL", 300)
+
+def _load_pool_settings() -> dict:
+    """Per-dialect pool_size/max_overflow, overridable with DAVE_ROUTER_POOL_SETTINGS (JSON)."""
+    settings = {
+        "default": {"pool_size": 5, "max_overflow": 10},
+        # Warehouse sessions are expensive to open and hold; keep these pools small
+        "snowflake": {"pool_size": 2, "max_overflow": 2},
+        "bigquery": {"pool_size": 2, "max_overflow": 2},
+    }
+    try:
+        overrides = json.loads(os.environ.get("DAVE_ROUTER_POOL_SETTINGS") or "{}")
+        for dialect, values in overrides.items():
+            settings[dialect] = {**settings.get(dialect, settings["default"]), **values}
+    except (ValueError, AttributeError, TypeError):
+        logging.getLogger("dave_router").warning("Ignoring invalid DAVE_ROUTER_POOL_SETTINGS")
+    return settings
+
+ENGINE_POOL_SETTINGS = _load_pool_settings()
+
+# Secret connectionObject fields, hashed into the connection key
+_CREDENTIAL_FIELDS = ("password", "private_key", "private_key_passphrase", "token", "access_token")
+# Per-process key for credential digests, so connection keys (logged at debug) cannot be brute-forced offline
+_CREDENTIAL_DIGEST_KEY = os.urandom(16)
+
+def _credential_digest(connection_object: dict) -> str:
+    secrets = [(field, str(connection_object[field])) for field in _CREDENTIAL_FIELDS if connection_object.get(field)]
+    if not secrets:
+        return ""
+    return hashlib.blake2b(json.dumps(secrets).encode(), key=_CREDENTIAL_DIGEST_KEY, digest_size=16).hexdigest()
 
 def _connection_key_from_object(connection_object: dict) -> str:
     """Create a stable key identifying a logical DB session target.
@@ -41,48 +316,1543 @@ def _connection_key_from_object(connection_object: dict) -> str:
         "database": connection_object.get("database"),
         # Optional/driver-specific extras that may affect auth/session
         "schema": connection_object.get("schema"),
+        "schemas": connection_object.get("schemas"),
         "role": connection_object.get("role"),
         "warehouse": connection_object.get("warehouse"),
         # For Snowflake: whether external browser auth is used
         "snowflake_externalbrowser": bool(connection_object.get("snowflake_externalbrowser")),
+        # Sessions may belong to different users; a wrong password must not reuse an authenticated pool
+        "credential": _credential_digest(connection_object),
     }
     # Stable JSON key
     return json.dumps(key_fields, sort_keys=True, separators=(",", ":"))
 
-def _get_or_create_engine(url: str, connect_args: dict, conn_key: str, logger: logging.Logger) -> sqlalchemy.Engine:
-    """Return a cached SQLAlchemy engine for this connection key, creating it if needed.
+class DialectBuilder:
+    """Builds the SQLAlchemy URL and connect_args for one dialect.
+
+    Builders replicate the backend adapters. Add support for a new dialect by
+    subclassing and decorating the class with @register_dialect_builder.
+    """
+    dialect = None
+    # SQLAlchemy "dialect+driver" name, used to pre-load the driver (defaults to dialect)
+    driver = None
+
+    def build(self, connection_object: dict, logger: logging.Logger):
+        """Return (url, connect_args) for connection_object."""
+        raise NotImplementedError
+
+    def apply_timeout(self, conn, timeout_ms: int):
+        """Set a driver-level statement timeout on conn before the query runs."""
+
+    def reset_timeout(self, conn):
+        """Undo apply_timeout before conn goes back to the pool."""
+
+    def cancel(self, handle, logger: logging.Logger) -> bool:
+        """Cancel the statement running on handle.dbapi_connection. Returns False if unsupported.
+
+        Runs with handle.cancel_lock held, so the connection stays checked out
+        until this returns. Cancels sent over a second session should connect
+        through _cancel_engine(handle), never the query's own (possibly full) pool.
+        """
+        if hasattr(handle.dbapi_connection, "cancel"):
+            handle.dbapi_connection.cancel()
+            return True
+        return False
+
+    @staticmethod
+    def host_port(connection_object: dict) -> str:
+        host = connection_object.get("host")
+        port = connection_object.get("port")
+        return f"{host}:{port}" if port else f"{host}"
+
+_DIALECT_BUILDERS = {}
+
+def register_dialect_builder(builder_cls):
+    """Class decorator registering a DialectBuilder for its dialect name."""
+    _DIALECT_BUILDERS[builder_cls.dialect] = builder_cls()
+    return builder_cls
+
+@register_dialect_builder
+class PostgresBuilder(DialectBuilder):
+    dialect = "postgresql"
+    driver = "postgresql+psycopg2"
+
+    def build(self, connection_object, logger):
+        c = connection_object
+        connect_args = {}
+        # Handle multi-schema for PostgreSQL
+        schemas = c.get("schemas")
+        if schemas and isinstance(schemas, list):
+            # Safely quote schema names and join them
+            quoted_schemas = [f'"{s.strip()}"' for s in schemas]
+            connect_args["options"] = f"-c search_path={','.join(quoted_schemas)}"
+            logger.info(f"PostgreSQL multi-schema mode. Setting search_path to: {','.join(quoted_schemas)}")
+        elif c.get("schema"):
+            # Handle legacy single schema
+            connect_args["options"] = f"-c search_path={c['schema']}"
+            logger.info(f"PostgreSQL single-schema mode. Setting search_path to: {c['schema']}")
+
+        # Use the correct driver for postgresql
+        url = f"postgresql+psycopg2://{c.get('user')}:{c.get('password')}@{c.get('host')}:{c.get('port')}/{c.get('database')}"
+        return url, connect_args
+
+    def apply_timeout(self, conn, timeout_ms):
+        # SET LOCAL only lasts until the transaction ends, so nothing to reset
+        conn.exec_driver_sql(f"SET LOCAL statement_timeout = {int(timeout_ms)}")
+
+    def cancel(self, handle, logger):
+        # psycopg2 sends a cancel request on a side channel; safe from another thread
+        handle.dbapi_connection.cancel()
+        return True
+
+@register_dialect_builder
+class SnowflakeBuilder(DialectBuilder):
+    dialect = "snowflake"
+
+    def build(self, connection_object, logger):
+        c = connection_object
+        connect_args = {}
+        # Router-side: optionally use external browser auth when requested
+        use_external = bool(c.get("snowflake_externalbrowser"))
+        params = {}
+        if c.get("schema"):
+            params['schema'] = c.get("schema")
+        if c.get("warehouse"):
+            params['warehouse'] = c.get("warehouse")
+        if c.get("role"):
+            params['role'] = c.get("role")
+
+        if use_external:
+            params["authenticator"] = "externalbrowser"
+            # Enable connector-side token caching to avoid repeated SSO prompts
+            connect_args["client_store_temporary_credential"] = True
+            url = f"snowflake://{c.get('user')}@{self.host_port(c)}/{c.get('database')}"
+            logger.info(f"Snowflake connection using external browser auth with token caching enabled")
+        else:
+            # Fallback to password/PAT if provided
+            if not c.get("password"):
+                raise ValueError("Snowflake password/PAT is required when not using external browser auth")
+            url = f"snowflake://{c.get('user')}:{c.get('password')}@{self.host_port(c)}/{c.get('database')}"
+            logger.info(f"Snowflake connection using password/PAT")
+
+        if params:
+            url += f"?{urllib.parse.urlencode(params)}"
+        # Supported by snowflake-connector; keeps the session active in the background
+        # to minimize re-auth prompts
+        connect_args.setdefault("client_session_keep_alive", True)
+        return url, connect_args
+
+    def apply_timeout(self, conn, timeout_ms):
+        seconds = max(1, -(-int(timeout_ms) // 1000))
+        conn.exec_driver_sql(f"ALTER SESSION SET STATEMENT_TIMEOUT_IN_SECONDS = {seconds}")
+
+    def reset_timeout(self, conn):
+        conn.exec_driver_sql("ALTER SESSION UNSET STATEMENT_TIMEOUT_IN_SECONDS")
+
+    def cancel(self, handle, logger):
+        # Cancel from a second session; the busy one is blocked in execute()
+        session_id = int(handle.dbapi_connection.session_id)
+        with _cancel_engine(handle).connect() as side_conn:
+            side_conn.exec_driver_sql(f"SELECT SYSTEM$CANCEL_ALL_QUERIES({session_id})")
+        return True
+
+@register_dialect_builder
+class BigQueryBuilder(DialectBuilder):
+    dialect = "bigquery"
+
+    def build(self, connection_object, logger):
+        # BigQuery uses the project_id as the "host" and may have a default dataset
+        project_id = connection_object.get("database")  # Mapped to project_id on the backend
+        dataset = connection_object.get("schema")  # Mapped to a single dataset
+        if dataset:
+            url = f"bigquery://{project_id}/{dataset}"
+        else:
+            url = f"bigquery://{project_id}"
+        logger.info(f"BigQuery connection url: {url}")
+        return url, {}
+
+    def apply_timeout(self, conn, timeout_ms):
+        # Jobs inherit the client's default job config; set job_timeout_ms there
+        from google.cloud import bigquery
+        client = conn.connection.dbapi_connection._client
+        conn.info["dave_default_job_config"] = client.default_query_job_config
+        job_config = bigquery.QueryJobConfig(job_timeout_ms=int(timeout_ms))
+        if client.default_query_job_config is not None:
+            job_config = job_config._fill_from_default(client.default_query_job_config)
+        client.default_query_job_config = job_config
+
+    def reset_timeout(self, conn):
+        if "dave_default_job_config" in conn.info:
+            conn.connection.dbapi_connection._client.default_query_job_config = conn.info.pop("dave_default_job_config")
+
+    def cancel(self, handle, logger):
+        # The DB-API connection tracks its cursors; running ones hold their QueryJob
+        cancelled = False
+        for cursor in list(getattr(handle.dbapi_connection, "_cursors_created", ())):
+            query_job = getattr(cursor, "_query_job", None)
+            if query_job is not None and not query_job.done():
+                query_job.cancel()
+                cancelled = True
+        return cancelled
+
+@register_dialect_builder
+class MySQLBuilder(DialectBuilder):
+    dialect = "mysql"
+    driver = "mysql+pymysql"
+
+    def build(self, connection_object, logger):
+        c = connection_object
+        return f"mysql+pymysql://{c.get('user')}:{c.get('password')}@{c.get('host')}:{c.get('port')}/{c.get('database')}", {}
+
+    def apply_timeout(self, conn, timeout_ms):
+        # MySQL 5.7+; applies to SELECT statements
+        conn.exec_driver_sql(f"SET SESSION max_execution_time = {int(timeout_ms)}")
+
+    def reset_timeout(self, conn):
+        conn.exec_driver_sql("SET SESSION max_execution_time = 0")
+
+    def cancel(self, handle, logger):
+        thread_id = int(handle.dbapi_connection.thread_id())
+        with _cancel_engine(handle).connect() as side_conn:
+            side_conn.exec_driver_sql(f"KILL QUERY {thread_id}")
+        return True
+
+@register_dialect_builder
+class SQLiteBuilder(DialectBuilder):
+    """Local SQLite files; "database" is the file path (empty for in-memory)."""
+    dialect = "sqlite"
+
+    def build(self, connection_object, logger):
+        return f"sqlite:///{connection_object.get('database') or ''}", {"check_same_thread": False}
+
+    def cancel(self, handle, logger):
+        handle.dbapi_connection.interrupt()
+        return True
+
+class GenericBuilder(DialectBuilder):
+    """Fallback for dialects without a registered builder."""
+
+    def build(self, connection_object, logger):
+        c = connection_object
+        return f"{c.get('dialect')}://{c.get('user')}:{c.get('password')}@{c.get('host')}:{c.get('port')}/{c.get('database')}", {}
+
+_GENERIC_BUILDER = GenericBuilder()
+
+def _load_driver(dialect: str):
+    """Import the SQLAlchemy dialect and DB-API module for dialect; returns the DB-API module."""
+    builder = _DIALECT_BUILDERS.get(dialect, _GENERIC_BUILDER)
+    dialect_cls = sqlalchemy.engine.make_url(f"{builder.driver or dialect}://").get_dialect()
+    return dialect_cls.import_dbapi()
+
+def prewarm_drivers(dialects=None) -> threading.Thread:
+    """Import SQLAlchemy and the drivers for dialects (default PREWARM_DRIVERS) on a background thread.
+
+    The first query to each dialect then skips the driver import.
+    """
+    dialects = PREWARM_DRIVERS if dialects is None else dialects
+    logger = logging.getLogger("dave_router.prewarm")
+
+    def load():
+        started = time.perf_counter()
+        sqlalchemy.engine  # noqa: B018 - loads the package
+        for dialect in dialects:
+            try:
+                _load_driver(dialect)
+            except Exception as e:
+                logger.warning(f"Could not pre-load the {dialect} driver: {str(e)}")
+        logger.info(f"Pre-loaded SQLAlchemy and {len(dialects)} driver(s) in {time.perf_counter() - started:.2f}s")
+
+    thread = threading.Thread(target=load, name="dave-prewarm", daemon=True)
+    thread.start()
+    return thread
+
+class _ConnectionTarget:
+    """A compiled connectionObject: dialect, SQLAlchemy URL, connect_args and cache key."""
+    __slots__ = ("dialect", "url", "connect_args", "key", "builder")
+
+    def __init__(self, dialect: str, url: str, connect_args: dict, key: str, builder: DialectBuilder):
+        self.dialect = dialect
+        self.url = url
+        self.connect_args = connect_args
+        self.key = key
+        self.builder = builder
+
+def _fingerprint(connection_object: dict):
+    """Cheap hashable identity of a connectionObject (all fields, including password)."""
+    try:
+        fingerprint = tuple(sorted(
+            (k, tuple(v) if isinstance(v, list) else v) for k, v in connection_object.items()
+        ))
+        hash(fingerprint)
+        return fingerprint
+    except TypeError:
+        # Nested or otherwise unhashable values
+        return repr(sorted(connection_object.items(), key=lambda item: item[0]))
+
+class _TargetRegistry:
+    """LRU registry of compiled connection targets keyed by connectionObject fingerprint.
+
+    The backend sends the full connectionObject with every query; compiling it
+    (URL, connect_args and engine cache key) happens once, after which repeated
+    queries only pay for a tuple hash.
+    """
+
+    def __init__(self, max_targets: int):
+        self.max_targets = max(1, max_targets)
+        self._lock = threading.Lock()
+        self._targets = OrderedDict()
+
+    def resolve(self, connection_object: dict, logger: logging.Logger) -> _ConnectionTarget:
+        fingerprint = _fingerprint(connection_object)
+        with self._lock:
+            target = self._targets.get(fingerprint)
+            if target is not None:
+                self._targets.move_to_end(fingerprint)
+                return target
+        target = self.compile(connection_object, logger)
+        with self._lock:
+            self._targets[fingerprint] = target
+            while len(self._targets) > self.max_targets:
+                self._targets.popitem(last=False)
+        return target
+
+    @staticmethod
+    def compile(connection_object: dict, logger: logging.Logger) -> _ConnectionTarget:
+        """Build a target from scratch, bypassing the registry."""
+        dialect = connection_object.get("dialect", "mysql")
+        builder = _DIALECT_BUILDERS.get(dialect, _GENERIC_BUILDER)
+        url, connect_args = builder.build(connection_object, logger)
+        logger.info(f"Connecting to DB with dialect '{dialect}': {url}")
+        return _ConnectionTarget(dialect, url, connect_args, _connection_key_from_object(connection_object), builder)
+
+    def clear(self):
+        with self._lock:
+            self._targets.clear()
+
+_target_registry = _TargetRegistry(_env_int("DAVE_ROUTER_MAX_TARGETS", 256))
+
+class _EngineCache:
+    """Bounded cache of SQLAlchemy engines keyed by connection key.
 
     Reusing engines lets the underlying connector keep sessions alive and
     leverage any token/credential caching, which prevents repeated SSO prompts.
+    The cache holds at most max_engines entries, evicting the least recently
+    used one when full, and drops engines idle for longer than idle_ttl.
+    Evicted pools are disposed on a background janitor thread so query
+    threads never wait on closing DB connections.
+
+    Hits are served without taking the cache lock. Misses are single-flight
+    per key: concurrent first queries to a target share one engine build, and
+    a slow build (e.g. a Snowflake external-browser login) never blocks other
+    targets. Hit/miss counters are updated without a lock and may be slightly
+    low under heavy contention.
     """
-    with _engine_cache_lock:
-        engine_entry = _engine_cache.get(conn_key)
-        if engine_entry:
+
+    def __init__(self, max_engines: int, idle_ttl: float, sweep_interval: float = 60):
+        self.max_engines = max(1, max_engines)
+        self.idle_ttl = idle_ttl
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()  # guards mutation of _entries and _creation_locks
+        self._entries = {}  # conn_key -> entry dict; LRU order comes from last_used_at
+        self._creation_locks = {}  # conn_key -> lock held while that key's engine is built
+        self._dispose_queue = Queue()
+        self._janitor = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_or_create(self, conn_key: str, factory, logger: logging.Logger, dialect: str = None):
+        """Return the engine for conn_key, creating it with factory() on a miss."""
+        # Fast path: a single dict lookup is atomic, no lock needed
+        entry = self._entries.get(conn_key)
+        if entry:
+            entry["last_used_at"] = time.time()
+            self.hits += 1
             logger.debug("Reusing cached engine for key=%s", conn_key)
-            return engine_entry["engine"]
+            return entry["engine"]
+
+        with self._lock:
+            creation_lock = self._creation_locks.setdefault(conn_key, threading.Lock())
+        with creation_lock:
+            # Another thread may have finished building while we waited
+            entry = self._entries.get(conn_key)
+            if entry:
+                entry["last_used_at"] = time.time()
+                self.hits += 1
+                return entry["engine"]
+
+            self.misses += 1
+            engine = factory()
+            now = time.time()
+            with self._lock:
+                self._entries[conn_key] = {
+                    "engine": engine,
+                    "dialect": dialect,
+                    "created_at": now,
+                    "last_used_at": now,
+                }
+                # Waiters still hold the lock object; later arrivals take the fast path
+                self._creation_locks.pop(conn_key, None)
+                while len(self._entries) > self.max_engines:
+                    oldest_key = min(self._entries, key=lambda k: self._entries[k]["last_used_at"])
+                    self._evict_locked(oldest_key, "capacity", logger)
+                self._ensure_janitor()
+            logger.debug("Created new engine and cached for key=%s", conn_key)
+            return engine
+
+    def peek(self, conn_key: str):
+        """The cached engine for conn_key without marking it used, or None."""
+        entry = self._entries.get(conn_key)
+        return entry["engine"] if entry else None
+
+    def touch(self, conn_key: str):
+        """Mark conn_key as used now, e.g. when a long query finishes."""
+        with self._lock:
+            entry = self._entries.get(conn_key)
+            if entry:
+                entry["last_used_at"] = time.time()
+
+    def evict_idle(self, logger: logging.Logger = None) -> int:
+        """Evict engines unused for longer than idle_ttl. Returns the number evicted."""
+        logger = logger or logging.getLogger("dave_router.engine_cache")
+        cutoff = time.time() - self.idle_ttl
+        with self._lock:
+            idle_keys = [key for key, entry in self._entries.items() if entry["last_used_at"] < cutoff]
+            for key in idle_keys:
+                self._evict_locked(key, "idle", logger)
+        return len(idle_keys)
 
+    def clear(self):
+        """Evict and dispose every cached engine."""
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+            self._creation_locks.clear()
+        for entry in entries:
+            self._dispose(entry["engine"])
+
+    def __contains__(self, conn_key):
+        return conn_key in self._entries
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"engines": len(self._entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    def pool_stats(self) -> list:
+        """(conn_key, dialect, checked-out connections) for every cached engine."""
+        with self._lock:
+            entries = list(self._entries.items())
+        stats = []
+        for conn_key, entry in entries:
+            checkedout = getattr(entry["engine"].pool, "checkedout", None)
+            stats.append((conn_key, entry["dialect"], checkedout() if callable(checkedout) else 0))
+        return stats
+
+    def _evict_locked(self, conn_key: str, reason: str, logger: logging.Logger):
+        entry = self._entries.pop(conn_key)
+        self.evictions += 1
+        logger.info(f"Evicting engine ({reason}): dialect={entry['dialect']}")
+        # Connections still checked out are closed when their query returns them
+        self._dispose_queue.put(entry["engine"])
+
+    def _ensure_janitor(self):
+        if self._janitor is None or not self._janitor.is_alive():
+            self._janitor = threading.Thread(target=self._janitor_loop, name="dave-engine-janitor", daemon=True)
+            self._janitor.start()
+
+    def _janitor_loop(self):
+        next_sweep = time.monotonic() + self.sweep_interval
+        while True:
+            try:
+                engine = self._dispose_queue.get(timeout=max(0.0, next_sweep - time.monotonic()))
+                self._dispose(engine)
+            except Empty:
+                self.evict_idle()
+                next_sweep = time.monotonic() + self.sweep_interval
+
+    @staticmethod
+    def _dispose(engine):
+        try:
+            engine.dispose()
+        except Exception as e:
+            logging.getLogger("dave_router.engine_cache").error(f"Failed to dispose engine: {str(e)}")
+
+_engine_cache = _EngineCache(MAX_ENGINES, ENGINE_IDLE_TTL)
+
+def _uses_queue_pool(url: str) -> bool:
+    """Whether create_engine(url) would default to a QueuePool (the only pool sized by pool_size)."""
+    try:
+        parsed = sqlalchemy.engine.make_url(url)
+        return issubclass(parsed.get_dialect().get_pool_class(parsed), sqlalchemy.pool.QueuePool)
+    except Exception:
+        # Unknown or uninstalled dialect: let create_engine report the real error
+        return True
+
+def _get_or_create_engine(url: str, connect_args: dict, conn_key: str, logger: logging.Logger, dialect: str = None) -> "sqlalchemy.Engine":
+    """Return a cached SQLAlchemy engine for this connection key, creating it if needed."""
+    def create():
         # Create a new engine with reasonable pool settings
         # - pool_pre_ping: validate connections before use
         # - pool_recycle: recycle connections periodically to avoid stale sessions
-        engine = sqlalchemy.create_engine(
+        # - pool_size/max_overflow: per dialect, see ENGINE_POOL_SETTINGS; only QueuePool
+        #   accepts them (in-memory SQLite uses SingletonThreadPool, for example)
+        pool_settings = ENGINE_POOL_SETTINGS.get(dialect) or ENGINE_POOL_SETTINGS["default"]
+        if not _uses_queue_pool(url):
+            pool_settings = {}
+        return sqlalchemy.create_engine(
             url,
             connect_args=connect_args,
             pool_pre_ping=True,
             pool_recycle=1800,  # 30 minutes
+            **pool_settings,
         )
-        _engine_cache[conn_key] = {
-            "engine": engine,
-            "created_at": time.time(),
-            "last_used_at": time.time(),
-        }
-        logger.debug("Created new engine and cached for key=%s", conn_key)
+    return _engine_cache.get_or_create(conn_key, create, logger, dialect)
+
+def _pool_count(pool, name: str) -> int:
+    """pool.checkedin()/checkedout(), or 0 for pools that do not track them."""
+    count = getattr(pool, name, None)
+    return count() if callable(count) else 0
+
+class _PoolWarmer:
+    """Opens pooled connections to known targets before their first query and keeps them alive.
+
+    Targets come from DAVE_ROUTER_TARGETS (source "config") or router-targets
+    messages (source = session name); each source's list replaces the one it
+    sent before. Warming runs on a small background pool so a slow login (e.g.
+    Snowflake) never holds up the WebSocket or queries. Every
+    keepalive_interval seconds warmed pools are revisited: checkout pings idle
+    connections (pool_pre_ping), replaces dead ones and keeps the engine from
+    idle eviction. Targets dropped from every list are no longer kept alive
+    and age out of the engine cache as usual.
+    """
+
+    def __init__(self, keepalive_interval: float, max_workers: int = 4):
+        self.keepalive_interval = keepalive_interval
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._targets = {}  # conn_key -> state dict
+        self._executor = None
+        self._keepalive_thread = None
+
+    def set_targets(self, source: str, entries: list, logger: logging.Logger) -> list:
+        """Replace source's targets with entries and warm them. Returns one future per target."""
+        compiled = {}
+        for entry in entries or []:
+            if not isinstance(entry, dict) or not isinstance(entry.get("connectionObject"), dict):
+                logger.warning("Ignoring router target without a connectionObject")
+                continue
+            try:
+                target = _target_registry.resolve(entry["connectionObject"], logger)
+            except Exception as e:
+                logger.warning(f"Ignoring router target: {str(e)}")
+                continue
+            compiled[target.key] = (target, entry)
+        with self._lock:
+            for state in self._targets.values():
+                state["sources"].discard(source)
+            for conn_key, (target, entry) in compiled.items():
+                state = self._targets.get(conn_key)
+                if state is None:
+                    state = self._targets[conn_key] = {
+                        "target": target, "sources": set(), "id": None, "state": "cold",
+                        "error": None, "warmed_at": None, "busy": False,
+                    }
+                state["target"] = target
+                state["sources"].add(source)
+                state["min_connections"] = self._min_connections(entry, target.dialect)
+                if entry.get("id") is not None:
+                    state["id"] = entry["id"]
+            for conn_key in [key for key, state in self._targets.items() if not state["sources"]]:
+                del self._targets[conn_key]
+            states = [self._targets[conn_key] for conn_key in compiled]
+        self._ensure_keepalive()
+        return [self._submit(state, logger) for state in states]
+
+    @staticmethod
+    def _min_connections(entry: dict, dialect: str) -> int:
+        try:
+            wanted = int(entry.get("min_connections", PREWARM_MIN_CONNECTIONS))
+        except (TypeError, ValueError):
+            wanted = PREWARM_MIN_CONNECTIONS
+        # Never more than the pool keeps idle
+        pool_size = (ENGINE_POOL_SETTINGS.get(dialect) or ENGINE_POOL_SETTINGS["default"]).get("pool_size", wanted)
+        return max(0, min(wanted, pool_size))
+
+    def _submit(self, state: dict, logger: logging.Logger):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="dave-prewarm")
+            if state["busy"]:
+                # Already being warmed; report on the running attempt
+                return state["future"]
+            state["busy"] = True
+            state["future"] = self._executor.submit(self._warm, state, logger)
+            return state["future"]
+
+    def _warm(self, state: dict, logger: logging.Logger):
+        target = state["target"]
+        if state["state"] != "warm":
+            state["state"] = "warming"
+        try:
+            engine = _get_or_create_engine(target.url, target.connect_args, target.key, logger, target.dialect)
+            # Checking out existing idle connections pings them; the rest are opened now
+            wanted = max(0, state["min_connections"] - _pool_count(engine.pool, "checkedout"))
+            connections = []
+            try:
+                for _ in range(wanted):
+                    connections.append(engine.connect())
+            finally:
+                for connection in connections:
+                    connection.close()
+            state.update(state="warm", error=None, warmed_at=time.time())
+        except Exception as e:
+            state.update(state="cold", error=str(e))
+            logger.warning(f"Could not warm {target.dialect} target: {str(e)}")
+        finally:
+            state["busy"] = False
+
+    def _ensure_keepalive(self):
+        with self._lock:
+            if self.keepalive_interval <= 0 or (self._keepalive_thread and self._keepalive_thread.is_alive()):
+                return
+            self._keepalive_thread = threading.Thread(target=self._keepalive_loop, name="dave-pool-keepalive",
+                                                      daemon=True)
+            self._keepalive_thread.start()
+
+    def _keepalive_loop(self):
+        logger = logging.getLogger("dave_router.prewarm")
+        while True:
+            time.sleep(self.keepalive_interval)
+            with self._lock:
+                states = list(self._targets.values())
+            for state in states:
+                self._submit(state, logger)
+
+    def status(self, source: str = None) -> list:
+        """Warm/cold state of every target (or only source's), without credentials."""
+        with self._lock:
+            states = [state for state in self._targets.values() if source is None or source in state["sources"]]
+        report = []
+        for state in states:
+            target = state["target"]
+            warm = state["state"] == "warm" and target.key in _engine_cache
+            engine = _engine_cache.peek(target.key) if warm else None
+            report.append({
+                "id": state["id"],
+                "dialect": target.dialect,
+                "conn": _conn_label(target.key),
+                "state": "warm" if warm else ("warming" if state["state"] == "warming" else "cold"),
+                "connections": _pool_count(engine.pool, "checkedin") if engine is not None else 0,
+                "min_connections": state["min_connections"],
+                "error": state["error"],
+                "warmed_at": state["warmed_at"],
+            })
+        return report
+
+    def clear(self):
+        with self._lock:
+            self._targets.clear()
+
+_pool_warmer = _PoolWarmer(POOL_KEEPALIVE_INTERVAL)
+
+def set_router_targets(entries: list, source: str = "config") -> list:
+    """Warm the pools for entries ({"connectionObject": {...}, "min_connections": n, "id": ...})."""
+    return _pool_warmer.set_targets(source, entries, logging.getLogger("dave_router.prewarm"))
+
+def target_stats() -> list:
+    """Warm/cold state per known target, for diagnostics."""
+    return _pool_warmer.status()
+
+def _load_configured_targets() -> list:
+    """Known targets from DAVE_ROUTER_TARGETS (a JSON list, see set_router_targets)."""
+    raw = os.environ.get("DAVE_ROUTER_TARGETS")
+    if not raw:
+        return []
+    try:
+        targets = json.loads(raw)
+    except ValueError as e:
+        logging.getLogger("dave_router").error(f"Ignoring invalid DAVE_ROUTER_TARGETS: {str(e)}")
+        return []
+    return targets if isinstance(targets, list) else []
+
+def start_configured_targets(targets=None):
+    """Warm every target listed in targets (default: DAVE_ROUTER_TARGETS)."""
+    targets = _load_configured_targets() if targets is None else targets
+    if targets:
+        set_router_targets(targets)
+
+class _StageTimer:
+    """Seconds spent per pipeline stage by the request running on this thread."""
+    __slots__ = ("stages", "labels", "rows", "bytes_sent")
+
+    def __init__(self):
+        self.stages = {}
+        self.labels = ("unknown", "")  # (dialect, hashed connection key)
+        self.rows = 0
+        self.bytes_sent = 0
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def as_millis(self, total: float) -> dict:
+        """The "timings" object of a response: milliseconds per stage plus total_ms."""
+        timings = {f"{stage}_ms": round(seconds * 1000, 3) for stage, seconds in self.stages.items()}
+        timings["total_ms"] = round(total * 1000, 3)
+        return timings
+
+_request_timer = threading.local()
+
+@contextlib.contextmanager
+def _stage(name: str):
+    """Add the time spent in the block to the current request's stage timer."""
+    timer = getattr(_request_timer, "timer", None)
+    if timer is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - start)
+
+def _timed_iter(iterable, stage: str):
+    """Yield from iterable, charging the time spent producing each item to stage."""
+    iterator = iter(iterable)
+    while True:
+        with _stage(stage):
+            item = next(iterator, _EXHAUSTED)
+        if item is _EXHAUSTED:
+            return
+        yield item
+
+_EXHAUSTED = object()
+
+class _Histogram:
+    """Minimal thread-safe Prometheus histogram with (dialect, conn) labels."""
+
+    def __init__(self, name: str, help_text: str, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}  # labels -> [per-bucket counts..., +Inf count, sum]
+
+    def observe(self, labels: tuple, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(labels, list(values)) for labels, values in self._series.items()]
+        for (dialect, conn), values in series:
+            label = f'dialect="{dialect}",conn="{conn}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values[:-1]):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{label}}} {values[-1]}")
+            lines.append(f"{self.name}_count{{{label}}} {cumulative}")
+        return lines
+
+_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+_ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+_BYTE_BUCKETS = (1024, 16384, 131072, 1048576, 8388608, 67108864, 268435456)
+
+# Per-request stage -> histogram of seconds spent in it
+_STAGE_HISTOGRAMS = {
+    stage: _Histogram(f"dave_router_{stage}_seconds", help_text, _LATENCY_BUCKETS)
+    for stage, help_text in (
+        ("queue_wait", "Time a query waited for a dispatcher worker"),
+        ("engine", "Time to look up or create the engine for a connection target"),
+        ("checkout", "Time to check a connection out of the engine pool"),
+        ("execute", "Time in Connection.execute"),
+        ("fetch", "Time reading rows from the cursor"),
+        ("convert", "Time converting values (convert_json_safe / columnar encoding)"),
+        ("pack", "Time packing responses as MessagePack"),
+        ("send", "Time compressing and writing frames to the backend"),
+    )
+}
+_ROWS_HISTOGRAM = _Histogram("dave_router_response_rows", "Rows per sql-query response", _ROW_BUCKETS)
+_BYTES_HISTOGRAM = _Histogram("dave_router_response_bytes", "Packed bytes sent per sql-query response", _BYTE_BUCKETS)
+
+def _conn_label(conn_key: str) -> str:
+    """Short stable hash of a connection key; keys hold hosts and user names."""
+    return hashlib.sha256(conn_key.encode("utf-8")).hexdigest()[:12] if conn_key else ""
+
+def _record_query_metrics(timer: _StageTimer):
+    for stage, seconds in timer.stages.items():
+        histogram = _STAGE_HISTOGRAMS.get(stage)
+        if histogram is not None:
+            histogram.observe(timer.labels, seconds)
+    _ROWS_HISTOGRAM.observe(timer.labels, timer.rows)
+    _BYTES_HISTOGRAM.observe(timer.labels, timer.bytes_sent)
+
+def render_metrics() -> str:
+    """All router metrics in the Prometheus text exposition format."""
+    lines = []
+    for histogram in list(_STAGE_HISTOGRAMS.values()) + [_ROWS_HISTOGRAM, _BYTES_HISTOGRAM]:
+        lines.extend(histogram.render())
+    gauges = [
+        ("dave_router_engine_cache_engines", "gauge", "Engines held by the engine cache", "engines"),
+        ("dave_router_engine_cache_hits_total", "counter", "Engine cache hits", "hits"),
+        ("dave_router_engine_cache_misses_total", "counter", "Engine cache misses", "misses"),
+        ("dave_router_engine_cache_evictions_total", "counter", "Engines evicted from the cache", "evictions"),
+    ]
+    engine_stats = _engine_cache.stats()
+    for name, kind, help_text, field in gauges:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name} {engine_stats[field]}"]
+    lines += ["# HELP dave_router_pool_checked_out Connections checked out of each engine pool",
+              "# TYPE dave_router_pool_checked_out gauge"]
+    for conn_key, dialect, checked_out in _engine_cache.pool_stats():
+        lines.append(f'dave_router_pool_checked_out{{dialect="{dialect}",conn="{_conn_label(conn_key)}"}} {checked_out}')
+    lines += ["# HELP dave_router_target_warm Whether a known target has warm pooled connections",
+              "# TYPE dave_router_target_warm gauge"]
+    for target in _pool_warmer.status():
+        lines.append(f'dave_router_target_warm{{dialect="{target["dialect"]}",conn="{target["conn"]}"}} '
+                     f'{1 if target["state"] == "warm" else 0}')
+    lines += ["# HELP dave_router_ui_events_dropped_total UI events dropped because the event bus was full",
+              "# TYPE dave_router_ui_events_dropped_total counter",
+              f"dave_router_ui_events_dropped_total {message_queue.dropped}"]
+    dispatcher_stats = _query_dispatcher.stats()
+    for field in ("running", "pending"):
+        name = f"dave_router_queries_{field}"
+        lines += [f"# HELP {name} Queries {field} in the dispatcher", f"# TYPE {name} gauge",
+                  f"{name} {dispatcher_stats[field]}"]
+    return "\n".join(lines) + "\n"
+
+def _metrics_route():
+    from fastapi.responses import PlainTextResponse
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+def _new_query_response(request_id) -> dict:
+    """Return an empty, unsuccessful sql-query-result for request_id."""
+    return {
+        "type": "sql-query-result",
+        "request_id": request_id,
+        "success": False,
+        "message": "",
+        "keys": [],
+        "rows": [],
+        "rowcount": -1,
+        "truncated": False
+    }
+
+def _zstd_compress(data: bytes) -> bytes:
+    import zstandard
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+
+def _lz4_compress(data: bytes) -> bytes:
+    import lz4.frame
+    return lz4.frame.compress(data)
+
+# Supported payload codecs, in order of preference
+_COMPRESSORS = {
+    "zstd": ("zstandard", _zstd_compress),
+    "lz4": ("lz4.frame", _lz4_compress),
+}
+
+def _available_codecs() -> list:
+    """Codecs whose optional packages are installed."""
+    codecs = []
+    for codec, (module_name, _) in _COMPRESSORS.items():
+        try:
+            __import__(module_name)
+            codecs.append(codec)
+        except ImportError:
+            pass
+    return codecs
+
+def _compress_packed(packed: bytes, message_type, request_id, codec=None) -> bytes:
+    """Wrap a packed message in a compressed envelope when it is worth it.
+
+    The envelope keeps type and request_id readable without decompressing and
+    reports the codec and ratio so thresholds can be tuned from the backend.
+    """
+    if not codec or len(packed) < COMPRESSION_MIN_BYTES:
+        return packed
+    compressed = _COMPRESSORS[codec][1](packed)
+    if len(compressed) >= len(packed):
+        return packed
+    return msgpack.packb({
+        "type": message_type,
+        "request_id": request_id,
+        "compression": {
+            "codec": codec,
+            "raw_bytes": len(packed),
+            "compressed_bytes": len(compressed),
+            "ratio": round(len(packed) / len(compressed), 2),
+        },
+        "payload": compressed,
+    }, use_bin_type=True)
+
+def send_message(message: dict, session=None):
+    """Pack a message as MessagePack and send it to the backend."""
+    with _stage("pack"):
+        packed = _packb(message, session.typed_values if session is not None else None)
+    _send_packed(packed, message.get("type"), message.get("request_id"), session)
+
+def _packb(message, typed=None) -> bytes:
+    """MessagePack-encode message; with typed values, temporal/Decimal values become ext types."""
+    if typed is None:
+        typed = _typed_values_active()
+    if typed:
+        return msgpack.packb(message, use_bin_type=True, datetime=True, default=_ext_default)
+    return msgpack.packb(message, use_bin_type=True)
+
+# Typed value encoding, advertised as capabilities["typed_values"] at login.
+# Aware datetimes use the standard MessagePack Timestamp (ext -1, the UTC
+# instant); bytes are raw bin. Application ext types, all big-endian:
+#   1  naive datetime  int64 microseconds since 1970-01-01T00:00:00 (wall clock)
+#   2  date            int32 days since 1970-01-01
+#   3  naive time      int64 microseconds since midnight
+#   4  Decimal         int8 exponent, then the unscaled value as a signed
+#                      two's-complement integer: value = unscaled * 10**exponent
+# Decimals that do not fit (NaN, infinities, |exponent| > 127) and aware
+# times are sent as strings.
+_TYPED_VALUES_VERSION = 1
+_EXT_NAIVE_DATETIME = 1
+_EXT_DATE = 2
+_EXT_TIME = 3
+_EXT_DECIMAL = 4
+_INT64 = struct.Struct(">q")
+_INT32 = struct.Struct(">i")
+
+def _ext_default(value):
+    """msgpack default hook for values the packer has no native form for."""
+    if isinstance(value, decimal.Decimal):
+        sign, digits, exponent = value.as_tuple()
+        if not isinstance(exponent, int) or not -128 <= exponent <= 127:
+            return str(value)
+        unscaled = int("".join(map(str, digits)) or "0")
+        if sign:
+            unscaled = -unscaled
+        return msgpack.ExtType(_EXT_DECIMAL, exponent.to_bytes(1, "big", signed=True)
+                               + unscaled.to_bytes(unscaled.bit_length() // 8 + 1, "big", signed=True))
+    if isinstance(value, datetime.datetime):
+        # Aware datetimes never get here: datetime=True packs them as Timestamps
+        return msgpack.ExtType(_EXT_NAIVE_DATETIME, _INT64.pack((value - _EPOCH) // _ONE_MICROSECOND))
+    if isinstance(value, datetime.date):
+        return msgpack.ExtType(_EXT_DATE, _INT32.pack((value - _EPOCH_DATE).days))
+    if isinstance(value, datetime.time):
+        if value.tzinfo is not None:
+            return value.isoformat()
+        micros = ((value.hour * 60 + value.minute) * 60 + value.second) * 1000000 + value.microsecond
+        return msgpack.ExtType(_EXT_TIME, _INT64.pack(micros))
+    if isinstance(value, (bytearray, memoryview)):
+        return bytes(value)
+    raise TypeError(f"can not serialize {type(value).__name__!r} object")
+
+def _typed_values_active() -> bool:
+    """Whether the session serving this thread negotiated typed values."""
+    session = _current_session()
+    return session.typed_values if session is not None else typed_values_enabled
+
+def _scalar_value(value):
+    return value if _typed_values_active() else convert_json_safe(value)
+
+def _send_packed(packed: bytes, message_type=None, request_id=None, session=None):
+    """Send an already packed MessagePack message to the backend.
+
+    Goes to session, else to the session whose request the current thread is
+    serving, else to the module-level primary connection. Large payloads are
+    compressed with the codec negotiated at login. Uses a binary frame when
+    the backend accepted binary_frames and falls back to base64 text for
+    older servers. Safe to call from any worker thread: websocket-client
+    connections do not support concurrent writers, so every send holds the
+    connection's send lock.
+    """
+    timer = getattr(_request_timer, "timer", None)
+    if timer is not None:
+        timer.bytes_sent += len(packed)
+    with _stage("send"):
+        session = session or _current_session()
+        if session is not None:
+            session.send_packed(packed, message_type, request_id)
+            return
+        frame, opcode = _encode_frame(packed, message_type, request_id, binary_frames_enabled, compression_codec)
+        with _send_lock:
+            if ws_connection:
+                ws_connection.send(frame, opcode=opcode)
+
+def _encode_frame(packed: bytes, message_type, request_id, binary_frames: bool, codec):
+    """Return (frame, opcode) for a packed message under the negotiated capabilities."""
+    packed = _compress_packed(packed, message_type, request_id, codec)
+    if binary_frames:
+        return packed, websocket.ABNF.OPCODE_BINARY
+    return base64.b64encode(packed).decode('utf-8'), websocket.ABNF.OPCODE_TEXT
+
+def _router_capabilities() -> dict:
+    """Capabilities advertised to the backend in the login message."""
+    return {"binary_frames": True, "compression": _available_codecs(), "acks": True, "typed_values": _TYPED_VALUES_VERSION,
+            "router_targets": True}
+
+def _decode_incoming(msg):
+    """Decode a backend message: raw MessagePack (binary), base64 MessagePack or JSON (text)."""
+    if isinstance(msg, (bytes, bytearray)):
+        return msgpack.unpackb(msg, raw=False)
+    if msg.lstrip().startswith("{"):
+        return json.loads(msg)
+    try:
+        return msgpack.unpackb(base64.b64decode(msg), raw=False)
+    except Exception:
+        return json.loads(msg)
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_EPOCH_UTC = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+_EPOCH_DATE = datetime.date(1970, 1, 1)
+_ONE_MICROSECOND = datetime.timedelta(microseconds=1)
+
+def _typed_array(typecode: str, values: list) -> bytes:
+    """Pack values as a little-endian typed array. Raises TypeError/OverflowError on mismatch."""
+    packed = array(typecode, values)
+    if sys.byteorder != "little":
+        packed.byteswap()
+    return packed.tobytes()
+
+def _validity_bitmap(values: list) -> bytes:
+    """Arrow-style validity bitmap (LSB first, bit set = not null)."""
+    if not values:
+        return b""
+    # Row i is bit i of one big integer: build its binary digits most significant first
+    bits = "".join(["0" if v is None else "1" for v in reversed(values)])
+    return int(bits, 2).to_bytes((len(values) + 7) // 8, "little")
+
+_numpy = None
+
+def _load_numpy():
+    """Import numpy on first use. Returns None when it is not installed."""
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy or None
+
+# Value types array("q") / array("d") accept, plus None
+_INT_COLUMN_TYPES = frozenset({int, bool, type(None)})
+_FLOAT_COLUMN_TYPES = frozenset({float, int, bool, type(None)})
+
+def _nullable_numeric(values: list, typecode: str):
+    """(little-endian data, validity bitmap) for an int64/float64 column with nulls.
+
+    With numpy the null mask, zero fill and packing are done in bulk;
+    otherwise falls back to per-value Python.
+    """
+    np = _load_numpy()
+    if np is None:
+        fill = 0 if typecode == "q" else 0.0
+        return _typed_array(typecode, [fill if v is None else v for v in values]), _validity_bitmap(values)
+    allowed = _INT_COLUMN_TYPES if typecode == "q" else _FLOAT_COLUMN_TYPES
+    if not set(map(type, values)) <= allowed:
+        # Same outcome as array() rejecting the value: the caller falls back to "object"
+        raise TypeError("mixed column types")
+    objects = np.array(values, dtype=object)
+    present = np.not_equal(objects, None)
+    objects[~present] = 0
+    data = objects.astype("<i8" if typecode == "q" else "<f8")
+    return data.tobytes(), np.packbits(present, bitorder="little").tobytes()
+
+def _encode_column(name: str, values: list) -> dict:
+    """Encode one result column as a type-tagged vector.
+
+    Numeric and temporal columns become packed little-endian arrays
+    (int64, float64, timestamp_us, date32) with a validity bitmap when nulls
+    are present. Strings, bytes, booleans and decimals stay as MessagePack
+    lists. Any column whose values do not fit a single type falls back to
+    "object", converted cell by cell with convert_json_safe.
+    """
+    column = {"name": name}
+    has_nulls = None in values
+    first = next((v for v in values if v is not None), None)
+    dense = [v for v in values if v is not None] if has_nulls else values
+    try:
+        if first is None:
+            column["type"] = "null"
+            column["data"] = len(values)
+            return column
+        elif type(first) is bool:
+            if not all(type(v) is bool for v in dense):
+                raise TypeError("mixed column types")
+            column["type"], column["data"] = "bool", values
+        elif isinstance(first, (int, float)):
+            typecode = "q" if isinstance(first, int) else "d"
+            column["type"] = "int64" if typecode == "q" else "float64"
+            if has_nulls:
+                column["data"], column["validity"] = _nullable_numeric(values, typecode)
+                return column
+            column["data"] = _typed_array(typecode, values)
+        elif isinstance(first, datetime.datetime):
+            aware = first.tzinfo is not None
+            epoch = _EPOCH_UTC if aware else _EPOCH
+            column["type"] = "timestamp_us"
+            column["tz"] = "UTC" if aware else None
+            column["data"] = _typed_array("q", [0 if v is None else (v - epoch) // _ONE_MICROSECOND for v in values])
+        elif isinstance(first, datetime.date):
+            column["type"] = "date32"
+            column["data"] = _typed_array("i", [0 if v is None else (v - _EPOCH_DATE).days for v in values])
+        elif isinstance(first, decimal.Decimal):
+            column["type"] = "decimal"
+            column["data"] = values if _typed_values_active() else [None if v is None else str(v) for v in values]
+        elif isinstance(first, str) and all(type(v) is str for v in dense):
+            column["type"], column["data"] = "string", values
+        elif isinstance(first, (bytes, bytearray)) and all(isinstance(v, (bytes, bytearray)) for v in dense):
+            column["type"], column["data"] = "binary", values
+        else:
+            raise TypeError("unsupported column type")
+    except (TypeError, OverflowError, ValueError):
+        converted = None if _typed_values_active() else _convert_column(values)
+        return {"name": name, "type": "object", "data": values if converted is None else converted}
+    if has_nulls:
+        column["validity"] = _validity_bitmap(values)
+    return column
+
+def _columnar_payload(keys: list, batch) -> dict:
+    """Column-major payload for a batch of rows."""
+    columns = list(zip(*batch)) if batch else [() for _ in keys]
+    return {"columns": [_encode_column(name, list(values)) for name, values in zip(keys, columns)]}
+
+def _estimate_row_bytes(row) -> int:
+    """Rough packed size of a row, cheap enough to run on every fetched row."""
+    size = 0
+    for value in row:
+        if isinstance(value, (str, bytes, bytearray)):
+            size += len(value) + 2
+        elif value is None:
+            size += 1
+        else:
+            size += 9
+    return size
+
+class _ResultLimits:
+    """Row/byte budget for one result, enforced while fetching.
+
+    Callers fetch in batches sized by fetch_size(), pass each batch through
+    admit() and stop once exhausted; finish() closes the cursor early and
+    records whether rows were left behind (truncated).
+    """
+
+    def __init__(self, max_rows: int = 0, max_bytes: int = 0):
+        # Negative limits mean unlimited, like 0
+        self.max_rows = max(0, max_rows or 0)
+        self.max_bytes = max(0, max_bytes or 0)
+        self.rows = 0
+        self.bytes = 0
+        self.exhausted = False
+        self.truncated = False
+
+    @property
+    def active(self) -> bool:
+        return bool(self.max_rows or self.max_bytes)
+
+    def fetch_size(self, batch_rows: int) -> int:
+        if self.max_rows:
+            return max(1, min(batch_rows, self.max_rows - self.rows))
+        return batch_rows
+
+    def admit(self, rows):
+        """Return the prefix of rows that fits in the remaining budget."""
+        if self.max_rows and self.rows + len(rows) >= self.max_rows:
+            if self.rows + len(rows) > self.max_rows:
+                self.truncated = True
+            rows = rows[:self.max_rows - self.rows]
+            self.exhausted = True
+        if self.max_bytes:
+            for i, row in enumerate(rows):
+                self.bytes += _estimate_row_bytes(row)
+                if self.bytes > self.max_bytes:
+                    self.bytes -= _estimate_row_bytes(row)
+                    rows = rows[:i]
+                    self.exhausted = self.truncated = True
+                    break
+        self.rows += len(rows)
+        return rows
+
+    def finish(self, has_more, close):
+        """Close the cursor; if the budget ran out exactly, peek once to see whether rows remain."""
+        try:
+            if self.exhausted and not self.truncated:
+                self.truncated = bool(has_more())
+        finally:
+            close()
+
+def _fetch_columns(cursor, column_count: int, batch_rows: int, limits: _ResultLimits = None) -> list:
+    """Read a DB-API cursor in batches straight into per-column lists."""
+    limits = limits or _ResultLimits()
+    columns = [[] for _ in range(column_count)]
+    while not limits.exhausted:
+        batch = cursor.fetchmany(limits.fetch_size(batch_rows))
+        if not batch:
+            break
+        if limits.active:
+            batch = limits.admit(batch)
+        for column, values in zip(columns, zip(*batch)):
+            column.extend(values)
+    return columns
+
+_pyarrow = None
+
+def _load_pyarrow():
+    """Import pyarrow on first use. Returns None when it is not installed."""
+    global _pyarrow
+    if _pyarrow is None:
+        try:
+            import pyarrow
+            import pyarrow.ipc
+            _pyarrow = pyarrow
+        except ImportError:
+            _pyarrow = False
+    return _pyarrow or None
+
+def _arrow_batches(dialect: str, cursor):
+    """Return an iterator of pyarrow RecordBatches read natively from the DB-API cursor.
+
+    Snowflake cursors expose fetch_arrow_batches(); BigQuery DB-API cursors keep
+    the QueryJob, whose result can be read as Arrow. Returns None when the cursor
+    offers neither, so the caller can use the generic row path.
+    """
+    if dialect == "snowflake" and hasattr(cursor, "fetch_arrow_batches"):
+        tables = cursor.fetch_arrow_batches()
+        return (batch for table in tables for batch in table.to_batches())
+    if dialect == "bigquery":
+        query_job = getattr(cursor, "_query_job", None)
+        if query_job is not None:
+            return iter(query_job.result().to_arrow_iterable())
+    return None
+
+def _arrow_ipc_bytes(pa, batches) -> bytes:
+    """Serialize record batches as one Arrow IPC stream."""
+    sink = pa.BufferOutputStream()
+    writer = None
+    for batch in batches:
+        if writer is None:
+            writer = pa.ipc.new_stream(sink, batch.schema)
+        writer.write_batch(batch)
+    if writer is not None:
+        writer.close()
+    return sink.getvalue().to_pybytes()
+
+def _limit_arrow_batches(batches, limits: _ResultLimits):
+    """Trim a record batch iterator to the row/byte budget."""
+    for batch in batches:
+        if limits.max_rows and limits.rows + batch.num_rows >= limits.max_rows:
+            if limits.rows + batch.num_rows > limits.max_rows:
+                limits.truncated = True
+            batch = batch.slice(0, limits.max_rows - limits.rows)
+            limits.exhausted = True
+        if limits.max_bytes and limits.bytes + batch.nbytes > limits.max_bytes:
+            # Keep the share of rows that fits, assuming evenly sized rows
+            fit = batch.num_rows * (limits.max_bytes - limits.bytes) // max(1, batch.nbytes)
+            limits.exhausted = limits.truncated = True
+            if fit <= 0:
+                return
+            batch = batch.slice(0, fit)
+        limits.rows += batch.num_rows
+        limits.bytes += batch.nbytes
+        yield batch
+        if limits.exhausted:
+            return
+
+def _send_arrow_result(dialect: str, result, request_id, response: dict, stream: bool, logger,
+                       limits: _ResultLimits = None) -> bool:
+    """Fill response with Arrow IPC bytes taken straight from the native cursor.
+
+    Rows are never materialized as Python objects. In stream mode each record
+    batch goes out as its own sql-query-result-chunk holding a self-contained
+    IPC stream. Returns False when the fast path is unavailable and nothing has
+    been read from the cursor yet.
+    """
+    pa = _load_pyarrow()
+    if pa is None:
+        logger.info("pyarrow is not installed, using the generic row path")
+        return False
+    try:
+        batches = _arrow_batches(dialect, result.cursor)
+    except Exception as e:
+        logger.info(f"Arrow fast path unavailable, using the generic row path: {e}")
+        return False
+    if batches is None:
+        return False
+    batches = _timed_iter(batches, "fetch")
+    limits = limits or _ResultLimits()
+    if limits.active:
+        batches = iter(batches)
+        source, batches = batches, _limit_arrow_batches(batches, limits)
+
+    keys = list(result.keys())
+    response["keys"] = keys
+    response["result_format"] = "arrow"
+    rowcount = 0
+    if stream:
+        seq = 0
+        for batch in batches:
+            send_message({
+                "type": "sql-query-result-chunk",
+                "request_id": request_id,
+                "seq": seq,
+                "keys": keys if seq == 0 else None,
+                "arrow_ipc": _arrow_ipc_bytes(pa, [batch]),
+            })
+            seq += 1
+            rowcount += batch.num_rows
+        response["streamed"] = True
+        response["chunks"] = seq
+    else:
+        def counted(source):
+            nonlocal rowcount
+            for batch in source:
+                rowcount += batch.num_rows
+                yield batch
+        response["arrow_ipc"] = _arrow_ipc_bytes(pa, counted(batches))
+    response["rowcount"] = rowcount
+    if limits.active:
+        limits.finish(lambda: next(source, None) is not None, result.close)
+        response["truncated"] = limits.truncated
+    else:
+        result.close()
+    return True
+
+def _stream_result_chunks(result, request_id, chunk_rows: int, response: dict, result_format: str = "rows",
+                          limits: _ResultLimits = None):
+    """Send a result as numbered sql-query-result-chunk frames, chunk_rows at a time.
+
+    Only one chunk is held in memory at once. The caller's response becomes the
+    summary frame sent after the last chunk, carrying the total row and chunk counts.
+    """
+    keys = list(result.keys())
+    response["keys"] = keys
+    response["streamed"] = True
+    if result_format == "columnar":
+        response["result_format"] = "columnar"
+    limits = limits or _ResultLimits()
+    seq = 0
+    total_rows = 0
+    try:
+        for partition in _timed_iter(result.partitions(chunk_rows), "fetch"):
+            if limits.active:
+                partition = limits.admit(partition)
+                if not partition:
+                    break
+            chunk = {
+                "type": "sql-query-result-chunk",
+                "request_id": request_id,
+                "seq": seq,
+                "keys": keys if seq == 0 else None,
+            }
+            with _stage("convert"):
+                if result_format == "columnar":
+                    chunk.update(_columnar_payload(keys, partition))
+                else:
+                    chunk["rows"] = _convert_rows(partition)
+            send_message(chunk)
+            seq += 1
+            total_rows += len(partition)
+            if limits.exhausted:
+                break
+    finally:
+        response["chunks"] = seq
+        response["rowcount"] = total_rows
+        if limits.active:
+            limits.finish(lambda: result.fetchone() is not None, result.close)
+            response["truncated"] = limits.truncated
+        else:
+            result.close()
+
+def _read_query_result(result, response: dict, request_id, dialect: str, stream: bool,
+                       chunk_rows: int, result_format: str, logger, limits: _ResultLimits = None):
+    """Fill response from an executed statement in the requested result format.
+
+    With an active row/byte budget the cursor is read with fetchmany and closed
+    as soon as the budget is spent; response["truncated"] tells the backend
+    whether rows were left unread.
+    """
+    limits = limits or _ResultLimits()
+    if not result.returns_rows:
+        response["rowcount"] = result.rowcount
+    elif (result_format == "arrow" and dialect in ("snowflake", "bigquery")
+            and _send_arrow_result(dialect, result, request_id, response, stream, logger, limits)):
+        pass  # response already carries the Arrow IPC payload
+    elif stream:
+        _stream_result_chunks(result, request_id, chunk_rows, response, result_format, limits)
+    elif result_format == "columnar":
+        # Read the DB-API cursor directly: no Row objects, no per-row lists
+        keys = list(result.keys())
+        cursor = result.cursor
+        with _stage("fetch"):
+            columns = _fetch_columns(cursor, len(keys), chunk_rows, limits)
+        if limits.active:
+            limits.finish(lambda: cursor.fetchone() is not None, result.close)
+            response["truncated"] = limits.truncated
+        else:
+            result.close()
+        rowcount = len(columns[0]) if columns else 0
+        response["keys"] = keys
+        response["result_format"] = "columnar"
+        with _stage("convert"):
+            response["columns"] = [_encode_column(name, values) for name, values in zip(keys, columns)]
+        response["rowcount"] = rowcount
+        if rowcount == 1 and len(keys) == 1:
+            response["scalar_result"] = _scalar_value(columns[0][0])
+    elif limits.active:
+        rows = []
+        while not limits.exhausted:
+            with _stage("fetch"):
+                batch = result.fetchmany(limits.fetch_size(chunk_rows))
+            if not batch:
+                break
+            with _stage("convert"):
+                rows.extend(_convert_rows(limits.admit(batch)))
+        limits.finish(lambda: result.fetchone() is not None, result.close)
+        response["keys"] = list(result.keys())
+        response["rows"] = rows
+        response["rowcount"] = len(rows)
+        response["truncated"] = limits.truncated
+        if len(rows) == 1 and len(rows[0]) == 1:
+            response["scalar_result"] = rows[0][0]
+    else:
+        with _stage("fetch"):
+            rows = result.fetchall()
+        keys = result.keys()
+        response["keys"] = list(keys)
+        with _stage("convert"):
+            response["rows"] = _convert_rows(rows)
+        response["rowcount"] = result.rowcount if result.rowcount is not None else len(rows)
+        if len(rows) == 1 and len(rows[0]) == 1:
+            response["scalar_result"] = _scalar_value(rows[0][0])
+
+class _QueryHandle:
+    """A running or queued sql-query that can be cancelled from another thread."""
+    __slots__ = ("request_id", "builder", "engine", "connect_args", "dbapi_connection", "cancel_reason",
+                 "cancel_lock", "queued_at")
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.queued_at = time.perf_counter()
+        self.builder = None
+        self.engine = None
+        self.connect_args = None
+        self.dbapi_connection = None  # set once the query holds a pooled connection
+        self.cancel_reason = None  # "cancelled" or "timeout"
+        # Held from reading dbapi_connection until the cancel is issued; the query
+        # takes it before clearing dbapi_connection and returning the connection
+        self.cancel_lock = threading.Lock()
+
+# pool engine -> NullPool engine for side-channel cancels; entries go with the pool engine
+_cancel_engines = weakref.WeakKeyDictionary()
+_cancel_engines_lock = threading.Lock()
+
+def _cancel_engine(handle) -> "sqlalchemy.Engine":
+    """Non-pooled engine for handle's target, so a cancel never waits for a busy pool."""
+    with _cancel_engines_lock:
+        engine = _cancel_engines.get(handle.engine)
+        if engine is None:
+            engine = _cancel_engines[handle.engine] = sqlalchemy.create_engine(
+                handle.engine.url, connect_args=handle.connect_args or {}, poolclass=sqlalchemy.pool.NullPool)
         return engine
 
+# (session, request_id) -> _QueryHandle; request ids are only unique within one backend session
+_active_queries = {}
+_active_queries_lock = threading.Lock()
+
+def _register_query(request_id, session=None) -> _QueryHandle:
+    """Return session's handle for request_id, creating it when the query is first seen."""
+    with _active_queries_lock:
+        handle = _active_queries.get((session, request_id))
+        if handle is None:
+            handle = _active_queries[(session, request_id)] = _QueryHandle(request_id)
+        return handle
+
+def _unregister_query(request_id, session=None):
+    with _active_queries_lock:
+        _active_queries.pop((session, request_id), None)
+
+def cancel_query(request_id, logger, reason: str = "cancelled", session=None) -> bool:
+    """Cancel one of session's queued or running queries. Returns False if request_id is unknown.
+
+    Queued queries are skipped when a worker picks them up; running ones are
+    stopped through the dialect's cancel API (see DialectBuilder.cancel).
+    """
+    with _active_queries_lock:
+        handle = _active_queries.get((session, request_id))
+        if handle is None:
+            return False
+        if handle.cancel_reason is None:
+            handle.cancel_reason = reason
+    with handle.cancel_lock:
+        if handle.dbapi_connection is None:
+            logger.info(f"Query {reason} before execution: request_id={request_id}")
+            return True
+        try:
+            if not handle.builder.cancel(handle, logger):
+                logger.warning(f"Driver does not support cancel: request_id={request_id}")
+            else:
+                logger.info(f"Query {reason}: request_id={request_id}")
+        except Exception as e:
+            logger.error(f"Failed to cancel query: request_id={request_id}, error={str(e)}")
+    return True
+
+def _start_watchdog(request_id, timeout_ms: int, logger, session=None) -> threading.Timer:
+    """Router-side timeout: cancel the query if the driver-level timeout did not fire."""
+    watchdog = threading.Timer(timeout_ms / 1000.0, cancel_query, args=(request_id, logger, "timeout", session))
+    watchdog.daemon = True
+    watchdog.start()
+    return watchdog
+
+class _QueryCancelled(Exception):
+    pass
+
 def handle_sql_query(data, logger):
+    """Run one sql-query and send its response, recording per-stage metrics."""
+    timer = _request_timer.timer = _StageTimer()
+    try:
+        _run_sql_query(data, logger, timer)
+    finally:
+        _request_timer.timer = None
+        _record_query_metrics(timer)
+
+def _run_sql_query(data, logger, timer: _StageTimer):
     connectionObject = data["connectionObject"]
     query = data.get("query", "SELECT 1")
     queryParams = data.get("queryParams", None)
     request_id = data.get("request_id")
+    # Streaming mode: rows go out as sql-query-result-chunk frames read from a server-side cursor
+    stream = bool(data.get("stream"))
+    chunk_rows = STREAM_CHUNK_ROWS
+    # "rows" (default), "columnar" (column-major, type-tagged vectors) or
+    # "arrow" (Arrow IPC bytes; Snowflake/BigQuery only, rows otherwise)
+    result_format = data.get("result_format") or "rows"
+    # Opt-in result cache for read-only statements; "cache_ttl" overrides the router TTL (seconds)
+    use_cache = bool(data.get("cache")) and not stream and RESULT_CACHE_MAX_BYTES > 0
+    cache_key = None
+    # Enforced by the driver (statement timeout) and by a router-side watchdog
+    timeout_ms = 0
+    # Opt-in per-stage breakdown (queue_wait, engine, checkout, execute, fetch,
+    # convert, pack, send) returned as response["timings"]; queue_wait is the
+    # receive-to-dispatch time. pack_ms includes the final frame (timings are spliced
+    # in after packing); its own send time can only show up in /metrics.
+    want_timings = bool(data.get("timings"))
+    # Row/byte budget enforced while fetching (0 = unlimited)
+    limits = _ResultLimits()
+    # Set by _run_for_session; None when called directly
+    session = getattr(_session_context, "session", None)
+    handle = _register_query(request_id, session)
+    timer.add("queue_wait", time.perf_counter() - handle.queued_at)
+    watchdog = None
+    started_at = time.monotonic()
 
     sql_query_event = {
         "type": "sql_execution_info",
@@ -94,194 +1864,1114 @@ def handle_sql_query(data, logger):
     }
     message_queue.put(sql_query_event)
 
-    response = {
-        "type": "sql-query-result",
-        "request_id": request_id,
-        "success": False,
-        "message": "",
-        "keys": [],
-        "rows": [],
-        "rowcount": -1
-    }
+    response = _new_query_response(request_id)
+    cache_ttl = None
     try:
-        # Build SQLAlchemy URL and connect_args - replicate backend logic
+        if handle.cancel_reason:
+            raise _QueryCancelled()
+        # Numeric request fields are parsed here so malformed values get an error response
+        chunk_rows = max(1, _request_int(data, "chunk_rows", STREAM_CHUNK_ROWS))
+        timeout_ms = _request_int(data, "timeout_ms", DEFAULT_QUERY_TIMEOUT_MS)
+        limits = _ResultLimits(_request_int(data, "max_rows", DEFAULT_MAX_ROWS),
+                               _request_int(data, "max_bytes", DEFAULT_MAX_BYTES))
+        if use_cache:
+            cache_ttl = _parse_cache_ttl(data.get("cache_ttl"), logger)
         dialect = connectionObject.get("dialect", "mysql")
-        user = connectionObject.get("user")
-        password = connectionObject.get("password")
-        host = connectionObject.get("host")
-        port = connectionObject.get("port")
         database = connectionObject.get("database")
+        # Compiled once per distinct connectionObject, then served from the registry
+        target = _target_registry.resolve(connectionObject, logger)
+        conn_key = target.key
+        timer.labels = (target.dialect, _conn_label(conn_key))
+        if use_cache:
+            cache_key = _result_cache.make_key(
+                conn_key, query, queryParams, (result_format, limits.max_rows, limits.max_bytes, _typed_values_active()))
+            cached_body = _result_cache.get(cache_key) if cache_key else None
+            if cached_body is not None:
+                message_queue.put({"type": "sql_success", "message": f"SQL Success: served from result cache (ID: {request_id})."})
+                logger.info(f"Result cache hit: request_id={request_id}")
+                extra = {"request_id": request_id, "cached": True}
+                if want_timings:
+                    extra["timings"] = timer.as_millis(time.perf_counter() - handle.queued_at)
+                _send_packed(_splice_map(cached_body, extra), "sql-query-result", request_id)
+                return
+        with _stage("engine"):
+            # Reuse cached engine for the same logical target to prevent repeated auth
+            engine = _get_or_create_engine(target.url, target.connect_args, conn_key, logger, target.dialect)
+        with _stage("checkout"):
+            connection = engine.connect()
 
-        url = ""
-        connect_args = {}
-
-        # --- DIALECT-SPECIFIC LOGIC (replicating backend adapters) ---
-        if dialect == "postgresql":
-            # Handle multi-schema for PostgreSQL
-            schemas = connectionObject.get("schemas")
-            if schemas and isinstance(schemas, list):
-                # Safely quote schema names and join them
-                quoted_schemas = [f'"{s.strip()}"' for s in schemas]
-                connect_args["options"] = f"-c search_path={','.join(quoted_schemas)}"
-                logger.info(f"PostgreSQL multi-schema mode. Setting search_path to: {','.join(quoted_schemas)}")
-            elif connectionObject.get("schema"):
-                # Handle legacy single schema
-                connect_args["options"] = f"-c search_path={connectionObject['schema']}"
-                logger.info(f"PostgreSQL single-schema mode. Setting search_path to: {connectionObject['schema']}")
-
-            # Use the correct driver for postgresql
-            url = f"postgresql+psycopg2://{user}:{password}@{host}:{port}/{database}"
-
-        elif dialect == "snowflake":
-            # Router-side: optionally use external browser auth when requested
-            use_external = bool(connectionObject.get("snowflake_externalbrowser"))
-            params = {}
-            if connectionObject.get("schema"):
-                params['schema'] = connectionObject.get("schema")
-            if connectionObject.get("warehouse"):
-                params['warehouse'] = connectionObject.get("warehouse")
-            if connectionObject.get("role"):
-                params['role'] = connectionObject.get("role")
-
-            if use_external:
-                params["authenticator"] = "externalbrowser"
-                # Enable connector-side token caching to avoid repeated SSO prompts
-                connect_args["client_store_temporary_credential"] = True
-                url = f"snowflake://{user}@{host}/{database}"
-                logger.info(f"Snowflake connection using external browser auth with token caching enabled")
-            else:
-                # Fallback to password/PAT if provided
-                if not password:
-                    raise ValueError("Snowflake password/PAT is required when not using external browser auth")
-                url = f"snowflake://{user}:{password}@{host}/{database}"
-                logger.info(f"Snowflake connection using password/PAT")
-
-            if params:
-                url += f"?{urllib.parse.urlencode(params)}"
-
-        elif dialect == "bigquery":
-            # BigQuery uses the project_id as the "host" and may have a default dataset
-            project_id = connectionObject.get("database")  # Mapped to project_id on the backend
-            dataset = connectionObject.get("schema")  # Mapped to a single dataset
-            if dataset:
-                url = f"bigquery://{project_id}/{dataset}"
-            else:
-                url = f"bigquery://{project_id}"
-            logger.info(f"BigQuery connection url: {url}")
-
-        elif dialect == "mysql":
-            url = f"mysql+pymysql://{user}:{password}@{host}:{port}/{database}"
-
-        else:
-            # Fallback for other dialects
-            url = f"{dialect}://{user}:{password}@{host}:{port}/{database}"
-
-        # --- END DIALECT-SPECIFIC LOGIC ---
-
-        # Enable session keep-alive for Snowflake to minimize re-auth prompts
-        if dialect == "snowflake":
-            # Supported by snowflake-connector; keeps the session active in the background
-            connect_args = dict(connect_args)  # copy before mutating
-            connect_args.setdefault("client_session_keep_alive", True)
-
-        logger.info(f"Connecting to DB with dialect '{dialect}': {url}")
-        # Reuse cached engine for the same logical target to prevent repeated auth
-        conn_key = _connection_key_from_object(connectionObject)
-        engine = _get_or_create_engine(url, connect_args, conn_key, logger)
-        
-        with engine.connect() as conn:
-            stmt = sqlalchemy.text(query)
-            logger.info(f"Executing SQL: {query} with params: {queryParams}")
-            result = conn.execute(stmt, queryParams or {})
-            if result.returns_rows:
-                rows = result.fetchall()
-                keys = result.keys()
-                response["keys"] = list(keys)
-                response["rows"] = [[convert_json_safe(cell) for cell in row] for row in rows]
-                response["rowcount"] = result.rowcount if result.rowcount is not None else len(rows)
-                if len(rows) == 1 and len(rows[0]) == 1:
-                    response["scalar_result"] = convert_json_safe(rows[0][0])
-            else:
-                response["rowcount"] = result.rowcount
+        with connection as conn:
+            if stream:
+                conn.execution_options(stream_results=True, yield_per=chunk_rows)
+            if timeout_ms > 0:
+                try:
+                    target.builder.apply_timeout(conn, timeout_ms)
+                except Exception as e:
+                    logger.warning(f"Driver-level timeout not applied, relying on watchdog: {str(e)}")
+                watchdog = _start_watchdog(request_id, timeout_ms, logger, session)
+            try:
+                with _active_queries_lock:
+                    handle.builder = target.builder
+                    handle.engine = engine
+                    handle.connect_args = target.connect_args
+                    handle.dbapi_connection = conn.connection.dbapi_connection
+                    if handle.cancel_reason:
+                        raise _QueryCancelled()
+                stmt = sqlalchemy.text(query)
+                logger.info(f"Executing SQL: {query} with params: {queryParams}")
+                with _stage("execute"):
+                    result = conn.execute(stmt, queryParams or {})
+                _read_query_result(result, response, request_id, dialect, stream, chunk_rows, result_format, logger, limits)
+            finally:
+                # The connection goes back to the pool next; wait out an in-flight cancel so
+                # it cannot reach the connection's next user
+                with handle.cancel_lock:
+                    handle.dbapi_connection = None
+                if timeout_ms > 0:
+                    try:
+                        target.builder.reset_timeout(conn)
+                    except Exception as e:
+                        logger.warning(f"Failed to reset statement timeout: {str(e)}")
             if query.strip().lower() in ("show tables", "select table_name from information_schema.tables where table_schema = database()"):
                 inspector = sqlalchemy.inspect(engine)
                 response["tables"] = inspector.get_table_names(schema=database)
             response["success"] = True
             response["message"] = "Query executed successfully"
+            timer.rows = response["rowcount"] if response["rowcount"] >= 0 else len(response["rows"])
             message_queue.put({"type": "sql_success", "message": f"SQL Success: {response['rowcount']} row(s) returned."})
             logger.info(f"Query success: request_id={request_id}, rowcount={response['rowcount']}")
+        # Long queries count as use; keep the idle clock running from when they finished
+        _engine_cache.touch(conn_key)
     except Exception as e:
         response["success"] = False
-        response["message"] = str(e)
-        message_queue.put({"type": "sql_error", "message": f"SQL Error: {str(e)}"})
-        logger.error(f"Query error: request_id={request_id}, error={str(e)}")
+        timed_out = handle.cancel_reason == "timeout" or (
+            timeout_ms > 0 and time.monotonic() - started_at >= timeout_ms / 1000.0)
+        if timed_out:
+            response["timed_out"] = True
+            response["message"] = f"Query timed out after {timeout_ms} ms"
+        elif handle.cancel_reason:
+            response["cancelled"] = True
+            response["message"] = "Query cancelled"
+        else:
+            response["message"] = str(e)
+        message_queue.put({"type": "sql_error", "message": f"SQL Error: {response['message']}"})
+        logger.error(f"Query error: request_id={request_id}, error={response['message']}")
+    finally:
+        if watchdog is not None:
+            watchdog.cancel()
+        _unregister_query(request_id, session)
     logger.info(f"Sending response: request_id={request_id}, success={response['success']}, rowcount={response['rowcount']}")
-    # Send as base64-encoded MessagePack string
-    packed = msgpack.packb(response, use_bin_type=True)
-    b64 = base64.b64encode(packed).decode('utf-8')
-    if ws_connection:
-        ws_connection.send(b64)
-
-def ws_thread(url, username=None, password=None, id_token=None):
-    global ws_connection, connected_username
-    logging.basicConfig(level=logging.DEBUG)
-    logger = logging.getLogger("dave_router.ws_thread")
+    if cache_key is not None and response["success"]:
+        # Pack once without the request_id: the same bytes are cached and sent
+        with _stage("pack"):
+            body = _packb({k: v for k, v in response.items() if k != "request_id"})
+        _result_cache.put(cache_key, body, cache_ttl)
+        extra = {"request_id": request_id}
+        if want_timings:
+            extra["timings"] = timer.as_millis(time.perf_counter() - handle.queued_at)
+        _send_packed(_splice_map(body, extra), response["type"], request_id)
+    elif want_timings:
+        # Pack first so pack_ms covers this frame, then splice the timings in
+        with _stage("pack"):
+            body = _packb(response)
+        timings = timer.as_millis(time.perf_counter() - handle.queued_at)
+        _send_packed(_splice_map(body, {"timings": timings}), response["type"], request_id)
+    else:
+        send_message(response)
+
+_SQL_TOKENS = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")|\s+""")
+_SQL_LEADING_COMMENTS = re.compile(r"^(?:\s+|--[^\n]*(?:\n|$)|/\*.*?\*/|\()*", re.S)
+_READ_ONLY_VERBS = {"select", "show", "describe", "desc", "explain", "with", "values"}
+_WRITE_KEYWORDS = re.compile(
+    r"\b(insert|update|delete|merge|upsert|create|drop|alter|truncate|grant|revoke|into|call|copy|lock|for\s+update)\b",
+    re.I,
+)
+# Calls that change state or hand out a fresh value even inside a SELECT
+_SIDE_EFFECT_CALLS = re.compile(
+    r"\b(nextval|setval|\w*_(?:un)?lock\w*|lo_\w+|pg_terminate_backend|pg_cancel_backend|system\$\w+)\s*\(",
+    re.I,
+)
+
+def _request_int(data: dict, name: str, default: int) -> int:
+    """Integer request field, or default when it is missing or 0."""
+    value = data.get(name)
     try:
-        ws = websocket.create_connection(url)
-        ws_connection = ws
-        
-        # Send login
-        if id_token:
-            ws.send(json.dumps({"id_token": id_token}))
-        elif username and password:
-            ws.send(json.dumps({"username": username, "password": password}))
+        return int(value or default)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be an integer (got {value!r})")
+
+def _parse_cache_ttl(value, logger):
+    """Seconds from a request's "cache_ttl"; None (router TTL) when unset or not a number."""
+    if value is None:
+        return None
+    try:
+        ttl = float(value)
+    except (TypeError, ValueError):
+        logger.warning(f"Ignoring invalid cache_ttl {value!r}; using the router TTL")
+        return None
+    if not ttl >= 0:
+        raise ValueError(f"cache_ttl must not be negative (got {value!r})")
+    return ttl
+
+def _normalize_sql(query: str) -> str:
+    """Collapse whitespace outside string literals and drop trailing semicolons."""
+    return _SQL_TOKENS.sub(lambda m: m.group(1) or " ", query).strip().rstrip(";").strip()
+
+def _is_read_only_sql(query: str) -> bool:
+    """Conservative check that query is a single statement that only reads data."""
+    body = _SQL_LEADING_COMMENTS.sub("", query).rstrip().rstrip(";")
+    verb = body.split(None, 1)[0].lower() if body else ""
+    if verb not in _READ_ONLY_VERBS:
+        return False
+    # Look for statement separators and write keywords outside string literals
+    code = _SQL_TOKENS.sub(lambda m: "''" if m.group(1) else " ", body)
+    return ";" not in code and not _WRITE_KEYWORDS.search(code) and not _SIDE_EFFECT_CALLS.search(code)
+
+def _splice_map(body: bytes, extra: dict) -> bytes:
+    """Prepend entries to a packed MessagePack map without repacking its contents."""
+    first = body[0]
+    if 0x80 <= first <= 0x8f:
+        count, offset = first & 0x0f, 1
+    elif first == 0xde:
+        count, offset = int.from_bytes(body[1:3], "big"), 3
+    elif first == 0xdf:
+        count, offset = int.from_bytes(body[1:5], "big"), 5
+    else:
+        raise ValueError("not a packed MessagePack map")
+    count += len(extra)
+    if count <= 0x0f:
+        header = bytes([0x80 | count])
+    elif count <= 0xffff:
+        header = b"\xde" + count.to_bytes(2, "big")
+    else:
+        header = b"\xdf" + count.to_bytes(4, "big")
+    pairs = b"".join(msgpack.packb(k, use_bin_type=True) + msgpack.packb(v, use_bin_type=True) for k, v in extra.items())
+    return header + pairs + body[offset:]
+
+class _ResultCache:
+    """TTL + total-bytes LRU cache of packed sql-query-result bodies.
+
+    Entries hold the MessagePack-packed response without its request_id, so a
+    hit skips execution, conversion and packing; _splice_map adds the new
+    request_id before sending.
+    """
+
+    def __init__(self, max_bytes: int, default_ttl: float):
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, body)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(conn_key: str, query: str, query_params, result_shape):
+        """Cache key for a read-only query, or None if the query must not be cached."""
+        if not _is_read_only_sql(query):
+            return None
+        normalized = _normalize_sql(query)
+        try:
+            params = json.dumps(query_params or {}, sort_keys=True, default=str)
+        except (TypeError, ValueError):
+            return None
+        return (conn_key, normalized, params, result_shape)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, body = entry
+            if expires_at < time.monotonic():
+                self._remove_locked(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, key, body: bytes, ttl: float = None):
+        if len(body) > self.max_bytes:
+            return
+        expires_at = time.monotonic() + (self.default_ttl if ttl is None else ttl)
+        with self._lock:
+            if key in self._entries:
+                self._remove_locked(key)
+            self._entries[key] = (expires_at, body)
+            self._bytes += len(body)
+            while self._bytes > self.max_bytes:
+                self._remove_locked(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _remove_locked(self, key):
+        _, body = self._entries.pop(key)
+        self._bytes -= len(body)
+
+_result_cache = _ResultCache(RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL)
+
+class _QueryDispatcher:
+    """Bounded worker pool between the WebSocket receive loop and handle_sql_query.
+
+    At most max_workers queries run at once, at most per_key_limit of them
+    against the same connection key, and at most session_limit of them for
+    the same backend session. Work that would exceed a limit waits in a FIFO
+    and starts as soon as both its key and its session have a free slot, so
+    one slow warehouse or one busy session cannot starve the others.
+    """
+
+    def __init__(self, max_workers: int, per_key_limit: int, max_pending: int):
+        self.max_workers = max(1, max_workers)
+        self.per_key_limit = max(1, per_key_limit)
+        self.max_pending = max(0, max_pending)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="dave-query")
+        self._lock = threading.Lock()
+        self._running = {}  # conn_key -> jobs handed to the executor
+        self._session_running = {}  # session key -> jobs handed to the executor
+        self._waiting = deque()  # jobs held back by a key or session limit, oldest first
+        self._pending = 0  # jobs accepted but not yet started
+
+    def submit(self, conn_key: str, fn, *args, session=None, session_limit: int = 0) -> bool:
+        """Schedule fn(*args) for conn_key. Returns False if the router is saturated.
+
+        session is any hashable owner of the job; session_limit caps its
+        running jobs (0 = no cap).
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                return False
+            self._pending += 1
+            job = (conn_key, session, session_limit, fn, args)
+            if self._can_start_locked(job):
+                self._start_locked(job)
+            else:
+                self._waiting.append(job)
+        return True
+
+    def _can_start_locked(self, job) -> bool:
+        conn_key, session, session_limit = job[:3]
+        if self._running.get(conn_key, 0) >= self.per_key_limit:
+            return False
+        return not session_limit or self._session_running.get(session, 0) < session_limit
+
+    def _start_locked(self, job):
+        conn_key, session = job[:2]
+        self._running[conn_key] = self._running.get(conn_key, 0) + 1
+        self._session_running[session] = self._session_running.get(session, 0) + 1
+        self._executor.submit(self._run, job)
+
+    def _run(self, job):
+        conn_key, session, _, fn, args = job
+        with self._lock:
+            self._pending -= 1
+        try:
+            fn(*args)
+        except Exception as e:
+            logging.getLogger("dave_router.dispatcher").error(f"Unhandled error in query worker: {str(e)}")
+        finally:
+            with self._lock:
+                for counts, key in ((self._running, conn_key), (self._session_running, session)):
+                    counts[key] -= 1
+                    if not counts[key]:
+                        del counts[key]
+                # Start every waiting job the freed slots unblock, oldest first
+                for waiting in list(self._waiting):
+                    if self._can_start_locked(waiting):
+                        self._waiting.remove(waiting)
+                        self._start_locked(waiting)
+
+    def stats(self) -> dict:
+        """Snapshot of running and queued work, for diagnostics."""
+        with self._lock:
+            return {
+                "running": sum(self._running.values()),
+                "pending": self._pending,
+                "keys": len(self._running),
+                "sessions": len(self._session_running),
+            }
+
+_query_dispatcher = _QueryDispatcher(MAX_CONCURRENT_QUERIES, MAX_QUERIES_PER_CONNECTION, MAX_PENDING_QUERIES)
+
+def _run_for_session(session, fn, *args):
+    """Run fn on a worker thread with responses routed back to session."""
+    _session_context.session = session
+    try:
+        fn(*args)
+    finally:
+        _session_context.session = None
+
+def _dispatch_sql_query(data, logger, session=None):
+    """Hand an sql-query message to the worker pool without blocking the receive loop."""
+    try:
+        conn_key = _target_registry.resolve(data.get("connectionObject") or {}, logger).key
+    except Exception:
+        # handle_sql_query reports the build error to the backend
+        conn_key = ""
+    request_id = data.get("request_id")
+    # Register before queueing so sql-query-cancel can reach queries still waiting
+    _register_query(request_id, session)
+    session_limit = session.max_concurrent if session is not None else 0
+    if not _query_dispatcher.submit(conn_key, _run_for_session, session, handle_sql_query, data, logger,
+                                    session=session, session_limit=session_limit):
+        _unregister_query(request_id, session)
+        response = _new_query_response(request_id)
+        response["message"] = "Router is busy, too many queued queries"
+        message_queue.put({"type": "sql_error", "message": f"SQL Error: {response['message']} (ID: {request_id})"})
+        logger.error(f"Query rejected: request_id={request_id}, router busy")
+        send_message(response, session)
+
+class _LoginRejected(Exception):
+    pass
+
+class _ResumeBuffer:
+    """sql-query-result frames sent but not yet acknowledged by the backend.
+
+    Bounded by total bytes; the oldest frames are dropped first. Frames are
+    stored packed but uncompressed, so they can be re-sent with whatever
+    codec the next connection negotiates.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._frames = OrderedDict()  # request_id -> packed frame
+        self._bytes = 0
+
+    def add(self, request_id, packed: bytes):
+        with self._lock:
+            self._discard_locked(request_id)
+            self._frames[request_id] = packed
+            self._bytes += len(packed)
+            while self._bytes > self.max_bytes and self._frames:
+                self._discard_locked(next(iter(self._frames)))
+
+    def ack(self, request_id):
+        with self._lock:
+            self._discard_locked(request_id)
+
+    def pending(self) -> list:
+        with self._lock:
+            return list(self._frames.items())
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self._bytes = 0
+
+    def _discard_locked(self, request_id):
+        packed = self._frames.pop(request_id, None)
+        if packed is not None:
+            self._bytes -= len(packed)
+
+def _backoff_delay(attempt: int) -> float:
+    """Exponential backoff with jitter: half the capped delay is fixed, half random."""
+    delay = min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * (2 ** attempt))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+# The session driven by the NiceGUI login form; it mirrors its state into the
+# module-level ws_connection/connected_username/... globals the UI reads.
+PRIMARY_SESSION = "default"
+
+_sessions = {}  # name -> _BackendSession
+_sessions_lock = threading.Lock()
+# Session whose backend asked for the work running on this thread
+_session_context = threading.local()
+
+def _current_session():
+    """The session that owns the current thread's request, or the primary session."""
+    session = getattr(_session_context, "session", None)
+    if session is not None:
+        return session
+    with _sessions_lock:
+        return _sessions.get(PRIMARY_SESSION)
+
+class _BackendSession:
+    """One authenticated, supervised WebSocket connection to a Data Dave backend.
+
+    Sessions share the engine cache, result cache and query dispatcher, but
+    each has its own socket, negotiated capabilities, resume buffer and
+    concurrency quota (max_concurrent running queries, 0 = unlimited).
+    Responses go back through the session that sent the request.
+    """
+
+    def __init__(self, name, url, username=None, password=None, id_token=None,
+                 token_provider=None, max_concurrent=None):
+        self.name = name
+        self.url = url
+        self.credentials = {"username": username, "password": password, "id_token": id_token}
+        self.token_provider = token_provider
+        self.max_concurrent = MAX_QUERIES_PER_SESSION if max_concurrent is None else max_concurrent
+        self.primary = name == PRIMARY_SESSION
+        self.logger = logging.getLogger("dave_router.ws_thread" if self.primary else f"dave_router.session.{name}")
+        # The primary session shares _send_lock with the module-level fallback path
+        self.send_lock = _send_lock if self.primary else threading.Lock()
+        self.stop_event = threading.Event()
+        self.resume_buffer = _ResumeBuffer(RESUME_BUFFER_BYTES)
+        self.thread = None
+        self._reset()
+        self.session_id = None
+
+    def _reset(self):
+        self.ws = None
+        self.username = None
+        self.binary_frames = False
+        self.compression = None
+        self.acks = False
+        self.typed_values = False
+        if self.primary:
+            self._mirror()
+
+    def _mirror(self):
+        global ws_connection, connected_username, binary_frames_enabled, compression_codec
+        global typed_values_enabled
+        ws_connection = self.ws
+        connected_username = self.username
+        binary_frames_enabled = self.binary_frames
+        compression_codec = self.compression
+        typed_values_enabled = self.typed_values
+
+    def _notify(self, msg_type, message):
+        # Only the primary session drives the UI connection state
+        if self.primary:
+            message_queue.put({"type": msg_type, "message": message})
         else:
-            message_queue.put({"type": "login_failed", "message": "Missing credentials"})
+            message_queue.put({"type": "info", "message": f"[{self.name}] {message}"})
+
+    def send_packed(self, packed: bytes, message_type=None, request_id=None):
+        if self.acks and message_type == "sql-query-result":
+            # Kept until the backend acks it, so a reconnect can re-send it
+            self.resume_buffer.add(request_id, packed)
+        frame, opcode = _encode_frame(packed, message_type, request_id, self.binary_frames, self.compression)
+        with self.send_lock:
+            if self.ws:
+                self.ws.send(frame, opcode=opcode)
+
+    def start(self) -> bool:
+        """Run the session on a daemon thread. Returns False if it is already running."""
+        if self.running():
+            return False
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=f"dave-session-{self.name}", daemon=True)
+        self.thread.start()
+        return True
+
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def stop(self):
+        """Stop reconnecting and close the active connection."""
+        self.stop_event.set()
+        with self.send_lock:
+            ws = self.ws
+        if ws:
             ws.close()
-            ws_connection = None
+
+    def run(self):
+        """Log in, serve backend requests and reconnect with backoff when the connection drops.
+
+        Stops when stop_event is set, the backend rejects the login, or the
+        very first connection attempt fails.
+        """
+        logging.basicConfig(level=logging.DEBUG)
+        _session_context.session = self
+        try:
+            self._supervise()
+        finally:
+            _session_context.session = None
+
+    def _supervise(self):
+        logger = self.logger
+        if not self.credentials["id_token"] and not (self.credentials["username"] and self.credentials["password"]):
+            self._notify("login_failed", "Missing credentials")
             return
-        resp = ws.recv()
-        resp_data = json.loads(resp)
-        
+        established = rejected = False
+        attempt = 0
+        while not self.stop_event.is_set():
+            try:
+                if established and self.token_provider:
+                    try:
+                        self.credentials["id_token"] = self.token_provider() or self.credentials["id_token"]
+                    except Exception as e:
+                        logger.warning(f"Could not refresh id_token, reusing the previous one: {str(e)}")
+                self._connect_once()
+                established = True
+                attempt = 0
+            except _LoginRejected as e:
+                self._notify("login_failed", f"Login failed: {str(e)}")
+                rejected = True
+                break
+            except Exception as e:
+                logger.error(f"WebSocket connection failed: {str(e)}")
+                if not established:
+                    break
+            if self.stop_event.is_set() or (RECONNECT_MAX_ATTEMPTS and attempt >= RECONNECT_MAX_ATTEMPTS):
+                break
+            delay = _backoff_delay(attempt)
+            attempt += 1
+            self._notify("reconnecting", f"Connection lost, reconnecting in {delay:.1f}s (attempt {attempt})")
+            self.stop_event.wait(delay)
+        if not rejected:
+            self._notify("disconnected", "Disconnected")
+        self._reset()
+        self.resume_buffer.clear()
+        self.session_id = None
+
+    def _connect_once(self):
+        """Open one WebSocket connection, log in and serve it until it drops.
+
+        Returns only after an accepted login. Connect and handshake failures
+        propagate, so _supervise counts them as failed attempts; raises
+        _LoginRejected when the backend refuses the credentials.
+        """
+        logger = self.logger
+        ws = websocket.create_connection(self.url, timeout=PING_TIMEOUT)
+        keepalive_stop = threading.Event()
+        try:
+            # Send login
+            ws.send(self._login_message())
+            for request_id, packed in self._accept_login(ws, json.loads(ws.recv())):
+                self.send_packed(packed, "sql-query-result", request_id)
+
+            threading.Thread(target=self._keepalive, args=(ws, keepalive_stop), daemon=True).start()
+            try:
+                while True:
+                    msg = ws.recv()
+                    # logger.debug(f"Received raw message: {msg}")
+                    try:
+                        try:
+                            data = _decode_incoming(msg)
+                        except Exception as e:
+                            logger.error(f"Failed to decode message: {e}")
+                            continue
+                        self._handle_message(data)
+                    except Exception as e:
+                        logger.error(f"Exception in ws_thread message handler: {str(e)}")
+            except (websocket.WebSocketException, OSError) as e:
+                logger.info(f"WebSocket connection lost: {str(e)}")
+        finally:
+            keepalive_stop.set()
+            self._detach(ws)
+            try:
+                ws.close()
+            except Exception:
+                pass
+
+    def _login_message(self) -> str:
+        credentials = self.credentials
+        login = {"capabilities": _router_capabilities()}
+        if credentials.get("id_token"):
+            login["id_token"] = credentials["id_token"]
+        else:
+            login["username"] = credentials["username"]
+            login["password"] = credentials["password"]
+        if self.session_id:
+            # Resume handshake: the backend answers with the request_ids it already has
+            login["resume"] = {"session_id": self.session_id, "pending": [rid for rid, _ in self.resume_buffer.pending()]}
+        return json.dumps(login)
+
+    def _accept_login(self, ws, resp_data) -> list:
+        """Adopt ws after the backend's login reply.
+
+        Returns the (request_id, packed) results to re-send on a resumed
+        session; raises _LoginRejected when the login failed.
+        """
         if not resp_data.get("success"):
-            message_queue.put({"type": "login_failed", "message": f"Login failed: {resp_data.get('message', '')}"})
-            ws.close()
-            ws_connection = None
+            raise _LoginRejected(resp_data.get("message", ""))
+        # Old servers ignore capabilities and keep receiving uncompressed base64 text frames
+        accepted = resp_data.get("capabilities") or {}
+        with self.send_lock:
+            self.ws = ws
+            self.username = self.credentials.get("username") or resp_data.get("username", "Google User")
+            self.binary_frames = bool(accepted.get("binary_frames"))
+            self.compression = accepted.get("compression") if accepted.get("compression") in _available_codecs() else None
+            self.acks = bool(accepted.get("acks"))
+            self.typed_values = bool(accepted.get("typed_values"))
+            if self.primary:
+                self._mirror()
+        self.session_id = resp_data.get("session_id") or self.session_id
+        self.logger.info(f"Login accepted, binary_frames={self.binary_frames}, compression={self.compression}, "
+                         f"acks={self.acks}, typed_values={self.typed_values}")
+        self._notify("connected", f"Connected as {self.username}")
+
+        resend = []
+        if resp_data.get("resumed"):
+            acked = set(resp_data.get("acked") or [])
+            for request_id, packed in self.resume_buffer.pending():
+                if request_id in acked:
+                    self.resume_buffer.ack(request_id)
+                else:
+                    self.logger.info(f"Re-sending unacknowledged result: request_id={request_id}")
+                    resend.append((request_id, packed))
+        else:
+            # A fresh session: the old one's results and request ids mean nothing to it
+            self.resume_buffer.clear()
+        return resend
+
+    def _detach(self, ws):
+        with self.send_lock:
+            if self.ws is ws:
+                self.ws = None
+                self.username = None
+                if self.primary:
+                    self._mirror()
+
+    def _keepalive(self, ws, stop: threading.Event):
+        """Ping the backend so dead sockets surface as recv() timeouts instead of hanging."""
+        while not stop.wait(PING_INTERVAL):
+            try:
+                with self.send_lock:
+                    ws.ping()
+            except Exception as e:
+                self.logger.debug(f"Keepalive ping failed: {e}")
+                return
+
+    def _handle_message(self, data):
+        """Route one decoded backend message."""
+        if not data:
             return
-        connected_username = username if username else resp_data.get("username", "Google User")
-        message_queue.put({"type": "connected", "message": f"Connected as {connected_username}"})
-        # Keep alive
-        while True:
-            msg = ws.recv()
-            # logger.debug(f"Received raw message: {msg}")
-            # Try to parse as JSON for tunnel mode
+        msg_type = data.get("type")
+        if msg_type == "sql-query":
+            _dispatch_sql_query(data, self.logger, self)
+        elif msg_type == "sql-query-cancel":
+            # Driver cancel calls may need their own round trip; keep recv() free
+            threading.Thread(target=cancel_query, args=(data.get("request_id"), self.logger, "cancelled", self),
+                             daemon=True).start()
+        elif msg_type == "sql-query-ack":
+            self.resume_buffer.ack(data.get("request_id"))
+        elif msg_type == "router-targets":
+            futures = _pool_warmer.set_targets(self.name, data.get("targets"), self.logger)
+            threading.Thread(target=self._report_targets, args=(futures,), daemon=True).start()
+
+    def _report_targets(self, futures):
+        """Send router-targets-status once every target from this session has been warmed or failed."""
+        concurrent.futures.wait(futures)
+        status = _pool_warmer.status(self.name)
+        warm = sum(1 for target in status if target["state"] == "warm")
+        self._notify("info", f"{warm} of {len(status)} database target(s) warm")
+        try:
+            send_message({"type": "router-targets-status", "targets": status}, self)
+        except Exception as e:
+            self.logger.error(f"Failed to send router-targets-status: {str(e)}")
+
+    def stats(self) -> dict:
+        return {
+            "connected": self.ws is not None,
+            "username": self.username,
+            "max_concurrent": self.max_concurrent,
+            "unacked_results": len(self.resume_buffer.pending()),
+        }
+
+_websockets = None
+
+def _load_websockets():
+    """Import the websockets asyncio client on first use. Returns None when it is not installed."""
+    global _websockets
+    if _websockets is None:
+        try:
+            import websockets.asyncio.client
+            import websockets.exceptions
+            _websockets = websockets
+        except ImportError:
+            _websockets = False
+    return _websockets or None
+
+# Event loop of the NiceGUI server, captured at startup; asyncio sessions run on it
+_event_loop = None
+
+def _capture_event_loop():
+    global _event_loop
+    _event_loop = asyncio.get_running_loop()
+
+class _AsyncBackendSession(_BackendSession):
+    """_BackendSession on an asyncio WebSocket client instead of a blocking thread.
+
+    Runs on the NiceGUI event loop when one is available (or a private loop
+    thread otherwise), so idle sessions cost no threads and keepalive pings
+    are handled by the websockets library. Queries still execute on the
+    dispatcher's worker threads; their responses are handed back to the
+    loop with run_coroutine_threadsafe.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loop = None
+        self.future = None
+        self._wakeup = None
+
+    def running(self) -> bool:
+        return (self.future is not None and not self.future.done()) or super().running()
+
+    def start(self) -> bool:
+        if self.running():
+            return False
+        self.stop_event = threading.Event()
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = _event_loop
+        if loop is not None and loop.is_running():
+            self.loop = loop
+            self.future = asyncio.run_coroutine_threadsafe(self.run_async(), loop)
+        else:
+            # No server loop (tests, scripts): give the session a loop of its own
+            self.thread = threading.Thread(target=asyncio.run, args=(self.run_async(),),
+                                           name=f"dave-session-{self.name}", daemon=True)
+            self.thread.start()
+        return True
+
+    def stop(self):
+        self.stop_event.set()
+        loop, ws = self.loop, self.ws
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._wake)
+            if ws is not None:
+                asyncio.run_coroutine_threadsafe(ws.close(), loop)
+
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def send_packed(self, packed: bytes, message_type=None, request_id=None):
+        if self.acks and message_type == "sql-query-result":
+            self.resume_buffer.add(request_id, packed)
+        frame, _ = _encode_frame(packed, message_type, request_id, self.binary_frames, self.compression)
+        ws, loop = self.ws, self.loop
+        if ws is None or loop is None:
+            return
+        try:
+            on_loop = asyncio.get_running_loop() is loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            loop.create_task(self._send(ws, frame))
+        else:
+            # Wait for the write so worker threads feel backpressure and chunks stay in order
+            asyncio.run_coroutine_threadsafe(self._send(ws, frame), loop).result()
+
+    async def _send(self, ws, frame):
+        # str frames go out as text, bytes as binary
+        try:
+            await ws.send(frame)
+        except _websockets.exceptions.ConnectionClosed as e:
+            self.logger.debug(f"Dropped frame on closed connection: {e}")
+
+    async def run_async(self):
+        """Asyncio counterpart of _BackendSession.run."""
+        self.loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        logger = self.logger
+        if not self.credentials["id_token"] and not (self.credentials["username"] and self.credentials["password"]):
+            self._notify("login_failed", "Missing credentials")
+            return
+        established = rejected = False
+        attempt = 0
+        while not self.stop_event.is_set():
             try:
-                data = None
-                # Try to decode as base64-encoded MessagePack
-                try:
-                    packed = base64.b64decode(msg)
-                    data = msgpack.unpackb(packed, raw=False)
-                except Exception:
-                    # Fallback to JSON
+                if established and self.token_provider:
                     try:
-                        data = json.loads(msg)
+                        # The provider may block on the UI loop; keep this loop free
+                        token = await asyncio.to_thread(self.token_provider)
+                        self.credentials["id_token"] = token or self.credentials["id_token"]
                     except Exception as e:
-                        logger.error(f"Failed to decode JSON: {e}")
-                        continue
-                if data and data.get("type") == "sql-query":
-                    handle_sql_query(data, logger)
-                    continue
+                        logger.warning(f"Could not refresh id_token, reusing the previous one: {str(e)}")
+                await self._connect_once_async()
+                established = True
+                attempt = 0
+            except _LoginRejected as e:
+                self._notify("login_failed", f"Login failed: {str(e)}")
+                rejected = True
+                break
             except Exception as e:
-                logger.error(f"Exception in ws_thread message handler: {str(e)}")
+                logger.error(f"WebSocket connection failed: {str(e)}")
+                if not established:
+                    break
+            if self.stop_event.is_set() or (RECONNECT_MAX_ATTEMPTS and attempt >= RECONNECT_MAX_ATTEMPTS):
+                break
+            delay = _backoff_delay(attempt)
+            attempt += 1
+            self._notify("reconnecting", f"Connection lost, reconnecting in {delay:.1f}s (attempt {attempt})")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
                 pass
-            # message_queue.put(f"Received: {msg}")
-    except Exception as e:
-        message_queue.put({"type": "disconnected", "message": "Disconnected"})
-        ws_connection = None
-        connected_username = None
+        if not rejected:
+            self._notify("disconnected", "Disconnected")
+        self._reset()
+        self.resume_buffer.clear()
+        self.session_id = None
+
+    async def _connect_once_async(self):
+        logger = self.logger
+        ws = await _websockets.asyncio.client.connect(
+            self.url, open_timeout=PING_TIMEOUT, ping_interval=PING_INTERVAL, ping_timeout=PING_TIMEOUT, max_size=None)
+        try:
+            await ws.send(self._login_message())
+            for request_id, packed in self._accept_login(ws, json.loads(await ws.recv())):
+                if self.acks:
+                    self.resume_buffer.add(request_id, packed)
+                frame, _ = _encode_frame(packed, "sql-query-result", request_id, self.binary_frames, self.compression)
+                await self._send(ws, frame)
+            try:
+                async for msg in ws:
+                    try:
+                        try:
+                            data = _decode_incoming(msg)
+                        except Exception as e:
+                            logger.error(f"Failed to decode message: {e}")
+                            continue
+                        self._handle_message(data)
+                    except Exception as e:
+                        logger.error(f"Exception in ws_thread message handler: {str(e)}")
+            except (_websockets.exceptions.ConnectionClosed, OSError) as e:
+                logger.info(f"WebSocket connection lost: {str(e)}")
+        finally:
+            self._detach(ws)
+            await ws.close()
+
+def add_session(name, url, username=None, password=None, id_token=None, token_provider=None,
+                max_concurrent=None) -> bool:
+    """Register and start a backend session. Returns False if name is already running."""
+    with _sessions_lock:
+        session = _sessions.get(name)
+        if session is not None and session.running():
+            return False
+        session_class = _AsyncBackendSession if TRANSPORT == "asyncio" and _load_websockets() else _BackendSession
+        session = _sessions[name] = session_class(
+            name, url, username, password, id_token, token_provider, max_concurrent)
+    return session.start()
+
+def remove_session(name) -> bool:
+    """Stop a backend session and forget it. Returns False if name is unknown."""
+    with _sessions_lock:
+        session = _sessions.pop(name, None)
+    if session is None:
+        return False
+    session.stop()
+    return True
+
+def session_stats() -> dict:
+    """Per-session connection state, for diagnostics."""
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+    return {session.name: session.stats() for session in sessions}
+
+def _load_configured_sessions() -> list:
+    """Extra backend sessions from DAVE_ROUTER_SESSIONS (a JSON list of objects).
+
+    Each object needs "name" and "url" plus either "username"/"password" or
+    "id_token"; "max_concurrent" overrides the per-session quota.
+    """
+    raw = os.environ.get("DAVE_ROUTER_SESSIONS")
+    if not raw:
+        return []
+    try:
+        sessions = json.loads(raw)
+    except ValueError as e:
+        logging.getLogger("dave_router").error(f"Ignoring invalid DAVE_ROUTER_SESSIONS: {str(e)}")
+        return []
+    return [s for s in sessions if isinstance(s, dict) and s.get("name") and s.get("url")]
+
+def start_configured_sessions(configs=None):
+    """Start every session listed in configs (default: DAVE_ROUTER_SESSIONS)."""
+    for config in _load_configured_sessions() if configs is None else configs:
+        add_session(
+            config["name"], config["url"], config.get("username"), config.get("password"),
+            config.get("id_token"), max_concurrent=config.get("max_concurrent"))
+
+def ws_thread(url, username=None, password=None, id_token=None, token_provider=None, stop_event=None):
+    """Run the primary (UI) session on the calling thread until it stops.
+
+    See _BackendSession.run for the reconnect behaviour.
+    """
+    session = _BackendSession(PRIMARY_SESSION, url, username, password, id_token, token_provider)
+    if stop_event is not None:
+        session.stop_event = stop_event
+    with _sessions_lock:
+        _sessions[PRIMARY_SESSION] = session
+    try:
+        session.run()
+    finally:
+        with _sessions_lock:
+            if _sessions.get(PRIMARY_SESSION) is session:
+                del _sessions[PRIMARY_SESSION]
+
+def start_tunnel(url, username=None, password=None, id_token=None, token_provider=None) -> bool:
+    """Start the primary session. Returns False if it is already running."""
+    return add_session(PRIMARY_SESSION, url, username, password, id_token, token_provider)
+
+def stop_tunnel():
+    """Stop the primary session."""
+    remove_session(PRIMARY_SESSION)
+
+def tunnel_running() -> bool:
+    with _sessions_lock:
+        session = _sessions.get(PRIMARY_SESSION)
+    return session is not None and session.running()
+
+# Headless mode: the tunnel without NiceGUI, for server deployments
+def _load_headless_config(path=None) -> dict:
+    """Tunnel credentials for headless mode.
+
+    Values come from the JSON file at path (or DAVE_ROUTER_CONFIG) with keys
+    "url", "username", "password", "id_token", "sessions" (same shape as
+    DAVE_ROUTER_SESSIONS) and "targets" (same shape as DAVE_ROUTER_TARGETS). DAVE_ROUTER_URL, DAVE_ROUTER_USERNAME,
+    DAVE_ROUTER_PASSWORD and DAVE_ROUTER_ID_TOKEN override the file.
+    """
+    config = {}
+    path = path or os.environ.get("DAVE_ROUTER_CONFIG")
+    if path:
+        with open(path) as f:
+            config = json.load(f)
+        if not isinstance(config, dict):
+            raise ValueError(f"{path} must contain a JSON object")
+    for key in ("url", "username", "password", "id_token"):
+        value = os.environ.get(f"DAVE_ROUTER_{key.upper()}")
+        if value:
+            config[key] = value
+    config.setdefault("url", ws_url)
+    sessions = config.get("sessions") or []
+    config["sessions"] = [s for s in sessions if isinstance(s, dict) and s.get("name") and s.get("url")]
+    config["sessions"] += _load_configured_sessions()
+    targets = config.get("targets")
+    config["targets"] = (targets if isinstance(targets, list) else []) + _load_configured_targets()
+    return config
+
+def _log_ui_event(events, dropped):
+    """Headless stand-in for the terminal: UI events go to the log."""
+    logger = logging.getLogger("dave_router.events")
+    for event in _coalesce_events(events):
+        msg_type = event.get("type")
+        if msg_type == "sql_execution_info":
+            continue
+        level = logging.WARNING if msg_type in ("sql_error", "login_failed", "disconnected") else logging.INFO
+        logger.log(level, event.get("message", ""))
+    if dropped:
+        logger.warning(f"{dropped} event(s) dropped during a burst")
+
+def _install_stop_signals(loop, stop: asyncio.Event):
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            # Windows event loops have no add_signal_handler
+            signal.signal(sig, lambda *_: loop.call_soon_threadsafe(stop.set))
+        except (RuntimeError, ValueError):
+            # Not the main thread; the caller stops the tunnel through `stop`
+            return
+
+async def _serve_headless(config: dict, stop: asyncio.Event) -> int:
+    """Run the configured sessions on this loop until stop is set or all of them end."""
+    _capture_event_loop()
+    message_queue.subscribe(_log_ui_event)
+    if config.get("id_token") or (config.get("username") and config.get("password")):
+        start_tunnel(config["url"], config.get("username"), config.get("password"), config.get("id_token"))
+    start_configured_sessions(config["sessions"])
+    start_configured_targets(config.get("targets", []))
+    with _sessions_lock:
+        sessions = list(_sessions.items())
+    while not stop.is_set() and any(session.running() for _, session in sessions):
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(stop.wait(), 1)
+    for name, _ in sessions:
+        remove_session(name)
+    deadline = time.monotonic() + 5
+    while any(session.running() for _, session in sessions) and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    # Ending without a stop request means every session gave up (rejected login, retries exhausted)
+    return 0 if stop.is_set() else 1
+
+def run_headless(config_path=None) -> int:
+    """Run the tunnel without the UI. Returns the process exit code."""
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    logger = logging.getLogger("dave_router")
+    try:
+        config = _load_headless_config(config_path)
+    except (OSError, ValueError) as e:
+        logger.error(f"Could not read headless config: {str(e)}")
+        return 2
+    if not (config.get("id_token") or (config.get("username") and config.get("password")) or config["sessions"]):
+        logger.error("Headless mode needs DAVE_ROUTER_USERNAME/DAVE_ROUTER_PASSWORD, DAVE_ROUTER_ID_TOKEN "
+                     "or sessions in the config file")
+        return 2
+
+    async def serve():
+        stop = asyncio.Event()
+        _install_stop_signals(asyncio.get_running_loop(), stop)
+        return await _serve_headless(config, stop)
+
+    logger.info(f"Starting headless router for {config['url']}")
+    prewarm_drivers()
+    return asyncio.run(serve())
 
 # NiceGUI interface
+class _TerminalLog:
+    """Fixed-size ring buffer of terminal lines backing the virtualized UI table."""
+
+    def __init__(self, capacity: int):
+        self._lines = deque(maxlen=max(1, capacity))
+        self._next_id = 0
+
+    def append(self, text: str, kind: str = "normal", query=None) -> dict:
+        """Add a line, evicting the oldest when full. `query` makes the line clickable."""
+        line = {"id": self._next_id, "time": time.strftime("%H:%M:%S", time.localtime()),
+                "text": text, "kind": kind, "clickable": query is not None}
+        self._next_id += 1
+        # The query payload stays server-side; it may carry connection credentials
+        self._lines.append((line, query))
+        return line
+
+    def query(self, line_id):
+        """The sql-query payload behind a clickable line, or None once it has been evicted."""
+        if not self._lines:
+            return None
+        # Ids are consecutive, so the offset from the oldest line is the index
+        index = line_id - self._lines[0][0]["id"]
+        if 0 <= index < len(self._lines):
+            return self._lines[index][1]
+        return None
+
+    def rows(self) -> list:
+        return [line for line, _ in self._lines]
+
+    def clear(self):
+        self._lines.clear()
+
+    def __len__(self):
+        return len(self._lines)
+
+def _browser_token_provider(client, loop):
+    """token_provider that fetches a fresh Firebase ID token from client's browser.
+
+    Sessions call it from their own thread before re-authenticating (ID
+    tokens expire after an hour). run_javascript returns an AwaitableResponse
+    that must be created and awaited on the UI loop, so it runs in a coroutine
+    scheduled there.
+    """
+    def refresh_id_token():
+        async def fetch():
+            return await client.run_javascript('firebase.auth().currentUser.getIdToken(true)', timeout=10)
+        return asyncio.run_coroutine_threadsafe(fetch(), loop).result(timeout=15)
+    return refresh_id_token
+
 def create_ui():
+    from nicegui import ui, app
     # Set the background color outside the card and ensure full height
     ui.add_head_html("""
     <style>
@@ -315,13 +3005,15 @@ def create_ui():
         
         .terminal-message {
             border-bottom: 1px solid #333;
-            padding: 6px 0;
+            padding: 6px 0 !important;
             white-space: pre-wrap;
             word-break: break-word;
+            font-family: monospace;
         }
         
-        .terminal-message:last-child {
-            border-bottom: none;
+        .terminal-table, .terminal-table .q-table__middle {
+            background-color: transparent;
+            color: #f0f0f0;
         }
         
         .terminal-time {
@@ -377,7 +3069,7 @@ def create_ui():
     ''')
 
     # Container for vertical centering
-    with ui.column().classes('w-full h-full flex items-center justify-center'):
+    with ui.column().classes('w-full h-full flex items-center justify-center') as root:
         # Create a row with two cards
         with ui.row().classes('w-full px-4 gap-4 flex-row justify-center items-stretch max-w-7xl'):
             # Left card - Login (30% width)
@@ -410,34 +3102,46 @@ def create_ui():
                     ui.label('Message Queue').classes('text-lg font-medium')
                     ui.space()
                     def clear_logs():
-                        message_history.clear()
-                        terminal_container.clear()
+                        terminal_log.clear()
+                        terminal_table.rows = []
                         message_count.text = 'Messages: 0'
                     ui.button(on_click=clear_logs, icon='delete').props('color=error flat dense').classes('mr-2').style('color: #ef4444').tooltip('Clear logs')
                     connection_status = ui.label('Disconnected').classes('text-sm rounded px-2 py-1 bg-red-500')
                     ui.label('|').classes('mx-2 text-gray-500')
                     message_count = ui.label('Messages: 0').classes('text-sm')
-                    terminal_container = ui.scroll_area().classes('w-full h-full terminal-container flex-grow')
-                    terminal_scroll_area = terminal_container  # Save reference for scrolling
+                    # Virtual scroll renders only the visible rows, so the page stays
+                    # the same size however many lines the ring buffer holds
+                    terminal_table = ui.table(rows=[], columns=[{"name": "text", "field": "text", "label": ""}],
+                                              pagination=0).classes('w-full h-full flex-grow terminal-table')
+                    terminal_table.props('flat dense hide-header hide-bottom virtual-scroll')
+                    terminal_table.add_slot('body', r'''
+                        <q-tr :props="props">
+                            <q-td class="terminal-message">
+                                <span class="terminal-time">[{{ props.row.time }}]</span>
+                                <span v-if="props.row.clickable" class="terminal-info cursor-pointer hover:underline"
+                                      @click="() => $parent.$emit('show_query', props.row.id)">{{ props.row.text }}</span>
+                                <span v-else :class="'terminal-' + props.row.kind">{{ props.row.text }}</span>
+                            </q-td>
+                        </q-tr>
+                    ''')
+                    terminal_table.on('show_query', lambda e: show_sql_query_dialog(terminal_log.query(e.args)))
 
-        # Store message history
-        message_history = []
+        # Bounded message history shown in the terminal
+        terminal_log = _TerminalLog(TERMINAL_HISTORY)
         # Buffer for pending terminal messages
         pending_terminal_messages = []
         
         def flush_terminal_messages():
             """Flush all buffered terminal messages to the UI at once."""
-            nonlocal pending_terminal_messages
             for args in pending_terminal_messages:
-                _add_terminal_message_to_ui(*args)
+                _add_terminal_message(*args)
             pending_terminal_messages.clear()
-            message_count.text = f"Messages: {len(message_history)}"
-            if terminal_scroll_area:
-                terminal_scroll_area.scroll_to(percent=100)
+            terminal_table.rows = terminal_log.rows()
+            message_count.text = f"Messages: {len(terminal_log)}"
+            terminal_table.run_method('scrollTo', len(terminal_log) - 1)
 
-        def _add_terminal_message_to_ui(content_or_data, type="normal"):
-            """Internal: Actually add a message to the terminal UI and message_history."""
-            timestamp = time.strftime("%H:%M:%S", time.localtime())
+        def _add_terminal_message(content_or_data, type="normal"):
+            """Internal: Append a message to the terminal ring buffer."""
             if type == "sql_query" and isinstance(content_or_data, dict):
                 query_data = content_or_data
                 raw_query = query_data.get('query', '')
@@ -447,29 +3151,18 @@ def create_ui():
                     summary_text = f"{display_query[:max_len-3]}..."
                 else:
                     summary_text = display_query
-                display_text = f"Executing Query: {summary_text}"
-                message_history.insert(0, (timestamp, display_text, "info_clickable", query_data))
-                with terminal_container:
-                    new_row = ui.row().classes('terminal-message w-full items-center')
-                    with new_row:
-                        ui.label(f"[{timestamp}]").classes('terminal-time')
-                        clickable_label = ui.label(display_text).classes(f'flex-grow terminal-info cursor-pointer hover:underline')
-                        clickable_label.on('click', lambda _, qd=query_data: show_sql_query_dialog(qd))
+                terminal_log.append(f"Executing Query: {summary_text}", "info", query_data)
             else:
                 text_content = str(content_or_data.get("message") if isinstance(content_or_data, dict) and "message" in content_or_data else content_or_data)
-                message_history.insert(0, (timestamp, text_content, type))
-                with terminal_container:
-                    new_row = ui.row().classes('terminal-message w-full')
-                    with new_row:
-                        ui.label(f"[{timestamp}]").classes('terminal-time')
-                        msg_class = f"terminal-{type}" if type in ["success", "error", "info"] else ""
-                        ui.label(text_content).classes(f'flex-grow {msg_class}')
+                terminal_log.append(text_content, type)
 
         def add_terminal_message(content_or_data, type="normal"):
             """Buffer a message to be added to the terminal UI on the next flush."""
             pending_terminal_messages.append((content_or_data, type))
 
         def show_sql_query_dialog(query_data):
+            if not query_data:
+                return
             with ui.dialog() as dialog, ui.card().classes(
                 'min-w-[600px] max-w-[80vw] dark:bg-gray-800 rounded-lg shadow-xl' # Dark mode, rounded, shadow
             ):
@@ -513,9 +3206,9 @@ def create_ui():
 
         def disconnect_ws():
             global ws_connection, connected_username
-            if ws_connection:
+            if ws_connection or tunnel_running():
                 try:
-                    ws_connection.close()
+                    stop_tunnel()
                     add_terminal_message("Manually disconnected", "info")
                 except Exception as e:
                     error_msg = f"Error disconnecting: {str(e)}"
@@ -550,12 +3243,9 @@ def create_ui():
             add_terminal_message(f"Connecting to {ws_url} as {username}...", "info")
             status_image.set_source('dave_disconnected.png')  # Ensure disconnected image while connecting
 
-            # Start WebSocket in a thread
-            threading.Thread(
-                target=ws_thread,
-                args=(ws_url, username, password, None),
-                daemon=True
-            ).start()
+            # Start the supervised WebSocket thread
+            if not start_tunnel(ws_url, username, password):
+                add_terminal_message("Already connected. Disconnect first if needed.", "info")
         
         # Listen for the Firebase ID token from JS and trigger login
         def handle_firebase_id_token(id_token):
@@ -568,11 +3258,9 @@ def create_ui():
             status_label.text = "Connecting with Google..."
             add_terminal_message("Connecting with Google...", "info")
             # status_image.set_source('dave_disconnected.png')
-            threading.Thread(
-                target=ws_thread,
-                args=(ws_url, None, None, id_token),
-                daemon=True
-            ).start()
+            refresh_id_token = _browser_token_provider(ui.context.client, asyncio.get_event_loop())
+            if not start_tunnel(ws_url, None, None, id_token, refresh_id_token):
+                add_terminal_message("Already connected. Disconnect first if needed.", "info")
         
         def update_ui_state():
             # Update UI elements based on connection state
@@ -599,11 +3287,9 @@ def create_ui():
         # Set initial UI state
         update_ui_state()
 
-        def check_messages():
-            """Check for messages from the websocket thread and update UI"""
-            updated = False
-            while not message_queue.empty():
-                msg_obj = message_queue.get()
+        def process_events(events, dropped):
+            """Apply a batch of events from the worker threads to the UI"""
+            for msg_obj in _coalesce_events(events):
                 msg_type = msg_obj.get("type", "normal")
                 message = msg_obj.get("message", "")
                 if msg_type == "connected":
@@ -616,6 +3302,11 @@ def create_ui():
                     status_image.set_source('dave_disconnected.png')
                     update_ui_state()
                     add_terminal_message(message, "error")
+                elif msg_type == "reconnecting":
+                    status_label.text = "Reconnecting..."
+                    status_image.set_source('dave_disconnected.png')
+                    update_ui_state()
+                    add_terminal_message(message, "info")
                 elif msg_type == "login_failed":
                     status_label.text = "Disconnected"
                     status_image.set_source('dave_disconnected.png')
@@ -630,34 +3321,107 @@ def create_ui():
                     add_terminal_message(msg_obj, "sql_query")
                 else:
                     add_terminal_message(message, "info" if msg_type == "info" else "normal")
-                updated = True
+            if dropped:
+                add_terminal_message(f"{dropped} message(s) dropped during a burst", "info")
             if pending_terminal_messages:
                 flush_terminal_messages()
 
-        # Set up a timer to check for messages from the WebSocket thread
-        ui.timer(0.5, check_messages)
+        def deliver_events(events, dropped):
+            # Bus callbacks run on the bare event loop; enter the page's slot so
+            # element updates and ui.notify know which client they belong to
+            with root:
+                process_events(events, dropped)
+
+        # Worker threads push events onto the UI loop as they happen
+        app.on_startup(lambda: message_queue.subscribe(deliver_events))
 
         ui.on("firebase_id_token", lambda e: handle_firebase_id_token(e.args))
 
-# Run the NiceGUI app
-def main():
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Dave tunnel mode router")
+    parser.add_argument("--headless", action="store_true", default=os.environ.get("DAVE_ROUTER_HEADLESS") == "1",
+                        help="run the tunnel without the web UI (also DAVE_ROUTER_HEADLESS=1)")
+    parser.add_argument("--config", help="JSON file with headless credentials (also DAVE_ROUTER_CONFIG)")
+    return parser.parse_args(argv)
+
+# Run the NiceGUI app, or the bare tunnel with --headless
+def main(argv=None):
+    args = _parse_args(argv)
+    if args.headless:
+        sys.exit(run_headless(args.config))
+    from nicegui import ui, app
     create_ui()
+    app.on_startup(_capture_event_loop)
+    app.add_api_route("/metrics", _metrics_route, methods=["GET"], include_in_schema=False)
+    app.on_startup(start_configured_sessions)
+    app.on_startup(prewarm_drivers)
+    app.on_startup(start_configured_targets)
     ui.run(reload=False, title='Dave Router', port=8180, favicon="https://cdn-icons-png.flaticon.com/128/6584/6584942.png")
 
 # Helper to convert values to JSON-serializable types
 def convert_json_safe(val):
     if isinstance(val, bytes):
-        try:
-            return val.decode('utf-8')
-        except UnicodeDecodeError:
-            if len(val) == 1:
-                return int.from_bytes(val, 'little')
-            return val.hex()
+        return _bytes_json_safe(val)
     if isinstance(val, (datetime.date, datetime.datetime)):
         return val.isoformat()
     if isinstance(val, decimal.Decimal):
         return str(val)
     return val
 
+def _bytes_json_safe(val: bytes):
+    try:
+        return val.decode('utf-8')
+    except UnicodeDecodeError:
+        if len(val) == 1:
+            return int.from_bytes(val, 'little')
+        return val.hex()
+
+# Types msgpack sends as-is; columns holding only these need no conversion
+_PASSTHROUGH_TYPES = frozenset({int, float, str, bool, type(None)})
+# Exact type -> converter equivalent to convert_json_safe for that type
+_COLUMN_CONVERTERS = {
+    datetime.datetime: datetime.datetime.isoformat,
+    datetime.date: datetime.date.isoformat,
+    decimal.Decimal: str,
+    bytes: _bytes_json_safe,
+}
+
+def _convert_column(values):
+    """convert_json_safe applied to a whole column, or None if nothing needs converting.
+
+    The column is profiled with one C-level pass over its value types, then
+    converted with a single specialized function (native columns are left
+    alone). Profiling every batch keeps this correct for drivers such as
+    SQLite whose column types can change from row to row; mixed columns use
+    convert_json_safe.
+    """
+    types = set(map(type, values))
+    if types <= _PASSTHROUGH_TYPES:
+        return None
+    has_nulls = type(None) in types
+    types.discard(type(None))
+    converter = _COLUMN_CONVERTERS.get(types.pop()) if len(types) == 1 else None
+    if converter is None:
+        return list(map(convert_json_safe, values))
+    if has_nulls:
+        return [None if v is None else converter(v) for v in values]
+    return list(map(converter, values))
+
+def _convert_rows(rows) -> list:
+    """Rows as lists of JSON/msgpack-safe values, converted column-at-a-time.
+
+    With typed values the rows are left as they are: _packb encodes every
+    supported type losslessly at pack time.
+    """
+    if not rows:
+        return []
+    if _typed_values_active():
+        return [list(row) for row in rows]
+    columns = list(zip(*rows))
+    converted = [_convert_column(values) for values in columns]
+    if all(c is None for c in converted):
+        return [list(row) for row in rows]
+    return list(map(list, zip(*[values if c is None else c for values, c in zip(columns, converted)])))
+
 if __name__ in {"__main__", "__mp_main__"}:
     main() 
@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the dave_router tunnel hot path.
+
+A local stand-in for the Data Dave backend speaks the router's login and
+sql-query protocol over a real WebSocket, and the router under test runs
+in-process as an ordinary backend session (dispatcher, engine cache, result
+encoding, compression and send path included). Results are written as JSON
+so runs can be compared across commits:
+
+    python dave_router_bench.py --output before.json
+    python dave_router_bench.py --output after.json --compare before.json
+
+Databases: a generated SQLite file always; DuckDB when duckdb_engine is
+installed; Postgres when --postgres is given a connectionObject (JSON).
+"""
+
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import logging
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import msgpack
+
+import dave_router
+
+WIDE_COLUMNS = 100
+
+
+class FakeBackend:
+    """Minimal Data Dave backend: accepts one router login and issues sql-query requests.
+
+    Runs a websockets server on its own event loop thread. run_query() blocks
+    the calling thread until the final sql-query-result arrives and returns
+    (result, bytes received, seconds).
+    """
+
+    def __init__(self, compression=None):
+        self.compression = compression
+        self.loop = asyncio.new_event_loop()
+        self.url = None
+        self._router = None
+        self._connected = threading.Event()
+        self._pending = {}  # request_id -> [future, bytes received]
+        self._ids = itertools.count()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="bench-backend", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._serve(), self.loop).result(5)
+        return self
+
+    async def _serve(self):
+        from websockets.asyncio.server import serve
+        self._server = await serve(self._handler, "127.0.0.1", 0, max_size=None)
+        self.url = f"ws://127.0.0.1:{self._server.sockets[0].getsockname()[1]}"
+
+    async def _handler(self, ws):
+        login = json.loads(await ws.recv())
+        offered = (login.get("capabilities") or {}).get("compression") or []
+        await ws.send(json.dumps({
+            "success": True,
+            "username": login.get("username"),
+            "capabilities": {
+                "binary_frames": True,
+                "compression": self.compression if self.compression in offered else None,
+            },
+        }))
+        self._router = ws
+        self._connected.set()
+        async for frame in ws:
+            message = _decode_frame(frame)
+            waiter = self._pending.get(message.get("request_id"))
+            if waiter is None:
+                continue
+            waiter[1] += len(frame)
+            if message.get("type") == "sql-query-result":
+                del self._pending[message["request_id"]]
+                waiter[0].set_result(message)
+
+    def wait_connected(self, timeout=10):
+        if not self._connected.wait(timeout):
+            raise RuntimeError("router did not log in to the benchmark backend")
+
+    async def _query(self, request: dict):
+        request_id = f"bench-{next(self._ids)}"
+        waiter = [self.loop.create_future(), 0]
+        self._pending[request_id] = waiter
+        started = time.perf_counter()
+        await self._router.send(json.dumps(dict(request, type="sql-query", request_id=request_id)))
+        result = await waiter[0]
+        return result, waiter[1], time.perf_counter() - started
+
+    def run_query(self, connection_object: dict, query: str, **options):
+        request = dict(options, connectionObject=connection_object, query=query)
+        return asyncio.run_coroutine_threadsafe(self._query(request), self.loop).result(600)
+
+    def stop(self):
+        async def shutdown():
+            self._server.close()
+            await self._server.wait_closed()
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result(5)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def _decode_frame(frame):
+    message = dave_router._decode_incoming(frame)
+    compression = message.get("compression") if isinstance(message, dict) else None
+    if compression and "payload" in message:
+        if compression["codec"] == "zstd":
+            import zstandard
+            payload = zstandard.ZstdDecompressor().decompress(message["payload"], max_output_size=compression["raw_bytes"])
+        else:
+            import lz4.frame
+            payload = lz4.frame.decompress(message["payload"])
+        message = msgpack.unpackb(payload, raw=False)
+    return message
+
+
+def build_sqlite_fixture(directory: str, rows: int) -> dict:
+    """SQLite file with a narrow `big` table and a WIDE_COLUMNS-column `wide` table."""
+    path = os.path.join(directory, "bench.sqlite")
+    conn = sqlite3.connect(path)
+    _create_tables(conn, rows, "?")
+    conn.commit()
+    conn.close()
+    return {"dialect": "sqlite", "database": path}
+
+
+def build_duckdb_fixture(directory: str, rows: int):
+    """DuckDB file with the same tables, or None when duckdb_engine is not installed."""
+    try:
+        import duckdb
+        import duckdb_engine  # noqa: F401  (registers the duckdb:// SQLAlchemy dialect)
+    except ImportError:
+        return None
+    if "duckdb" not in dave_router._DIALECT_BUILDERS:
+        @dave_router.register_dialect_builder
+        class DuckDBBuilder(dave_router.DialectBuilder):
+            dialect = "duckdb"
+
+            def build(self, connection_object, logger):
+                return f"duckdb:///{connection_object['database']}", {}
+    path = os.path.join(directory, "bench.duckdb")
+    conn = duckdb.connect(path)
+    _create_tables(conn, rows, "?")
+    conn.close()
+    return {"dialect": "duckdb", "database": path}
+
+
+def _create_tables(conn, rows: int, placeholder: str):
+    conn.execute("CREATE TABLE big (id INTEGER, amount DOUBLE PRECISION, label VARCHAR, created VARCHAR)")
+    base = datetime.datetime(2024, 1, 1)
+    conn.executemany(
+        f"INSERT INTO big VALUES ({', '.join([placeholder] * 4)})",
+        [(i, i * 1.25, f"label-{i % 1000}", (base + datetime.timedelta(seconds=i)).isoformat()) for i in range(rows)],
+    )
+    # Rotate integer, float and text columns so conversion sees mixed types
+    kinds = ["INTEGER", "DOUBLE PRECISION", "VARCHAR"]
+    columns = [f"c{i} {kinds[i % 3]}" for i in range(WIDE_COLUMNS)]
+    conn.execute(f"CREATE TABLE wide ({', '.join(columns)})")
+    wide_rows = max(1, rows // 10)
+    values = [
+        tuple(r if i % 3 == 0 else r / 3 if i % 3 == 1 else f"v{r}-{i}" for i in range(WIDE_COLUMNS))
+        for r in range(wide_rows)
+    ]
+    conn.executemany(f"INSERT INTO wide VALUES ({', '.join([placeholder] * WIDE_COLUMNS)})", values)
+
+
+def _percentiles(samples: list) -> dict:
+    ordered = sorted(samples)
+    if not ordered:
+        return {}
+
+    def pick(p):
+        return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000, 3)
+    return {"p50_ms": pick(50), "p90_ms": pick(90), "p99_ms": pick(99), "max_ms": round(ordered[-1] * 1000, 3)}
+
+
+def bench_small_queries(backend, target, queries: int, concurrency: int) -> dict:
+    """Round trips per second for a trivial query."""
+    def one(_):
+        return backend.run_query(target, "SELECT 1")[2]
+    backend.run_query(target, "SELECT 1")  # warm the engine
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(one, range(queries)))
+    elapsed = time.perf_counter() - started
+    return dict({"queries": queries, "concurrency": concurrency, "qps": round(queries / elapsed, 1)},
+                **_percentiles(latencies))
+
+
+def bench_large_result(backend, target, rows: int, result_format: str, stream: bool) -> dict:
+    """Rows/s and MB/s for one large result, end to end."""
+    result, received, elapsed = backend.run_query(
+        target, "SELECT id, amount, label, created FROM big", result_format=result_format, stream=stream, timings=True)
+    if not result.get("success"):
+        raise RuntimeError(result.get("message"))
+    return {
+        "rows": rows,
+        "result_format": result_format,
+        "stream": stream,
+        "seconds": round(elapsed, 4),
+        "rows_per_s": round(rows / elapsed),
+        # Wire bytes, i.e. after compression when a codec was negotiated
+        "mb_per_s": round(received / elapsed / 1e6, 2),
+        "bytes": received,
+        "router_timings": result.get("timings"),
+    }
+
+
+def bench_wide_columns(backend, target, result_format: str) -> dict:
+    """Conversion cost per cell for a wide mixed-type table, from the router's own timings."""
+    result, received, elapsed = backend.run_query(target, "SELECT * FROM wide", result_format=result_format, timings=True)
+    if not result.get("success"):
+        raise RuntimeError(result.get("message"))
+    rows = result["rowcount"] if result["rowcount"] >= 0 else len(result.get("rows") or [])
+    timings = result.get("timings") or {}
+    cells = max(1, rows * WIDE_COLUMNS)
+    return {
+        "rows": rows,
+        "columns": WIDE_COLUMNS,
+        "result_format": result_format,
+        "seconds": round(elapsed, 4),
+        "convert_ns_per_cell": round(timings.get("convert_ms", 0) * 1e6 / cells, 1),
+        "fetch_ns_per_cell": round(timings.get("fetch_ms", 0) * 1e6 / cells, 1),
+        "bytes": received,
+    }
+
+
+def bench_concurrent_latency(backend, target, clients: int, per_client: int) -> dict:
+    """Latency percentiles with many clients issuing mid-sized queries at once."""
+    query = "SELECT id, amount, label FROM big LIMIT 500"
+
+    def client(_):
+        return [backend.run_query(target, query)[2] for _ in range(per_client)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        latencies = [latency for batch in pool.map(client, range(clients)) for latency in batch]
+    elapsed = time.perf_counter() - started
+    return dict({"clients": clients, "queries": len(latencies), "qps": round(len(latencies) / elapsed, 1)},
+                **_percentiles(latencies))
+
+
+def run_benchmarks(rows=200000, small_queries=2000, concurrency=8, clients=32, per_client=20,
+                   compression=None, postgres=None, scenarios=None) -> dict:
+    """Run every scenario against every available database and return the report dict."""
+    scenarios = set(scenarios or ("small_qps", "large_result", "wide_columns", "concurrent_latency"))
+    report = {"meta": _run_metadata(rows, compression), "results": {}}
+    backend = FakeBackend(compression).start()
+    session_name = f"bench-{os.getpid()}"
+    with tempfile.TemporaryDirectory() as directory:
+        targets = {"sqlite": build_sqlite_fixture(directory, rows)}
+        duckdb_target = build_duckdb_fixture(directory, rows)
+        if duckdb_target:
+            targets["duckdb"] = duckdb_target
+        if postgres:
+            targets["postgres"] = postgres
+        try:
+            dave_router.add_session(session_name, backend.url, "bench", "bench", max_concurrent=0)
+            backend.wait_connected()
+            for name, target in targets.items():
+                results = report["results"][name] = {}
+                if "small_qps" in scenarios:
+                    results["small_qps"] = bench_small_queries(backend, target, small_queries, concurrency)
+                if "large_result" in scenarios:
+                    results["large_result"] = [
+                        bench_large_result(backend, target, rows, result_format, stream)
+                        for result_format, stream in (("rows", False), ("columnar", False), ("rows", True))
+                    ]
+                if "wide_columns" in scenarios:
+                    results["wide_columns"] = [bench_wide_columns(backend, target, f) for f in ("rows", "columnar")]
+                if "concurrent_latency" in scenarios:
+                    results["concurrent_latency"] = bench_concurrent_latency(backend, target, clients, per_client)
+        finally:
+            dave_router.remove_session(session_name)
+            backend.stop()
+            dave_router._engine_cache.clear()
+            # Nothing renders the terminal while benchmarking; the UI event bus is bounded
+            dave_router.message_queue.drain()
+    return report
+
+
+def _run_metadata(rows, compression) -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "sqlalchemy": dave_router.sqlalchemy.__version__,
+        "transport": dave_router.TRANSPORT,
+        "compression": compression,
+        "rows": rows,
+    }
+
+
+def compare(current: dict, baseline: dict) -> list:
+    """Lines describing how headline numbers moved relative to a baseline report."""
+    lines = []
+    for database, results in current["results"].items():
+        before = baseline.get("results", {}).get(database, {})
+        for scenario, result in results.items():
+            old = before.get(scenario)
+            if old is None:
+                continue
+            pairs = zip(result, old) if isinstance(result, list) else [(result, old)]
+            for new_entry, old_entry in pairs:
+                for metric in ("qps", "rows_per_s", "mb_per_s", "p99_ms", "convert_ns_per_cell"):
+                    if metric in new_entry and old_entry.get(metric):
+                        change = (new_entry[metric] - old_entry[metric]) / old_entry[metric] * 100
+                        variant = new_entry.get("result_format", "") + ("/stream" if new_entry.get("stream") else "")
+                        lines.append(f"{database:8} {scenario:20} {variant:9} {metric:20} "
+                                     f"{old_entry[metric]:>12} -> {new_entry[metric]:>12} ({change:+.1f}%)")
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--output", default="dave_router_bench.json", help="where to write the JSON report")
+    parser.add_argument("--compare", help="baseline JSON report to compare against")
+    parser.add_argument("--rows", type=int, default=200000, help="rows in the large-result table")
+    parser.add_argument("--small-queries", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=8, help="in-flight queries for the QPS scenario")
+    parser.add_argument("--clients", type=int, default=32, help="concurrent clients for the latency scenario")
+    parser.add_argument("--per-client", type=int, default=20)
+    parser.add_argument("--compression", choices=["zstd", "lz4"], help="codec the fake backend accepts")
+    parser.add_argument("--postgres", help='connectionObject JSON for a local Postgres, e.g. '
+                                           '\'{"dialect": "postgresql", "host": "localhost", ...}\' '
+                                           '(needs the big/wide tables, see _create_tables)')
+    parser.add_argument("--scenario", action="append",
+                        choices=["small_qps", "large_result", "wide_columns", "concurrent_latency"])
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    report = run_benchmarks(
+        rows=args.rows, small_queries=args.small_queries, concurrency=args.concurrency,
+        clients=args.clients, per_client=args.per_client, compression=args.compression,
+        postgres=json.loads(args.postgres) if args.postgres else None, scenarios=args.scenario)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report["results"], indent=2))
+    print(f"Wrote {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            for line in compare(report, json.load(f)):
+                print(line)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -12,7 +12,18 @@ import json
 import base64
 import msgpack
 import sqlalchemy
-from dave_router import handle_sql_query
+import threading
+import decimal
+import datetime
+import asyncio
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import dave_router
+from dave_router import handle_sql_query, _QueryDispatcher
 
 
 class TestDaveRouterTunnelMode(unittest.TestCase):
@@ -22,6 +33,7 @@ class TestDaveRouterTunnelMode(unittest.TestCase):
         """Set up test fixtures."""
         self.mock_logger = MagicMock()
         self.mock_websocket = MagicMock()
+        dave_router._engine_cache.clear()
 
     @patch('dave_router.sqlalchemy.create_engine')
     @patch('dave_router.message_queue')
@@ -347,5 +359,1525 @@ class TestDaveRouterTunnelMode(unittest.TestCase):
         self.mock_logger.error.assert_called()
 
 
+class TestQueryDispatcher(unittest.TestCase):
+    """Test cases for the bounded worker pool in front of handle_sql_query."""
+
+    def _tracking_job(self, state, release):
+        def job(key):
+            with state["lock"]:
+                state["running"][key] = state["running"].get(key, 0) + 1
+                state["peak"][key] = max(state["peak"].get(key, 0), state["running"][key])
+            release.wait(2)
+            with state["lock"]:
+                state["running"][key] -= 1
+                state["done"] += 1
+        return job
+
+    def _wait_for(self, predicate):
+        deadline = time.time() + 2
+        while time.time() < deadline and not predicate():
+            time.sleep(0.01)
+
+    def test_per_key_limit(self):
+        """A single connection key never exceeds its concurrency limit."""
+        dispatcher = _QueryDispatcher(max_workers=4, per_key_limit=1, max_pending=10)
+        state = {"lock": threading.Lock(), "running": {}, "peak": {}, "done": 0}
+        release = threading.Event()
+        job = self._tracking_job(state, release)
+        for _ in range(3):
+            self.assertTrue(dispatcher.submit("snowflake", job, "snowflake"))
+        self.assertTrue(dispatcher.submit("postgres", job, "postgres"))
+
+        # The other key runs alongside the busy one
+        self._wait_for(lambda: state["running"].get("postgres") == 1)
+        self.assertEqual(state["running"].get("postgres"), 1)
+        self.assertEqual(state["running"].get("snowflake"), 1)
+
+        release.set()
+        self._wait_for(lambda: state["done"] == 4)
+        self.assertEqual(state["done"], 4)
+        self.assertEqual(state["peak"]["snowflake"], 1)
+        self.assertEqual(dispatcher.stats()["running"], 0)
+
+    def test_rejects_when_saturated(self):
+        """Requests beyond max_pending are rejected instead of queued."""
+        dispatcher = _QueryDispatcher(max_workers=1, per_key_limit=1, max_pending=1)
+        release = threading.Event()
+        self.assertTrue(dispatcher.submit("k", release.wait, 2))
+        self._wait_for(lambda: dispatcher.stats()["pending"] == 0)
+        self.assertTrue(dispatcher.submit("k", release.wait, 2))
+        self.assertFalse(dispatcher.submit("k", release.wait, 2))
+        release.set()
+
+
+def _sqlite_engine(row_count):
+    """Return an in-memory SQLite engine holding a numbers table with row_count rows."""
+    engine = sqlalchemy.create_engine(
+        "sqlite://", poolclass=sqlalchemy.pool.StaticPool, connect_args={"check_same_thread": False})
+    with engine.begin() as conn:
+        conn.execute(sqlalchemy.text("CREATE TABLE numbers (n INTEGER, label TEXT)"))
+        if not row_count:
+            return engine
+        conn.execute(
+            sqlalchemy.text("INSERT INTO numbers VALUES (:n, :label)"),
+            [{"n": i, "label": f"row {i}"} for i in range(row_count)],
+        )
+    return engine
+
+
+class TestStreamingResults(unittest.TestCase):
+    """Test cases for chunked result delivery."""
+
+    def setUp(self):
+        dave_router._engine_cache.clear()
+        self.sent = []
+
+    def _run(self, data, engine):
+        with patch('dave_router.sqlalchemy.create_engine', return_value=engine), \
+                patch('dave_router.message_queue'), \
+                patch('dave_router.send_message', side_effect=self.sent.append):
+            handle_sql_query(data, MagicMock())
+
+    def test_stream_sends_numbered_chunks_then_summary(self):
+        """Rows arrive as sequenced chunk frames followed by a summary frame."""
+        data = {
+            "connectionObject": {"dialect": "sqlite", "database": "stream_test"},
+            "query": "SELECT n, label FROM numbers ORDER BY n",
+            "request_id": "stream_id",
+            "stream": True,
+            "chunk_rows": 4,
+        }
+        self._run(data, _sqlite_engine(10))
+
+        chunks = [m for m in self.sent if m["type"] == "sql-query-result-chunk"]
+        self.assertEqual([c["seq"] for c in chunks], [0, 1, 2])
+        self.assertEqual([len(c["rows"]) for c in chunks], [4, 4, 2])
+        self.assertEqual(chunks[0]["keys"], ["n", "label"])
+        self.assertEqual(chunks[2]["rows"][-1], [9, "row 9"])
+
+        summary = self.sent[-1]
+        self.assertEqual(summary["type"], "sql-query-result")
+        self.assertTrue(summary["success"])
+        self.assertTrue(summary["streamed"])
+        self.assertEqual(summary["chunks"], 3)
+        self.assertEqual(summary["rowcount"], 10)
+        self.assertEqual(summary["rows"], [])
+
+    def test_non_stream_returns_single_frame(self):
+        """Without the stream flag the whole result is sent in one frame."""
+        data = {
+            "connectionObject": {"dialect": "sqlite", "database": "single_test"},
+            "query": "SELECT n FROM numbers ORDER BY n",
+            "request_id": "single_id",
+        }
+        self._run(data, _sqlite_engine(3))
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(self.sent[0]["rows"], [[0], [1], [2]])
+
+
+class TestFrameEncoding(unittest.TestCase):
+    """Test cases for binary/base64 frame negotiation."""
+
+    def test_send_binary_frame_when_negotiated(self):
+        """Negotiated sessions send raw MessagePack in a binary frame."""
+        mock_ws = MagicMock()
+        with patch('dave_router.ws_connection', mock_ws), patch('dave_router.binary_frames_enabled', True):
+            dave_router.send_message({"type": "sql-query-result", "rows": [[1]]})
+        frame = mock_ws.send.call_args[0][0]
+        self.assertEqual(mock_ws.send.call_args[1]["opcode"], dave_router.websocket.ABNF.OPCODE_BINARY)
+        self.assertEqual(msgpack.unpackb(frame, raw=False)["rows"], [[1]])
+
+    def test_send_base64_text_for_old_servers(self):
+        """Without negotiation the legacy base64 text frame is used."""
+        mock_ws = MagicMock()
+        with patch('dave_router.ws_connection', mock_ws), patch('dave_router.binary_frames_enabled', False):
+            dave_router.send_message({"type": "sql-query-result", "rows": [[1]]})
+        frame = mock_ws.send.call_args[0][0]
+        self.assertEqual(mock_ws.send.call_args[1]["opcode"], dave_router.websocket.ABNF.OPCODE_TEXT)
+        self.assertEqual(msgpack.unpackb(base64.b64decode(frame), raw=False)["rows"], [[1]])
+
+    def test_decode_incoming_formats(self):
+        """Binary MessagePack, base64 MessagePack and JSON messages all decode."""
+        message = {"type": "sql-query", "query": "SELECT 1"}
+        packed = msgpack.packb(message, use_bin_type=True)
+        self.assertEqual(dave_router._decode_incoming(packed), message)
+        self.assertEqual(dave_router._decode_incoming(base64.b64encode(packed).decode('utf-8')), message)
+        self.assertEqual(dave_router._decode_incoming(json.dumps(message)), message)
+
+
+class TestColumnarResults(unittest.TestCase):
+    """Test cases for the column-major result format."""
+
+    def setUp(self):
+        dave_router._engine_cache.clear()
+
+    def test_columnar_response_from_cursor(self):
+        """Columns carry a type tag and packed typed arrays with validity bitmaps."""
+        engine = _sqlite_engine(3)
+        sent = []
+        data = {
+            "connectionObject": {"dialect": "sqlite", "database": "columnar_test"},
+            "query": "SELECT n, label, CASE WHEN n = 1 THEN NULL ELSE n * 0.5 END AS half FROM numbers ORDER BY n",
+            "request_id": "columnar_id",
+            "result_format": "columnar",
+        }
+        with patch('dave_router.sqlalchemy.create_engine', return_value=engine), \
+                patch('dave_router.message_queue'), \
+                patch('dave_router.send_message', side_effect=sent.append):
+            handle_sql_query(data, MagicMock())
+
+        response = sent[0]
+        self.assertTrue(response["success"])
+        self.assertEqual(response["result_format"], "columnar")
+        self.assertEqual(response["rowcount"], 3)
+        n, label, half = response["columns"]
+        self.assertEqual(n["type"], "int64")
+        self.assertEqual(list(memoryview(n["data"]).cast("q")), [0, 1, 2])
+        self.assertNotIn("validity", n)
+        self.assertEqual(label, {"name": "label", "type": "string", "data": ["row 0", "row 1", "row 2"]})
+        self.assertEqual(half["type"], "float64")
+        self.assertEqual(list(memoryview(half["data"]).cast("d")), [0.0, 0.0, 1.0])
+        self.assertEqual(half["validity"], bytes([0b101]))
+
+    def test_encode_temporal_and_mixed_columns(self):
+        """Temporal columns become epoch vectors; mixed columns fall back to object."""
+        import datetime
+        ts = dave_router._encode_column("ts", [datetime.datetime(1970, 1, 1, 0, 0, 1), None])
+        self.assertEqual(ts["type"], "timestamp_us")
+        self.assertEqual(list(memoryview(ts["data"]).cast("q")), [1000000, 0])
+        day = dave_router._encode_column("day", [datetime.date(1970, 1, 11)])
+        self.assertEqual((day["type"], list(memoryview(day["data"]).cast("i"))), ("date32", [10]))
+        mixed = dave_router._encode_column("mixed", [1, "a"])
+        self.assertEqual((mixed["type"], mixed["data"]), ("object", [1, "a"]))
+        flags = dave_router._encode_column("flags", [True, 5, None])
+        self.assertEqual((flags["type"], flags["data"]), ("object", [True, 5, None]))
+
+
+@unittest.skipIf(dave_router._load_pyarrow() is None, "pyarrow is not installed")
+class TestArrowResults(unittest.TestCase):
+    """Test cases for the Arrow IPC fast path."""
+
+    def setUp(self):
+        dave_router._engine_cache.clear()
+
+    def _run(self, data, cursor):
+        mock_engine = MagicMock()
+        mock_result = mock_engine.connect.return_value.__enter__.return_value.execute.return_value
+        mock_result.returns_rows = True
+        mock_result.keys.return_value = ["n"]
+        mock_result.cursor = cursor
+        sent = []
+        with patch('dave_router.sqlalchemy.create_engine', return_value=mock_engine), \
+                patch('dave_router.message_queue'), \
+                patch('dave_router.send_message', side_effect=sent.append):
+            handle_sql_query(data, MagicMock())
+        return mock_result, sent
+
+    def test_snowflake_arrow_batches_sent_as_ipc(self):
+        """Snowflake Arrow batches are forwarded as IPC bytes without fetching rows."""
+        import pyarrow
+        cursor = MagicMock()
+        cursor.fetch_arrow_batches.return_value = iter([pyarrow.table({"n": [1, 2]}), pyarrow.table({"n": [3]})])
+        data = {
+            "connectionObject": {"dialect": "snowflake", "user": "u", "password": "p", "host": "acct", "database": "db"},
+            "query": "SELECT n FROM t",
+            "request_id": "arrow_id",
+            "result_format": "arrow",
+        }
+        mock_result, sent = self._run(data, cursor)
+
+        response = sent[0]
+        self.assertTrue(response["success"])
+        self.assertEqual(response["result_format"], "arrow")
+        self.assertEqual(response["rowcount"], 3)
+        table = pyarrow.ipc.open_stream(response["arrow_ipc"]).read_all()
+        self.assertEqual(table.column("n").to_pylist(), [1, 2, 3])
+        mock_result.fetchall.assert_not_called()
+
+    def test_arrow_batches_trimmed_to_max_rows(self):
+        """Arrow batches are sliced at max_rows without converting rows."""
+        import pyarrow
+        limits = dave_router._ResultLimits(max_rows=3)
+        batches = [pyarrow.record_batch({"n": [1, 2]}), pyarrow.record_batch({"n": [3, 4]}), pyarrow.record_batch({"n": [5]})]
+        kept = list(dave_router._limit_arrow_batches(iter(batches), limits))
+        self.assertEqual([b.num_rows for b in kept], [2, 1])
+        self.assertTrue(limits.truncated)
+
+    def test_other_dialects_use_generic_path(self):
+        """Dialects without native Arrow support fall back to rows."""
+        data = {
+            "connectionObject": {"dialect": "mysql", "user": "u", "password": "p", "host": "h", "port": "3306", "database": "db"},
+            "query": "SELECT 1",
+            "request_id": "fallback_id",
+            "result_format": "arrow",
+        }
+        mock_result, sent = self._run(data, MagicMock())
+        self.assertNotIn("arrow_ipc", sent[0])
+        mock_result.fetchall.assert_called_once()
+
+
+class TestCompression(unittest.TestCase):
+    """Test cases for negotiated payload compression."""
+
+    def _send(self, message, codec):
+        mock_ws = MagicMock()
+        with patch('dave_router.ws_connection', mock_ws), \
+                patch('dave_router.binary_frames_enabled', True), \
+                patch('dave_router.compression_codec', codec):
+            dave_router.send_message(message)
+        return msgpack.unpackb(mock_ws.send.call_args[0][0], raw=False)
+
+    def test_large_payload_compressed_with_metadata(self):
+        """Payloads above the threshold are wrapped in a compressed envelope."""
+        codec = (dave_router._available_codecs() or [None])[0]
+        if codec is None:
+            self.skipTest("no compression codec installed")
+        message = {"type": "sql-query-result", "request_id": "big", "rows": [["same value"]] * 5000}
+        envelope = self._send(message, codec)
+        self.assertEqual(envelope["type"], "sql-query-result")
+        self.assertEqual(envelope["request_id"], "big")
+        self.assertEqual(envelope["compression"]["codec"], codec)
+        self.assertGreater(envelope["compression"]["ratio"], 1)
+        if codec == "zstd":
+            import zstandard
+            raw = zstandard.ZstdDecompressor().decompress(envelope["payload"])
+        else:
+            import lz4.frame
+            raw = lz4.frame.decompress(envelope["payload"])
+        self.assertEqual(msgpack.unpackb(raw, raw=False), message)
+
+    def test_small_payload_left_uncompressed(self):
+        """Scalar-sized results skip compression."""
+        message = {"type": "sql-query-result", "request_id": "small", "scalar_result": 1}
+        self.assertEqual(self._send(message, "zstd"), message)
+
+
+class TestEngineCache(unittest.TestCase):
+    """Test cases for the bounded engine cache."""
+
+    def setUp(self):
+        self.logger = MagicMock()
+        self.cache = dave_router._EngineCache(max_engines=2, idle_ttl=60, sweep_interval=0.05)
+
+    def _wait_disposed(self, engine):
+        deadline = time.time() + 2
+        while time.time() < deadline and not engine.dispose.called:
+            time.sleep(0.01)
+        engine.dispose.assert_called_once()
+
+    def test_lru_eviction_disposes_pool(self):
+        """Exceeding max_engines evicts and disposes the least recently used engine."""
+        engines = {key: MagicMock(name=key) for key in ("a", "b", "c")}
+        self.cache.get_or_create("a", lambda: engines["a"], self.logger)
+        self.cache.get_or_create("b", lambda: engines["b"], self.logger)
+        # Touch "a" so "b" becomes least recently used
+        self.assertIs(self.cache.get_or_create("a", MagicMock(), self.logger), engines["a"])
+        self.cache.get_or_create("c", lambda: engines["c"], self.logger)
+
+        self.assertEqual(len(self.cache), 2)
+        self._wait_disposed(engines["b"])
+        engines["a"].dispose.assert_not_called()
+        self.assertEqual(self.cache.stats(), {"engines": 2, "hits": 1, "misses": 3, "evictions": 1})
+
+    def test_idle_engines_evicted(self):
+        """Engines unused for longer than idle_ttl are evicted by the janitor."""
+        engine = MagicMock()
+        self.cache.idle_ttl = 0
+        self.cache.get_or_create("idle", lambda: engine, self.logger)
+        self._wait_disposed(engine)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_concurrent_misses_share_one_build(self):
+        """Concurrent first lookups for a key run the factory once."""
+        started = threading.Event()
+        release = threading.Event()
+        engine = MagicMock()
+        factory = MagicMock(side_effect=lambda: (started.set(), release.wait(2), engine)[2])
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.cache.get_or_create("k", factory, self.logger)))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        started.wait(2)
+        release.set()
+        for thread in threads:
+            thread.join(2)
+        factory.assert_called_once()
+        self.assertEqual(results, [engine] * 4)
+
+    def test_slow_build_does_not_block_other_keys(self):
+        """A key stuck in engine creation leaves other keys' lookups unblocked."""
+        ready = MagicMock()
+        self.cache.get_or_create("ready", lambda: ready, self.logger)
+        started = threading.Event()
+        release = threading.Event()
+        slow = threading.Thread(target=self.cache.get_or_create,
+                                args=("slow", lambda: (started.set(), release.wait(2), MagicMock())[2], self.logger))
+        slow.start()
+        started.wait(2)
+        try:
+            begin = time.monotonic()
+            self.assertIs(self.cache.get_or_create("ready", MagicMock(), self.logger), ready)
+            other = self.cache.get_or_create("other", MagicMock, self.logger)
+            self.assertIsNotNone(other)
+            self.assertLess(time.monotonic() - begin, 0.5)
+        finally:
+            release.set()
+            slow.join(2)
+
+    @patch('dave_router.sqlalchemy.create_engine')
+    def test_pool_settings_per_dialect(self, mock_create_engine):
+        """Pool sizing comes from the dialect's ENGINE_POOL_SETTINGS entry."""
+        dave_router._engine_cache.clear()
+        dave_router._get_or_create_engine("snowflake://u:p@acct/db", {}, "pool-key", self.logger, "snowflake")
+        kwargs = mock_create_engine.call_args[1]
+        self.assertEqual(kwargs["pool_size"], dave_router.ENGINE_POOL_SETTINGS["snowflake"]["pool_size"])
+        self.assertEqual(kwargs["max_overflow"], dave_router.ENGINE_POOL_SETTINGS["snowflake"]["max_overflow"])
+        dave_router._engine_cache.clear()
+
+
+class TestConnectionTargetRegistry(unittest.TestCase):
+    """Test cases for compiled connection targets and pluggable dialect builders."""
+
+    def setUp(self):
+        self.logger = MagicMock()
+        self.registry = dave_router._TargetRegistry(max_targets=2)
+
+    def test_repeated_objects_reuse_compiled_target(self):
+        """Equal connectionObjects are compiled once and served from the registry."""
+        connection = {"dialect": "mysql", "user": "u", "password": "p", "host": "h", "port": "3306", "database": "db"}
+        with patch.object(dave_router._DIALECT_BUILDERS["mysql"], "build", wraps=dave_router._DIALECT_BUILDERS["mysql"].build) as build:
+            first = self.registry.resolve(dict(connection), self.logger)
+            second = self.registry.resolve(dict(connection), self.logger)
+        self.assertIs(first, second)
+        build.assert_called_once()
+        self.assertEqual(first.url, "mysql+pymysql://u:p@h:3306/db")
+        self.assertEqual(first.key, dave_router._connection_key_from_object(connection))
+
+    def test_schema_lists_produce_distinct_keys(self):
+        """Different PostgreSQL search paths never share an engine."""
+        base = {"dialect": "postgresql", "user": "u", "password": "p", "host": "h", "port": "5432", "database": "db"}
+        sales = self.registry.resolve({**base, "schemas": ["sales"]}, self.logger)
+        marketing = self.registry.resolve({**base, "schemas": ["marketing"]}, self.logger)
+        self.assertNotEqual(sales.key, marketing.key)
+
+    def test_registered_builder_is_used(self):
+        """Custom dialects plug in through register_dialect_builder."""
+        @dave_router.register_dialect_builder
+        class DuckBuilder(dave_router.DialectBuilder):
+            dialect = "duck"
+
+            def build(self, connection_object, logger):
+                return f"duckdb:///{connection_object['database']}", {"read_only": True}
+
+        try:
+            target = self.registry.resolve({"dialect": "duck", "database": "local.db"}, self.logger)
+            self.assertEqual((target.url, target.connect_args), ("duckdb:///local.db", {"read_only": True}))
+        finally:
+            del dave_router._DIALECT_BUILDERS["duck"]
+
+
+class TestResultCache(unittest.TestCase):
+    """Test cases for the opt-in query result cache."""
+
+    def setUp(self):
+        dave_router._engine_cache.clear()
+        dave_router._result_cache.clear()
+        self.sent = []
+
+    def _run(self, engine, query, request_id, **extra):
+        data = {
+            "connectionObject": {"dialect": "sqlite", "database": "cache_test"},
+            "query": query,
+            "request_id": request_id,
+            "cache": True,
+            **extra,
+        }
+        with patch('dave_router.sqlalchemy.create_engine', return_value=engine), \
+                patch('dave_router.message_queue'), \
+                patch('dave_router._send_packed', side_effect=lambda packed, *args: self.sent.append(msgpack.unpackb(packed, raw=False))):
+            handle_sql_query(data, MagicMock())
+        return self.sent[-1]
+
+    def test_repeated_read_only_query_served_from_cache(self):
+        """A repeated SELECT returns the cached bytes with the new request_id."""
+        engine = _sqlite_engine(2)
+        before = dave_router._result_cache.stats()
+        first = self._run(engine, "SELECT count(*) FROM numbers", "first")
+        with engine.begin() as conn:
+            conn.execute(sqlalchemy.text("INSERT INTO numbers VALUES (99, 'late')"))
+        second = self._run(engine, "SELECT  count(*)\nFROM numbers;", "second")
+
+        self.assertEqual(first["request_id"], "first")
+        self.assertNotIn("cached", first)
+        self.assertEqual(second["request_id"], "second")
+        self.assertTrue(second["cached"])
+        self.assertEqual(second["rows"], first["rows"])
+        stats = dave_router._result_cache.stats()
+        self.assertEqual((stats["hits"] - before["hits"], stats["misses"] - before["misses"]), (1, 1))
+
+    def test_cache_ttl_is_validated(self):
+        """String TTLs are coerced, junk falls back to the router TTL and negatives are rejected."""
+        engine = _sqlite_engine(2)
+        self.assertTrue(self._run(engine, "SELECT n FROM numbers", "ttl-string", cache_ttl="60")["success"])
+        self.assertTrue(self._run(engine, "SELECT n FROM numbers", "ttl-cached", cache_ttl="60")["cached"])
+        self.assertTrue(self._run(engine, "SELECT count(*) FROM numbers", "ttl-junk", cache_ttl="soon")["success"])
+        rejected = self._run(engine, "SELECT n, label FROM numbers", "ttl-negative", cache_ttl=-1)
+        self.assertFalse(rejected["success"])
+        self.assertIn("cache_ttl", rejected["message"])
+        self.assertNotIn((None, "ttl-negative"), dave_router._active_queries)
+
+    def test_writes_are_never_cached(self):
+        """Statements that are not read-only bypass the cache."""
+        self.assertIsNone(dave_router._ResultCache.make_key("k", "DELETE FROM numbers", None, "rows"))
+        self.assertIsNone(dave_router._ResultCache.make_key("k", "SELECT 1; DROP TABLE numbers", None, "rows"))
+        self.assertIsNotNone(dave_router._ResultCache.make_key("k", "SELECT 'delete me'", None, "rows"))
+        for query in (
+            "select nextval('s')",
+            "select setval('s', 1)",
+            "select pg_advisory_lock(1)",
+            "SELECT pg_advisory_unlock_all()",
+            "SELECT lo_unlink(1)",
+            "select pg_terminate_backend(42)",
+            "select pg_cancel_backend (42)",
+            "SELECT SYSTEM$CANCEL_ALL_QUERIES(1)",
+        ):
+            self.assertIsNone(dave_router._ResultCache.make_key("k", query, None, "rows"), query)
+        self.assertIsNotNone(dave_router._ResultCache.make_key("k", "SELECT 'nextval(1)', lock_id FROM t", None, "rows"))
+
+    def test_byte_budget_evicts_least_recently_used(self):
+        """Entries are evicted oldest-first once max_bytes is exceeded."""
+        cache = dave_router._ResultCache(max_bytes=10, default_ttl=60)
+        cache.put("a", b"12345")
+        cache.put("b", b"12345")
+        cache.get("a")
+        cache.put("c", b"12345")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), b"12345")
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_splice_map_adds_entries(self):
+        """Spliced entries appear alongside the packed body's own entries."""
+        body = msgpack.packb({"k%d" % i: i for i in range(20)})
+        spliced = dave_router._splice_map(body, {"request_id": "r"})
+        self.assertEqual(msgpack.unpackb(spliced, raw=False), {"request_id": "r", **{"k%d" % i: i for i in range(20)}})
+
+
+class TestQueryCancellation(unittest.TestCase):
+    """Test cases for sql-query-cancel and timeout_ms."""
+
+    SLOW_QUERY = ("WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < 500000000) "
+                  "SELECT count(*) FROM c")
+
+    def setUp(self):
+        dave_router._engine_cache.clear()
+        self.sent = []
+
+    def _run(self, data):
+        with patch('dave_router.sqlalchemy.create_engine', return_value=_sqlite_engine(0)), \
+                patch('dave_router.message_queue'), \
+                patch('dave_router.send_message', side_effect=self.sent.append):
+            handle_sql_query(data, MagicMock())
+        return self.sent[-1]
+
+    def _data(self, request_id, **extra):
+        return {
+            "connectionObject": {"dialect": "sqlite", "database": "cancel_test"},
+            "query": self.SLOW_QUERY,
+            "request_id": request_id,
+            **extra,
+        }
+
+    def test_timeout_interrupts_running_query(self):
+        """The watchdog stops a query that exceeds timeout_ms."""
+        begin = time.monotonic()
+        response = self._run(self._data("slow", timeout_ms=200))
+        self.assertLess(time.monotonic() - begin, 5)
+        self.assertFalse(response["success"])
+        self.assertTrue(response["timed_out"])
+        self.assertNotIn((None, "slow"), dave_router._active_queries)
+
+    def test_cancel_running_query(self):
+        """sql-query-cancel stops a running statement through the driver."""
+        def cancel_when_running():
+            deadline = time.time() + 5
+            while time.time() < deadline:
+                handle = dave_router._active_queries.get((None, "running"))
+                if handle is not None and handle.dbapi_connection is not None:
+                    time.sleep(0.05)
+                    dave_router.cancel_query("running", MagicMock())
+                    return
+                time.sleep(0.01)
+        canceller = threading.Thread(target=cancel_when_running)
+        canceller.start()
+        response = self._run(self._data("running"))
+        canceller.join()
+        self.assertFalse(response["success"])
+        self.assertTrue(response["cancelled"])
+
+    def test_cancel_before_start_skips_execution(self):
+        """A query cancelled while queued never reaches the database."""
+        dave_router._register_query("queued")
+        self.assertTrue(dave_router.cancel_query("queued", MagicMock()))
+        with patch('dave_router._get_or_create_engine') as get_engine:
+            response = self._run(self._data("queued"))
+        get_engine.assert_not_called()
+        self.assertTrue(response["cancelled"])
+        self.assertFalse(dave_router.cancel_query("queued", MagicMock()))
+
+    def test_side_channel_cancel_bypasses_busy_pool(self):
+        """Snowflake/MySQL cancels connect outside the query's pool, which may be exhausted."""
+        pool_engine = sqlalchemy.create_engine(
+            "sqlite:///" + os.path.join(tempfile.mkdtemp(), "busy.db"),
+            poolclass=sqlalchemy.pool.QueuePool, pool_size=1, max_overflow=0, pool_timeout=0.1)
+        handle = dave_router._QueryHandle("busy")
+        handle.engine, handle.connect_args = pool_engine, {}
+        handle.dbapi_connection = MagicMock(session_id=42)
+        with pool_engine.connect():
+            cancel_engine = dave_router._cancel_engine(handle)
+            self.assertIsInstance(cancel_engine.pool, sqlalchemy.pool.NullPool)
+            self.assertIs(dave_router._cancel_engine(handle), cancel_engine)
+            with patch.object(sqlalchemy.engine.Connection, "exec_driver_sql") as execute:
+                self.assertTrue(dave_router.SnowflakeBuilder().cancel(handle, MagicMock()))
+            execute.assert_called_once_with("SELECT SYSTEM$CANCEL_ALL_QUERIES(42)")
+
+    def test_connection_is_held_until_cancel_is_issued(self):
+        """The query cannot release its connection while a cancel for it is in flight."""
+        handle = dave_router._register_query("held")
+        issuing, release = threading.Event(), threading.Event()
+        handle.builder = MagicMock()
+        handle.builder.cancel.side_effect = lambda h, logger: issuing.set() or release.wait(5)
+        handle.dbapi_connection = object()
+        canceller = threading.Thread(target=dave_router.cancel_query, args=("held", MagicMock()))
+        canceller.start()
+        try:
+            self.assertTrue(issuing.wait(5))
+            self.assertFalse(handle.cancel_lock.acquire(timeout=0.1))
+        finally:
+            release.set()
+            canceller.join()
+            dave_router._unregister_query("held")
+        self.assertTrue(handle.cancel_lock.acquire(timeout=1))
+
+    def test_postgres_timeout_is_transaction_scoped(self):
+        """PostgreSQL gets SET LOCAL statement_timeout before the query."""
+        conn = MagicMock()
+        dave_router.PostgresBuilder().apply_timeout(conn, 1500)
+        conn.exec_driver_sql.assert_called_once_with("SET LOCAL statement_timeout = 1500")
+
+
+class TestResultLimits(unittest.TestCase):
+    """Test cases for max_rows/max_bytes enforcement."""
+
+    def setUp(self):
+        dave_router._engine_cache.clear()
+        self.sent = []
+
+    def _run(self, **extra):
+        data = {
+            "connectionObject": {"dialect": "sqlite", "database": "limits_test"},
+            "query": "SELECT n, label FROM numbers ORDER BY n",
+            "request_id": "limits_id",
+            **extra,
+        }
+        with patch('dave_router.sqlalchemy.create_engine', return_value=_sqlite_engine(50)), \
+                patch('dave_router.message_queue'), \
+                patch('dave_router.send_message', side_effect=self.sent.append):
+            handle_sql_query(data, MagicMock())
+        return self.sent[-1]
+
+    def test_max_rows_truncates(self):
+        """Fetching stops at max_rows and the response is flagged truncated."""
+        response = self._run(max_rows=10, chunk_rows=4)
+        self.assertTrue(response["success"])
+        self.assertEqual(response["rowcount"], 10)
+        self.assertEqual(response["rows"][-1], [9, "row 9"])
+        self.assertTrue(response["truncated"])
+
+    def test_exact_fit_is_not_truncated(self):
+        """A result that exactly fills max_rows is complete."""
+        response = self._run(max_rows=50)
+        self.assertEqual(response["rowcount"], 50)
+        self.assertFalse(response["truncated"])
+
+    def test_negative_limits_mean_unlimited(self):
+        """max_rows/max_bytes below zero are treated like 0, not as an empty budget."""
+        response = self._run(max_rows=-5, max_bytes=-1)
+        self.assertTrue(response["success"])
+        self.assertEqual(len(response["rows"]), 50)
+        self.assertFalse(response["truncated"])
+
+    def test_malformed_numeric_fields_get_an_error_response(self):
+        """Bad numeric fields fail the request with a response instead of killing the worker."""
+        for field in ("max_rows", "max_bytes", "timeout_ms", "chunk_rows"):
+            with self.subTest(field=field):
+                response = self._run(**{field: "lots"})
+                self.assertFalse(response["success"])
+                self.assertIn(field, response["message"])
+                self.assertNotIn((None, "limits_id"), dave_router._active_queries)
+
+    def test_max_bytes_truncates(self):
+        """max_bytes bounds the estimated size of returned rows."""
+        response = self._run(max_bytes=100)
+        self.assertTrue(response["truncated"])
+        self.assertGreater(response["rowcount"], 0)
+        self.assertLess(response["rowcount"], 50)
+        self.assertLessEqual(sum(dave_router._estimate_row_bytes(row) for row in response["rows"]), 100)
+
+    def test_limits_apply_to_columnar_and_stream(self):
+        """Columnar and streamed results honour the same budget."""
+        columnar = self._run(max_rows=5, result_format="columnar")
+        self.assertEqual((columnar["rowcount"], columnar["truncated"]), (5, True))
+        self.sent.clear()
+        summary = self._run(max_rows=7, stream=True, chunk_rows=3)
+        chunks = [m for m in self.sent if m["type"] == "sql-query-result-chunk"]
+        self.assertEqual([len(c["rows"]) for c in chunks], [3, 3, 1])
+        self.assertEqual((summary["rowcount"], summary["truncated"]), (7, True))
+
+
+class _FakeSocket:
+    """Scripted websocket-client connection: recv() pops replies, a callable reply is raised or run."""
+
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.sent = []
+        self.closed = False
+
+    def send(self, frame, opcode=None):
+        self.sent.append(frame)
+
+    def recv(self):
+        reply = self.replies.pop(0) if self.replies else dave_router.websocket.WebSocketConnectionClosedException("closed")
+        if isinstance(reply, Exception):
+            raise reply
+        if callable(reply):
+            return reply()
+        return json.dumps(reply) if isinstance(reply, dict) else reply
+
+    def ping(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class TestReconnect(unittest.TestCase):
+    def setUp(self):
+        self.events = []
+        queue_patch = patch('dave_router.message_queue')
+        self.addCleanup(queue_patch.stop)
+        queue_patch.start().put.side_effect = self.events.append
+        for name, value in (("RECONNECT_BASE_DELAY", 0), ("RECONNECT_MAX_DELAY", 0)):
+            setting = patch.object(dave_router, name, value)
+            setting.start()
+            self.addCleanup(setting.stop)
+
+    def test_backoff_is_capped_and_jittered(self):
+        """Delays grow exponentially, never exceed the cap and never drop below half of it."""
+        with patch.object(dave_router, "RECONNECT_BASE_DELAY", 1), patch.object(dave_router, "RECONNECT_MAX_DELAY", 60):
+            for attempt, expected in ((0, 1), (3, 8), (10, 60)):
+                delay = dave_router._backoff_delay(attempt)
+                self.assertGreaterEqual(delay, expected / 2)
+                self.assertLessEqual(delay, expected)
+
+    def test_resume_buffer_is_bounded_and_acked(self):
+        """Acked frames are dropped and the oldest frames go first when over budget."""
+        buffer = dave_router._ResumeBuffer(max_bytes=10)
+        buffer.add("a", b"12345")
+        buffer.add("b", b"12345")
+        buffer.ack("a")
+        buffer.add("c", b"123456")
+        self.assertEqual([rid for rid, _ in buffer.pending()], ["c"])
+
+    def test_reconnects_and_resends_unacked_results(self):
+        """A dropped session is resumed with fresh credentials and unacked results are re-sent."""
+        stop = threading.Event()
+        login = {"success": True, "session_id": "s1", "capabilities": {"binary_frames": True, "acks": True}}
+
+        def deliver_result():
+            dave_router.send_message({"type": "sql-query-result", "request_id": "r1", "rows": []})
+            raise dave_router.websocket.WebSocketConnectionClosedException("dropped")
+
+        def stop_tunnel():
+            stop.set()
+            raise dave_router.websocket.WebSocketConnectionClosedException("closed")
+
+        first = _FakeSocket([login, deliver_result])
+        second = _FakeSocket([dict(login, resumed=True, acked=[]), stop_tunnel])
+        tokens = iter(["fresh-token"])
+        with patch('dave_router.websocket.create_connection', side_effect=[first, second]):
+            dave_router.ws_thread("ws://backend", id_token="old-token", token_provider=lambda: next(tokens), stop_event=stop)
+
+        relogin = json.loads(second.sent[0])
+        self.assertEqual(relogin["id_token"], "fresh-token")
+        self.assertEqual(relogin["resume"], {"session_id": "s1", "pending": ["r1"]})
+        resent = msgpack.unpackb(second.sent[1], raw=False)
+        self.assertEqual(resent["request_id"], "r1")
+        types = [e["type"] for e in self.events]
+        self.assertEqual(types, ["connected", "reconnecting", "connected", "disconnected"])
+        self.assertIsNone(dave_router.ws_connection)
+
+    def test_new_session_drops_the_old_sessions_results(self):
+        """A login that is not resumed starts clean: nothing from the dead session is listed or re-sent."""
+        stop = threading.Event()
+        login = {"success": True, "session_id": "s1", "capabilities": {"binary_frames": True, "acks": True}}
+
+        def deliver_result():
+            dave_router.send_message({"type": "sql-query-result", "request_id": "r1", "rows": []})
+            raise dave_router.websocket.WebSocketConnectionClosedException("dropped")
+
+        def stop_tunnel():
+            stop.set()
+            raise dave_router.websocket.WebSocketConnectionClosedException("closed")
+
+        first = _FakeSocket([login, deliver_result])
+        second = _FakeSocket([dict(login, session_id="s2")])
+        third = _FakeSocket([dict(login, session_id="s2", resumed=True, acked=[]), stop_tunnel])
+        with patch('dave_router.websocket.create_connection', side_effect=[first, second, third]):
+            dave_router.ws_thread("ws://backend", "user", "pw", stop_event=stop)
+
+        self.assertEqual(len(second.sent), 1)
+        self.assertEqual(json.loads(third.sent[0])["resume"], {"session_id": "s2", "pending": []})
+        self.assertEqual(len(third.sent), 1)
+
+    def test_browser_token_provider_awaits_on_the_ui_loop(self):
+        """The Google token refresh awaits NiceGUI's AwaitableResponse on the UI loop, not the session thread."""
+        from nicegui import core
+        from nicegui.awaitable_response import AwaitableResponse
+
+        async def main():
+            loop = asyncio.get_running_loop()
+            calls = []
+
+            def run_javascript(code, timeout):
+                calls.append((code, timeout, asyncio.get_running_loop()))
+
+                async def wait_for_result():
+                    return "fresh-token"
+                return AwaitableResponse(lambda: None, wait_for_result)
+
+            client = MagicMock(run_javascript=run_javascript)
+            with patch.object(core, "loop", loop):
+                token = await asyncio.to_thread(dave_router._browser_token_provider(client, loop))
+            return token, calls, loop
+
+        token, calls, loop = asyncio.run(main())
+        self.assertEqual(token, "fresh-token")
+        self.assertEqual(calls, [("firebase.auth().currentUser.getIdToken(true)", 10, loop)])
+
+    def test_rejected_login_is_not_retried(self):
+        """Bad credentials end the supervisor instead of looping."""
+        socket = _FakeSocket([{"success": False, "message": "bad password"}])
+        with patch('dave_router.websocket.create_connection', return_value=socket) as connect:
+            dave_router.ws_thread("ws://backend", "user", "wrong", stop_event=threading.Event())
+        self.assertEqual(connect.call_count, 1)
+        self.assertEqual([e["type"] for e in self.events], ["login_failed"])
+
+    def test_dropped_handshake_on_first_attempt_is_not_retried(self):
+        """A backend that accepts TCP but drops the socket before the login reply ends the first attempt."""
+        with patch('dave_router.websocket.create_connection', side_effect=lambda *a, **k: _FakeSocket([])) as connect:
+            dave_router.ws_thread("ws://backend", "user", "pw", stop_event=threading.Event())
+        self.assertEqual(connect.call_count, 1)
+        self.assertEqual([e["type"] for e in self.events], ["disconnected"])
+
+    def test_handshake_failures_grow_the_backoff(self):
+        """After a drop, failed handshakes count as attempts; only an accepted login resets the backoff."""
+        sockets = [_FakeSocket([{"success": True}])] + [_FakeSocket([]) for _ in range(5)]
+        with patch('dave_router.websocket.create_connection', side_effect=sockets) as connect, \
+                patch.object(dave_router, "RECONNECT_MAX_ATTEMPTS", 3), \
+                patch('dave_router._backoff_delay', return_value=0) as backoff:
+            dave_router.ws_thread("ws://backend", "user", "pw", stop_event=threading.Event())
+        self.assertEqual([c.args[0] for c in backoff.call_args_list], [0, 1, 2])
+        self.assertEqual(connect.call_count, 4)
+        self.assertEqual([e["type"] for e in self.events][-1], "disconnected")
+
+
+class TestMultipleSessions(unittest.TestCase):
+    """Several backend sessions share one engine layer and dispatcher."""
+
+    def setUp(self):
+        dave_router._engine_cache.clear()
+        dave_router._result_cache.clear()
+
+    def _session(self, name, max_concurrent=0):
+        session = dave_router._BackendSession(name, "ws://backend", "user", "pw", max_concurrent=max_concurrent)
+        session.ws = MagicMock()
+        session.binary_frames = True
+        return session
+
+    def test_request_ids_are_scoped_per_session(self):
+        """Sessions reusing a request_id get separate handles and cannot cancel each other's queries."""
+        first, second = self._session("first"), self._session("second")
+        handle = dave_router._register_query("shared", first)
+        self.addCleanup(dave_router._unregister_query, "shared", first)
+        other = dave_router._register_query("shared", second)
+        self.assertIsNot(handle, other)
+        second._handle_message({"type": "sql-query-cancel", "request_id": "shared"})
+        dave_router._unregister_query("shared", second)
+        self.assertFalse(dave_router.cancel_query("shared", MagicMock(), session=second))
+        self.assertIsNone(handle.cancel_reason)
+        self.assertIs(dave_router._active_queries[(first, "shared")], handle)
+
+    def test_connection_key_depends_on_credentials(self):
+        """A wrong password never maps to another session's authenticated engine or cached results."""
+        target = {"dialect": "postgresql", "host": "db", "port": 5432, "user": "app", "database": "prod"}
+        right = dave_router._connection_key_from_object({**target, "password": "right"})
+        wrong = dave_router._connection_key_from_object({**target, "password": "wrong"})
+        self.assertNotEqual(right, wrong)
+        self.assertEqual(right, dave_router._connection_key_from_object({**target, "password": "right"}))
+        self.assertNotIn("right", right)
+
+    def test_responses_go_to_originating_session(self):
+        """Each session receives only the results of its own requests."""
+        first, second = self._session("a"), self._session("b")
+        engine = _sqlite_engine(3)
+        logger = MagicMock()
+        with patch('dave_router.sqlalchemy.create_engine', return_value=engine), \
+                patch('dave_router.message_queue'):
+            for session, request_id in ((first, "q-a"), (second, "q-b")):
+                dave_router._dispatch_sql_query({
+                    "request_id": request_id,
+                    "connectionObject": {"dialect": "sqlite", "database": "shared"},
+                    "query": "SELECT n FROM numbers",
+                }, logger, session)
+            deadline = time.time() + 2
+            while time.time() < deadline and not (first.ws.send.called and second.ws.send.called):
+                time.sleep(0.01)
+
+        for session, request_id in ((first, "q-a"), (second, "q-b")):
+            frames = [msgpack.unpackb(c.args[0], raw=False) for c in session.ws.send.call_args_list]
+            self.assertEqual([f["request_id"] for f in frames], [request_id])
+            self.assertEqual(len(frames[0]["rows"]), 3)
+        # One engine serves both sessions
+        self.assertEqual(dave_router._engine_cache.stats()["engines"], 1)
+
+    def test_session_quota(self):
+        """A session at its quota waits while other sessions keep running."""
+        dispatcher = _QueryDispatcher(max_workers=4, per_key_limit=4, max_pending=10)
+        release = threading.Event()
+        started = []
+
+        def job(name):
+            started.append(name)
+            release.wait(2)
+
+        for name in ("a1", "a2"):
+            self.assertTrue(dispatcher.submit("k", job, name, session="a", session_limit=1))
+        self.assertTrue(dispatcher.submit("k", job, "b1", session="b", session_limit=1))
+        deadline = time.time() + 2
+        while time.time() < deadline and len(started) < 2:
+            time.sleep(0.01)
+        time.sleep(0.05)
+        self.assertEqual(sorted(started), ["a1", "b1"])
+
+        release.set()
+        deadline = time.time() + 2
+        while time.time() < deadline and len(started) < 3:
+            time.sleep(0.01)
+        self.assertEqual(started[-1], "a2")
+
+
+@unittest.skipIf(dave_router._load_websockets() is None, "websockets not installed")
+class TestAsyncTransport(unittest.TestCase):
+    """The asyncio session against a real local websockets server."""
+
+    def setUp(self):
+        dave_router._engine_cache.clear()
+        dave_router._result_cache.clear()
+
+    def _serve(self, handler):
+        """Run handler on a websockets server in a background loop; returns its ws:// URL."""
+        from websockets.asyncio.server import serve
+        ready = threading.Event()
+        ports = []
+
+        async def main():
+            async with serve(handler, "127.0.0.1", 0) as server:
+                ports.append(server.sockets[0].getsockname()[1])
+                ready.set()
+                await asyncio.Future()
+
+        threading.Thread(target=asyncio.run, args=(main(),), daemon=True).start()
+        ready.wait(2)
+        return f"ws://127.0.0.1:{ports[0]}"
+
+    def test_dropped_handshake_on_first_attempt_is_not_retried(self):
+        """A server that closes before replying to the login ends the session instead of looping."""
+        connections = []
+
+        async def backend(ws):
+            connections.append(await ws.recv())
+            await ws.close()
+
+        url = self._serve(backend)
+        with patch('dave_router.message_queue'):
+            session = dave_router._AsyncBackendSession("async-drop", url, "user", "pw")
+            session.start()
+            session.thread.join(5)
+        self.assertFalse(session.running())
+        self.assertEqual(len(connections), 1)
+
+    def test_query_round_trip(self):
+        """Login, a dispatched query and its binary result frame all flow over the asyncio client."""
+        received = []
+        done = threading.Event()
+
+        async def backend(ws):
+            login = json.loads(await ws.recv())
+            received.append(login)
+            await ws.send(json.dumps({"success": True, "capabilities": {"binary_frames": True}}))
+            await ws.send(json.dumps({
+                "type": "sql-query",
+                "request_id": "async-1",
+                "connectionObject": {"dialect": "sqlite", "database": "async_test"},
+                "query": "SELECT n FROM numbers",
+            }))
+            received.append(msgpack.unpackb(await ws.recv(), raw=False))
+            done.set()
+            await ws.wait_closed()
+
+        url = self._serve(backend)
+        with patch('dave_router.sqlalchemy.create_engine', return_value=_sqlite_engine(4)), \
+                patch('dave_router.message_queue'):
+            session = dave_router._AsyncBackendSession("async", url, "user", "pw")
+            self.assertTrue(session.start())
+            self.assertTrue(done.wait(5))
+            session.stop()
+            session.thread.join(5)
+
+        self.assertEqual(received[0]["username"], "user")
+        self.assertEqual(received[1]["request_id"], "async-1")
+        self.assertEqual(len(received[1]["rows"]), 4)
+        self.assertFalse(session.running())
+        self.assertIsNone(session.ws)
+
+
+class TestMetrics(unittest.TestCase):
+    """Prometheus histograms for the query hot path."""
+
+    def setUp(self):
+        dave_router._engine_cache.clear()
+        for histogram in list(dave_router._STAGE_HISTOGRAMS.values()) + [
+                dave_router._ROWS_HISTOGRAM, dave_router._BYTES_HISTOGRAM]:
+            histogram.clear()
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = dave_router._Histogram("test_seconds", "Test", (0.1, 1))
+        for value in (0.05, 0.5, 5):
+            histogram.observe(("sqlite", "abc"), value)
+        text = "\n".join(histogram.render())
+        self.assertIn('test_seconds_bucket{dialect="sqlite",conn="abc",le="0.1"} 1', text)
+        self.assertIn('test_seconds_bucket{dialect="sqlite",conn="abc",le="1"} 2', text)
+        self.assertIn('test_seconds_bucket{dialect="sqlite",conn="abc",le="+Inf"} 3', text)
+        self.assertIn('test_seconds_count{dialect="sqlite",conn="abc"} 3', text)
+
+    def test_query_records_stage_metrics(self):
+        """A query observes every stage once, labelled by dialect and hashed key."""
+        mock_ws = MagicMock()
+        with patch('dave_router.sqlalchemy.create_engine', return_value=_sqlite_engine(5)), \
+                patch('dave_router.message_queue'), \
+                patch('dave_router.ws_connection', mock_ws), patch('dave_router.binary_frames_enabled', True):
+            handle_sql_query({
+                "request_id": "metrics-1",
+                "connectionObject": {"dialect": "sqlite", "database": "metrics_test", "password": "secret"},
+                "query": "SELECT n, label FROM numbers",
+            }, MagicMock())
+
+        text = dave_router.render_metrics()
+        for stage in ("queue_wait", "checkout", "execute", "fetch", "convert", "pack", "send"):
+            self.assertRegex(text, rf'dave_router_{stage}_seconds_count{{dialect="sqlite",conn="[0-9a-f]{{12}}"}} 1')
+        self.assertRegex(text, r'dave_router_response_rows_bucket\{dialect="sqlite",conn="\w+",le="10"\} 1')
+        self.assertRegex(text, rf'dave_router_response_bytes_sum{{dialect="sqlite",conn="\w+"}} {len(mock_ws.send.call_args.args[0])}\.0')
+        self.assertIn("dave_router_engine_cache_engines 1", text)
+        self.assertIn("dave_router_pool_checked_out{dialect=\"sqlite\"", text)
+        self.assertNotIn("secret", text)
+
+
+class TestQueryTimings(unittest.TestCase):
+    """Opt-in per-request timing breakdown."""
+
+    def setUp(self):
+        dave_router._engine_cache.clear()
+        dave_router._result_cache.clear()
+
+    def _run(self, **extra):
+        sent = []
+        data = {
+            "request_id": "timed-1",
+            "connectionObject": {"dialect": "sqlite", "database": "timings_test"},
+            "query": "SELECT n FROM numbers",
+        }
+        data.update(extra)
+        with patch('dave_router.sqlalchemy.create_engine', return_value=_sqlite_engine(3)), \
+                patch('dave_router.message_queue'), \
+                patch('dave_router._send_packed', side_effect=lambda packed, *args: sent.append(packed)):
+            handle_sql_query(data, MagicMock())
+        return msgpack.unpackb(sent[-1], raw=False)
+
+    def test_timings_only_when_requested(self):
+        self.assertNotIn("timings", self._run())
+        timings = self._run(timings=True)["timings"]
+        for key in ("queue_wait_ms", "engine_ms", "checkout_ms", "execute_ms", "fetch_ms", "convert_ms", "pack_ms",
+                    "total_ms"):
+            self.assertGreaterEqual(timings[key], 0)
+        self.assertGreaterEqual(timings["total_ms"], timings["execute_ms"])
+        # Cache misses report the packing of the body that is cached and sent
+        self.assertIn("pack_ms", self._run(cache=True, timings=True)["timings"])
+
+    def test_cached_results_carry_fresh_timings(self):
+        """Timings are spliced per request and never stored in the result cache."""
+        self._run(cache=True)
+        cached = self._run(cache=True, timings=True)
+        self.assertTrue(cached["cached"])
+        self.assertNotIn("execute_ms", cached["timings"])
+        self.assertNotIn("timings", self._run(cache=True))
+
+
+@unittest.skipIf(dave_router._load_websockets() is None, "websockets not installed")
+class TestBenchmarkHarness(unittest.TestCase):
+    """The benchmark harness runs end to end on a tiny fixture."""
+
+    def test_smoke(self):
+        import dave_router_bench
+        report = dave_router_bench.run_benchmarks(rows=50, small_queries=5, concurrency=2, clients=2, per_client=2)
+        results = report["results"]["sqlite"]
+        self.assertGreater(results["small_qps"]["qps"], 0)
+        self.assertEqual([r["rows"] for r in results["large_result"]], [50, 50, 50])
+        self.assertEqual(results["wide_columns"][0]["rows"], 5)
+        self.assertEqual(results["concurrent_latency"]["queries"], 4)
+        json.dumps(report)
+        self.assertTrue(dave_router_bench.compare(report, report))
+
+
+class TestColumnConversion(unittest.TestCase):
+    """Column-at-a-time conversion matches convert_json_safe cell for cell."""
+
+    ROWS = [
+        (1, None, b"\xff\xfe", decimal.Decimal("1.50"), datetime.date(2024, 1, 2), "x", 2.5),
+        (2, datetime.datetime(2024, 1, 1, 5, tzinfo=datetime.timezone.utc), b"\x01", None, None, 7, None),
+        (None, datetime.datetime(2024, 1, 1, 6), b"ok", decimal.Decimal("-3"), datetime.date(1999, 12, 31), "z", 1.0),
+    ]
+
+    def test_matches_convert_json_safe(self):
+        expected = [[dave_router.convert_json_safe(cell) for cell in row] for row in self.ROWS]
+        self.assertEqual(dave_router._convert_rows(self.ROWS), expected)
+
+    def test_native_columns_are_not_converted(self):
+        with patch('dave_router.convert_json_safe') as convert:
+            self.assertEqual(dave_router._convert_rows([(1, "a", 1.5, True), (None, "b", None, False)]),
+                             [[1, "a", 1.5, True], [None, "b", None, False]])
+        convert.assert_not_called()
+        self.assertEqual(dave_router._convert_rows([]), [])
+
+    def test_validity_bitmap(self):
+        values = [None if i % 3 == 0 else i for i in range(21)]
+        expected = bytearray(3)
+        for i, value in enumerate(values):
+            if value is not None:
+                expected[i >> 3] |= 1 << (i & 7)
+        self.assertEqual(dave_router._validity_bitmap(values), bytes(expected))
+        self.assertEqual(dave_router._validity_bitmap([]), b"")
+
+    def test_numpy_and_python_numeric_paths_agree(self):
+        if dave_router._load_numpy() is None:
+            self.skipTest("numpy not installed")
+        columns = ([1, None, -3, 2 ** 40], [1.5, None, float("nan"), 2], [1, None, "2"], [1, None, 2.5])
+        with_numpy = [dave_router._encode_column("c", list(values)) for values in columns]
+        with patch('dave_router._numpy', False):
+            without_numpy = [dave_router._encode_column("c", list(values)) for values in columns]
+        self.assertEqual(repr(with_numpy), repr(without_numpy))
+        self.assertEqual([c["type"] for c in with_numpy], ["int64", "float64", "object", "object"])
+
+
+def _decode_typed(packed):
+    """Reference decoder for the typed value ext types, as a backend would implement it."""
+    def ext_hook(code, data):
+        if code == dave_router._EXT_NAIVE_DATETIME:
+            return datetime.datetime(1970, 1, 1) + datetime.timedelta(microseconds=int.from_bytes(data, "big", signed=True))
+        if code == dave_router._EXT_DATE:
+            return datetime.date(1970, 1, 1) + datetime.timedelta(days=int.from_bytes(data, "big", signed=True))
+        if code == dave_router._EXT_TIME:
+            micros = int.from_bytes(data, "big", signed=True)
+            return (datetime.datetime.min + datetime.timedelta(microseconds=micros)).time()
+        if code == dave_router._EXT_DECIMAL:
+            exponent = int.from_bytes(data[:1], "big", signed=True)
+            unscaled = int.from_bytes(data[1:], "big", signed=True)
+            return decimal.Decimal((int(unscaled < 0), tuple(map(int, str(abs(unscaled)))), exponent))
+        return msgpack.ExtType(code, data)
+    return msgpack.unpackb(packed, raw=False, ext_hook=ext_hook, timestamp=3)
+
+
+class TestTypedValues(unittest.TestCase):
+    """Lossless ext-type encoding negotiated at login."""
+
+    VALUES = [
+        decimal.Decimal("1.50"), decimal.Decimal("-123456789012345678901234567890.0001"), decimal.Decimal("0"),
+        datetime.datetime(2024, 2, 29, 23, 59, 59, 999999), datetime.date(1969, 7, 20), datetime.time(13, 45, 1, 5),
+        datetime.datetime(2024, 1, 1, 5, tzinfo=datetime.timezone.utc), b"\xff\x00", 42, "text", None,
+    ]
+
+    def setUp(self):
+        dave_router._engine_cache.clear()
+        dave_router._result_cache.clear()
+
+    def test_round_trip_is_lossless(self):
+        decoded = _decode_typed(dave_router._packb({"rows": [self.VALUES]}, typed=True))["rows"][0]
+        self.assertEqual(decoded, self.VALUES)
+        self.assertEqual(str(decoded[0]), "1.50")
+        self.assertIsInstance(decoded[7], bytes)
+
+    def test_special_decimals_fall_back_to_strings(self):
+        decoded = _decode_typed(dave_router._packb([decimal.Decimal("NaN"), decimal.Decimal("1E+200")], typed=True))
+        self.assertEqual(decoded, ["NaN", "1E+200"])
+
+    def test_login_negotiation_and_query(self):
+        """A session that accepted typed_values sends raw typed rows; others keep strings."""
+        session = dave_router._BackendSession("typed", "ws://backend", "user", "pw")
+        self.assertTrue(dave_router._router_capabilities()["typed_values"])
+        session._accept_login(MagicMock(), {"success": True, "capabilities": {"binary_frames": True, "typed_values": 1}})
+        self.assertTrue(session.typed_values)
+        engine = sqlalchemy.create_engine("sqlite://", poolclass=sqlalchemy.pool.StaticPool)
+        frames = []
+        session.send_packed = lambda packed, *args: frames.append(packed)
+        query = {
+            "request_id": "typed-1",
+            "connectionObject": {"dialect": "sqlite", "database": "typed_test"},
+            "query": "SELECT :blob AS b, :n AS n",
+            "queryParams": {"blob": b"\xff\x01", "n": 3},
+            "cache": True,
+        }
+        with patch('dave_router.sqlalchemy.create_engine', return_value=engine), \
+                patch('dave_router.message_queue'):
+            dave_router._run_for_session(session, handle_sql_query, dict(query), MagicMock())
+            session.typed_values = False
+            dave_router._run_for_session(session, handle_sql_query, dict(query), MagicMock())
+        typed, untyped = (_decode_typed(frame) for frame in frames)
+        self.assertEqual(typed["rows"], [[b"\xff\x01", 3]])
+        # The untyped request is not served the typed cache entry
+        self.assertNotIn("cached", untyped)
+        self.assertEqual(untyped["rows"], [["ff01", 3]])
+
+
+class TestTerminalLog(unittest.TestCase):
+    """Bounded history behind the UI terminal."""
+
+    def test_ring_buffer_keeps_newest_lines(self):
+        log = dave_router._TerminalLog(3)
+        for i in range(5):
+            log.append(f"line {i}", "info")
+        self.assertEqual(len(log), 3)
+        self.assertEqual([row["text"] for row in log.rows()], ["line 2", "line 3", "line 4"])
+        self.assertEqual([row["id"] for row in log.rows()], [2, 3, 4])
+
+    def test_query_lookup_survives_eviction(self):
+        log = dave_router._TerminalLog(2)
+        first = log.append("Executing Query: SELECT 1", "info", {"query": "SELECT 1"})
+        second = log.append("Executing Query: SELECT 2", "info", {"query": "SELECT 2"})
+        self.assertEqual(log.query(first["id"]), {"query": "SELECT 1"})
+        log.append("done", "success")
+        self.assertIsNone(log.query(first["id"]))
+        self.assertEqual(log.query(second["id"]), {"query": "SELECT 2"})
+        # Rows sent to the browser never include the query payload
+        self.assertTrue(all("query" not in row for row in log.rows()))
+        log.clear()
+        self.assertEqual(log.rows(), [])
+        self.assertIsNone(log.query(second["id"]))
+
+
+class TestEventBus(unittest.TestCase):
+    """Push-based, bounded delivery of UI events."""
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join, 2)
+        self.addCleanup(self.loop.call_soon_threadsafe, self.loop.stop)
+        self.batches = []
+        self.delivered = threading.Event()
+
+    def _handler(self, events, dropped):
+        self.batches.append((events, dropped))
+        self.delivered.set()
+
+    def test_burst_from_many_threads_is_delivered_in_one_batch(self):
+        bus = dave_router._EventBus(5000, 0.2)
+        bus.subscribe(self._handler, self.loop)
+        workers = [threading.Thread(target=lambda: [bus.put({"type": "sql_success", "message": "ok"}) for _ in range(250)])
+                   for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertTrue(self.delivered.wait(2))
+        self.assertEqual(len(self.batches), 1)
+        events, dropped = self.batches[0]
+        self.assertEqual((len(events), dropped), (1000, 0))
+        self.assertEqual(dave_router._coalesce_events(events),
+                         [{"type": "sql_success", "message": "SQL Success: 1000 queries completed."}])
+
+    def test_full_bus_drops_and_counts(self):
+        bus = dave_router._EventBus(5, 0)
+        for i in range(8):
+            bus.put({"type": "sql_success", "message": str(i)})
+        self.assertEqual((len(bus), bus.dropped), (5, 3))
+        # Events buffered before anyone subscribed are delivered on subscribe
+        bus.subscribe(self._handler, self.loop)
+        self.assertTrue(self.delivered.wait(2))
+        events, dropped = self.batches[0]
+        self.assertEqual([event["message"] for event in events], ["0", "1", "2", "3", "4"])
+        self.assertEqual(dropped, 3)
+        self.assertIn("dave_router_ui_events_dropped_total 0", dave_router.render_metrics())
+
+    def test_state_events_are_never_dropped(self):
+        """A full bus still takes connection-state events, keeping only the latest of each type."""
+        bus = dave_router._EventBus(3, 0)
+        bus.put({"type": "connected", "message": "up"})
+        for _ in range(3):
+            bus.put({"type": "sql_success", "message": "ok"})
+        bus.put({"type": "disconnected", "message": "down"})
+        bus.put({"type": "connected", "message": "up again"})
+        bus.put({"type": "sql_error", "message": "boom"})
+        self.assertEqual(bus.dropped, 2)
+        self.assertEqual([event["type"] for event in bus.drain()],
+                         ["sql_success", "sql_success", "disconnected", "connected"])
+
+    def test_coalesce_keeps_small_batches_and_order(self):
+        events = [{"type": "sql_execution_info", "query": "SELECT 1"}, {"type": "sql_success", "message": "1 row"},
+                  {"type": "connected", "message": "up"}]
+        self.assertEqual(dave_router._coalesce_events(events), events)
+        burst = [{"type": "connected", "message": "up"}] + [{"type": "sql_success", "message": "ok"}] * 12 + \
+                [{"type": "sql_error", "message": "boom"}]
+        self.assertEqual([event["type"] for event in dave_router._coalesce_events(burst)],
+                         ["connected", "sql_success", "sql_error"])
+
+
+class TestHeadless(unittest.TestCase):
+    """The tunnel without NiceGUI."""
+
+    _serve = TestAsyncTransport._serve
+
+    def setUp(self):
+        for name, value in (("message_queue", dave_router._EventBus(100, 0)), ("_event_loop", None)):
+            patcher = patch.object(dave_router, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        env = patch.dict(os.environ, {}, clear=False)
+        env.start()
+        self.addCleanup(env.stop)
+        for key in ("DAVE_ROUTER_CONFIG", "DAVE_ROUTER_SESSIONS", "DAVE_ROUTER_URL", "DAVE_ROUTER_USERNAME",
+                    "DAVE_ROUTER_PASSWORD", "DAVE_ROUTER_ID_TOKEN"):
+            os.environ.pop(key, None)
+
+    def test_import_does_not_load_nicegui(self):
+        code = "import sys, dave_router; sys.exit('nicegui' in sys.modules or 'fastapi' in sys.modules)"
+        result = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(result.returncode, 0)
+
+    def test_config_file_with_environment_overrides(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+            json.dump({"url": "wss://file", "username": "file-user", "password": "file-pw",
+                       "sessions": [{"name": "extra", "url": "wss://extra"}, {"url": "wss://unnamed"}]}, f)
+        self.addCleanup(os.remove, f.name)
+        os.environ["DAVE_ROUTER_PASSWORD"] = "env-pw"
+        config = dave_router._load_headless_config(f.name)
+        self.assertEqual((config["url"], config["username"], config["password"]), ("wss://file", "file-user", "env-pw"))
+        self.assertEqual([s["name"] for s in config["sessions"]], ["extra"])
+        self.assertEqual(dave_router.run_headless(os.path.join(os.path.dirname(f.name), "missing.json")), 2)
+
+    def test_missing_credentials_exit_with_usage_error(self):
+        self.assertEqual(dave_router.run_headless(), 2)
+
+    def _run(self, config):
+        """Run _serve_headless on a private loop; returns (loop, stop event, result list, thread)."""
+        loop = asyncio.new_event_loop()
+        state = {}
+        started = threading.Event()
+
+        async def main():
+            state["stop"] = asyncio.Event()
+            started.set()
+            state["code"] = await dave_router._serve_headless(config, state["stop"])
+
+        thread = threading.Thread(target=loop.run_until_complete, args=(main(),), daemon=True)
+        thread.start()
+        started.wait(2)
+        return loop, state, thread
+
+    def test_stops_cleanly_on_request(self):
+        logged_in = threading.Event()
+
+        async def backend(ws):
+            await ws.recv()
+            await ws.send(json.dumps({"success": True}))
+            logged_in.set()
+            await ws.wait_closed()
+
+        url = self._serve(backend)
+        loop, state, thread = self._run({"url": url, "username": "u", "password": "p", "sessions": []})
+        self.assertTrue(logged_in.wait(5))
+        self.assertTrue(dave_router.tunnel_running())
+        loop.call_soon_threadsafe(state["stop"].set)
+        thread.join(10)
+        self.assertEqual(state["code"], 0)
+        self.assertFalse(dave_router.tunnel_running())
+
+    def test_exits_with_error_when_login_is_rejected(self):
+        async def backend(ws):
+            await ws.recv()
+            await ws.send(json.dumps({"success": False, "message": "bad password"}))
+            await ws.wait_closed()
+
+        url = self._serve(backend)
+        with self.assertLogs("dave_router.events", "WARNING") as logs:
+            loop, state, thread = self._run({"url": url, "username": "u", "password": "p", "sessions": []})
+            thread.join(10)
+        self.assertEqual(state["code"], 1)
+        self.assertTrue(any("bad password" in line for line in logs.output))
+
+
+class TestLazyImports(unittest.TestCase):
+    """Heavy dependencies load on first use or from the pre-warm thread."""
+
+    def test_dependencies_load_on_first_use(self):
+        code = """if True:
+            import sys
+            from unittest.mock import patch
+            import dave_router
+            heavy = ("sqlalchemy", "websocket", "msgpack")
+            assert not any(name in sys.modules for name in heavy), [n for n in heavy if n in sys.modules]
+            with patch("dave_router.sqlalchemy.create_engine") as create_engine:
+                assert dave_router.sqlalchemy.create_engine is create_engine
+            import sqlalchemy
+            # The first access rebound the name to the real module, and patch restored it
+            assert dave_router.sqlalchemy is sqlalchemy
+            assert sqlalchemy.create_engine is not create_engine
+            assert "msgpack" not in sys.modules
+        """
+        result = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+    def test_prewarm_loads_drivers_in_background(self):
+        import sqlite3
+        self.assertIs(dave_router._load_driver("sqlite"), sqlite3.dbapi2)
+        with self.assertLogs("dave_router.prewarm", "INFO") as logs:
+            dave_router.prewarm_drivers(["sqlite", "no_such_dialect"]).join(5)
+        self.assertTrue(any("no_such_dialect" in line and "WARNING" in line for line in logs.output))
+        self.assertTrue(any("2 driver(s)" in line for line in logs.output))
+
+
+class TestPoolWarming(unittest.TestCase):
+    """Known targets get pooled connections before their first query."""
+
+    def setUp(self):
+        dave_router._engine_cache.clear()
+        dave_router._pool_warmer.clear()
+        self.addCleanup(dave_router._engine_cache.clear)
+        self.addCleanup(dave_router._pool_warmer.clear)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, True)
+        self.target = {"connectionObject": {"dialect": "sqlite", "database": os.path.join(directory, "warm.db"),
+                                            "password": "secret"}, "min_connections": 2, "id": "t1"}
+
+    def _engine(self):
+        key = dave_router._target_registry.resolve(self.target["connectionObject"], MagicMock()).key
+        return dave_router._engine_cache.peek(key)
+
+    def test_warms_configured_targets(self):
+        futures = dave_router.set_router_targets([self.target, {"connectionObject": {"dialect": "no_such_dialect"}}])
+        for future in futures:
+            future.result(5)
+        status = {target["dialect"]: target for target in dave_router.target_stats()}
+        self.assertEqual(status["sqlite"]["state"], "warm")
+        self.assertEqual((status["sqlite"]["connections"], status["sqlite"]["id"]), (2, "t1"))
+        self.assertEqual(status["no_such_dialect"]["state"], "cold")
+        self.assertTrue(status["no_such_dialect"]["error"])
+        self.assertIn(f'dave_router_target_warm{{dialect="sqlite",conn="{status["sqlite"]["conn"]}"}} 1',
+                      dave_router.render_metrics())
+        # A new list from the same source replaces the old one
+        dave_router.set_router_targets([])
+        self.assertEqual(dave_router.target_stats(), [])
+
+    def test_keepalive_tops_up_pools(self):
+        warmer = dave_router._PoolWarmer(0.05)
+        self.addCleanup(warmer.clear)
+        warmer.set_targets("config", [self.target], MagicMock())[0].result(5)
+        engine = self._engine()
+        self.assertEqual(engine.pool.checkedin(), 2)
+        # Drop the idle connections, as a server-side timeout would
+        engine.pool.dispose()
+        self.assertEqual(engine.pool.checkedin(), 0)
+        deadline = time.time() + 5
+        while engine.pool.checkedin() < 2 and time.time() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(engine.pool.checkedin(), 2)
+
+    def test_router_targets_message_reports_status(self):
+        session = dave_router._BackendSession("warm", "ws://backend", "user", "pw")
+        sent = []
+        reported = threading.Event()
+
+        def capture(message, target_session=None):
+            sent.append((message, target_session))
+            reported.set()
+
+        with patch('dave_router.send_message', side_effect=capture), patch('dave_router.message_queue'):
+            session._handle_message({"type": "router-targets", "targets": [self.target]})
+            self.assertTrue(reported.wait(5))
+        message, target_session = sent[0]
+        self.assertIs(target_session, session)
+        self.assertEqual(message["type"], "router-targets-status")
+        self.assertEqual([(t["id"], t["state"]) for t in message["targets"]], [("t1", "warm")])
+        self.assertNotIn("secret", json.dumps(message))
+        self.assertTrue(dave_router._router_capabilities()["router_targets"])
+
+
+class TestEnginePoolSettings(unittest.TestCase):
+    """Pool sizing is only passed to pools that accept it."""
+
+    def setUp(self):
+        dave_router._engine_cache.clear()
+        self.addCleanup(dave_router._engine_cache.clear)
+
+    def test_in_memory_sqlite_query_succeeds(self):
+        with patch('dave_router.message_queue'), patch('dave_router.send_message') as send:
+            handle_sql_query({"request_id": "mem-1", "connectionObject": {"dialect": "sqlite", "database": ""},
+                              "query": "SELECT 1 AS one"}, MagicMock())
+        response = send.call_args[0][0]
+        self.assertTrue(response["success"], response["message"])
+        self.assertEqual(response["rows"], [[1]])
+
+    def test_queue_pool_dialects_get_pool_settings(self):
+        self.assertTrue(dave_router._uses_queue_pool("sqlite:////tmp/dave_router_pool.db"))
+        self.assertTrue(dave_router._uses_queue_pool("postgresql+psycopg2://u:p@h/d"))
+        self.assertFalse(dave_router._uses_queue_pool("sqlite://"))
+
+
+class TestUiEvents(unittest.TestCase):
+    """Bus deliveries run inside the page's slot, as the old ui.timer callback did."""
+
+    def test_login_failed_event_reaches_the_terminal(self):
+        from nicegui import app, core, ui
+
+        async def main():
+            bus = dave_router._EventBus(100, 0)
+            startup = []
+            with patch.object(core, "loop", asyncio.get_running_loop()), \
+                    patch.object(dave_router, "message_queue", bus), \
+                    patch.object(app, "on_startup", side_effect=startup.append):
+                dave_router.create_ui()
+                for callback in startup:
+                    if getattr(callback, "__module__", None) == "dave_router":
+                        callback()
+                with self.assertNoLogs("dave_router.events", "ERROR"):
+                    bus.put({"type": "login_failed", "message": "Login failed: bad password"})
+                    await asyncio.sleep(0.1)
+            tables = [element for element in ui.context.client.elements.values() if isinstance(element, ui.table)]
+            return [row["text"] for row in tables[-1].rows]
+
+        self.assertEqual(asyncio.run(main()), ["Login failed: bad password"])
+
+
 if __name__ == '__main__':
     unittest.main() 
\ No newline at end of file